@@ -0,0 +1,10 @@
+"""Offline benchmarks of the hot paths of the electroncash package.
+
+Run them from the root of the repository with:
+
+    python -m benchmarks run [-o results.json] [--scale N] [names...]
+    python -m benchmarks compare old.json new.json
+    python -m benchmarks.walletgen wallet_file [--production] [options]
+
+See README.rst in this directory.
+"""
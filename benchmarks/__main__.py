@@ -0,0 +1,47 @@
+import argparse
+import json
+import sys
+
+from . import bench_blockchain, bench_keys, bench_transaction, bench_wallet  # noqa: F401
+from .harness import BENCHMARKS, compare, run
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("run", help="run the benchmarks")
+    p.add_argument("names", nargs="*", help="benchmarks or groups to run (default: all)")
+    p.add_argument("-o", "--output", help="save the results to this JSON file")
+    p.add_argument("--scale", type=int, default=1, help="multiply the size of the synthetic wallets")
+    p.add_argument("--repeat", type=int, help="override the number of timed runs")
+    sub.add_parser("list", help="list the benchmarks")
+    p = sub.add_parser("compare", help="compare two JSON results")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=0.1,
+                   help="report time ratios beyond 1 +/- threshold (default 0.1)")
+    p.add_argument("--fail", action="store_true",
+                   help="exit with status 1 if a benchmark got slower")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for bench in BENCHMARKS.values():
+            print("{:<32} {}".format(bench.name, bench.group))
+    elif args.command == "run":
+        results = run(args.names, scale=args.scale, repeat=args.repeat)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+                f.write("\n")
+    elif args.command == "compare":
+        with open(args.old, encoding="utf-8") as f:
+            old = json.load(f)
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+        slower = compare(old, new, threshold=args.threshold)
+        if slower and args.fail:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""Header chain verification."""
+from electroncash import blockchain, networks
+
+from .harness import benchmark
+from .synthetic import SyntheticBlockchain, synthetic_headers
+
+CHUNK_SIZE = 2016
+
+
+@benchmark("verify_chunk", group="blockchain", ops=CHUNK_SIZE)
+def bench_verify_chunk(ctx):
+    anchor = networks.net.asert_daa.anchor
+    base = anchor.height + 20 * CHUNK_SIZE
+    headers = synthetic_headers(base - 11, CHUNK_SIZE + 11)
+    chunk_data = b"".join(
+        bytes.fromhex(blockchain.serialize_header(headers[h]))
+        for h in range(base, base + CHUNK_SIZE)
+    )
+    chain = SyntheticBlockchain(headers)
+
+    def func():
+        # The synthetic headers cannot have a real proof of work: accept
+        # any hash, everything else is checked.
+        bits_to_target = blockchain.bits_to_target
+        blockchain.bits_to_target = lambda bits: 1 << 256
+        try:
+            chain.verify_chunk(base, chunk_data)
+        finally:
+            blockchain.bits_to_target = bits_to_target
+    return func
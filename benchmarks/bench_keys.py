@@ -0,0 +1,31 @@
+"""BIP32 key derivation."""
+from electroncash import bitcoin, keystore
+
+from .harness import benchmark
+from .synthetic import SEED
+
+N_KEYS = 100
+
+
+def root_keystore():
+    return keystore.from_seed(SEED, "", seed_type="bip39")
+
+
+@benchmark("bip32_public_derivation", group="keys", ops=N_KEYS)
+def bench_public_derivation(ctx):
+    xtype, depth, fp, child_number, c, K = bitcoin.deserialize_xpub(root_keystore().xpub)
+
+    def func():
+        for i in range(N_KEYS):
+            bitcoin.CKD_pub(K, c, i)
+    return func
+
+
+@benchmark("bip32_private_derivation", group="keys", ops=N_KEYS)
+def bench_private_derivation(ctx):
+    xtype, depth, fp, child_number, c, k = bitcoin.deserialize_xprv(root_keystore().xprv)
+
+    def func():
+        for i in range(N_KEYS):
+            bitcoin.CKD_priv(k, c, i)
+    return func
@@ -0,0 +1,59 @@
+"""Transaction parsing, serialization and signing."""
+import copy
+
+from electroncash.transaction import Transaction
+
+from .harness import benchmark
+from .synthetic import PAYEE, SyntheticWallet
+
+N_TXS = 1000
+
+
+def raw_txs(ctx):
+    def factory(ctx):
+        synthetic = SyntheticWallet(ctx.path("tx_wallet"), n_addresses=20, n_txs=N_TXS)
+        return [tx.raw for tx_hash, tx, height in synthetic.txs]
+    return ctx.fixture("raw_txs", factory)
+
+
+@benchmark("tx_deserialize", group="transaction", ops=N_TXS)
+def bench_deserialize(ctx):
+    raws = raw_txs(ctx)
+
+    def func():
+        for raw in raws:
+            Transaction(raw).deserialize()
+    return func
+
+
+@benchmark("tx_serialize", group="transaction", ops=N_TXS)
+def bench_serialize(ctx):
+    txs = [Transaction(raw) for raw in raw_txs(ctx)]
+    for tx in txs:
+        tx.deserialize()
+
+    def func():
+        for tx in txs:
+            tx.serialize()
+    return func
+
+
+def signing_setup(ctx, n_inputs):
+    synthetic = SyntheticWallet(ctx.path("sign_wallet_%d" % n_inputs), n_addresses=20, n_txs=100, seed=n_inputs)
+    wallet = synthetic.wallet
+    coins = wallet.get_spendable_coins(None, synthetic.config)[:n_inputs]
+    amount = sum(coin["value"] for coin in coins) // 2
+    tx = wallet.make_unsigned_transaction(coins, [(0, PAYEE, amount)], synthetic.config)
+    return wallet, tx
+
+
+@benchmark("tx_sign_1_input", group="transaction")
+def bench_sign_1(ctx):
+    wallet, tx = signing_setup(ctx, 1)
+    return lambda: wallet.sign_transaction(copy.deepcopy(tx), None)
+
+
+@benchmark("tx_sign_10_inputs", group="transaction", repeat=3, ops=10)
+def bench_sign_10(ctx):
+    wallet, tx = signing_setup(ctx, 10)
+    return lambda: wallet.sign_transaction(copy.deepcopy(tx), None)
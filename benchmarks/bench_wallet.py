@@ -0,0 +1,94 @@
+"""Wallet storage, wallet open and wallet queries."""
+from electroncash.storage import WalletStorage
+from electroncash.wallet import Wallet
+
+from .harness import benchmark
+from .synthetic import PAYEE, Shape, SyntheticWallet
+
+# Size of the large wallet at scale 1
+N_ADDRESSES = 200
+N_TXS = 2000
+
+
+def large_wallet(ctx):
+    def factory(ctx):
+        # the mix of a production wallet, at a size set by the scale
+        shape = Shape.production(addresses=N_ADDRESSES * ctx.scale,
+                                 change_addresses=N_ADDRESSES * ctx.scale // 10,
+                                 txs=N_TXS * ctx.scale)
+        return SyntheticWallet(ctx.path("large_wallet"), shape=shape)
+    return ctx.fixture("large_wallet", factory)
+
+
+@benchmark("storage_open", group="wallet")
+def bench_storage_open(ctx):
+    path = large_wallet(ctx).path
+    return lambda: WalletStorage(path)
+
+
+@benchmark("storage_write", group="wallet")
+def bench_storage_write(ctx):
+    storage = WalletStorage(large_wallet(ctx).path)
+
+    def func():
+        storage.modified = True
+        storage.write()
+    return func
+
+
+@benchmark("wallet_load_transactions", group="wallet", ops=lambda scale: N_TXS * scale)
+def bench_load_transactions(ctx):
+    wallet = large_wallet(ctx).wallet
+    return wallet.load_transactions
+
+
+@benchmark("wallet_open", group="wallet")
+def bench_wallet_open(ctx):
+    path = large_wallet(ctx).path
+    return lambda: Wallet(WalletStorage(path))
+
+
+@benchmark("add_transaction", group="wallet", repeat=3, ops=lambda scale: N_TXS * scale)
+def bench_add_transaction(ctx):
+    synthetic = large_wallet(ctx)
+    wallet = synthetic.open()
+    txs = [(tx_hash, tx) for tx_hash, tx, height in synthetic.txs]
+
+    def func():
+        wallet.clear_history()
+        for tx_hash, tx in txs:
+            wallet.add_transaction(tx_hash, tx)
+    return func
+
+
+@benchmark("get_history", group="wallet")
+def bench_get_history(ctx):
+    wallet = large_wallet(ctx).open()
+    return wallet.get_history
+
+
+@benchmark("get_balance", group="wallet")
+def bench_get_balance(ctx):
+    wallet = large_wallet(ctx).open()
+
+    def func():
+        # measure the computation, not the balance cache
+        wallet._addr_bal_cache.clear()
+        wallet.get_balance()
+    return func
+
+
+@benchmark("get_utxos", group="wallet")
+def bench_get_utxos(ctx):
+    wallet = large_wallet(ctx).open()
+    return wallet.get_utxos
+
+
+@benchmark("coinchooser_make_tx", group="wallet")
+def bench_make_tx(ctx):
+    synthetic = large_wallet(ctx)
+    wallet = synthetic.open()
+    coins = wallet.get_spendable_coins(None, synthetic.config)
+    amount = sum(coin["value"] for coin in coins) // 3
+    outputs = [(0, PAYEE, amount)]
+    return lambda: wallet.make_unsigned_transaction(coins, outputs, synthetic.config)
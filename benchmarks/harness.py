@@ -0,0 +1,209 @@
+"""Registration, timing and reporting of the benchmarks."""
+import gc
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+
+FORMAT_VERSION = 1
+
+BENCHMARKS = OrderedDict()
+
+
+class Benchmark:
+    def __init__(self, func, name, group, repeat, ops):
+        self.func = func
+        self.name = name
+        self.group = group
+        self.repeat = repeat
+        self.ops = ops
+
+
+def benchmark(name, *, group, repeat=5, ops=1):
+    """Registers a benchmark.
+
+    The decorated function is called with a Context. It does the setup that
+    is not measured and returns the function to time, which is called
+    `repeat` times. `ops` is the number of operations done by one call of
+    that function (an int, or a function of the scale), used to report
+    throughput."""
+    def decorator(func):
+        assert name not in BENCHMARKS, name
+        BENCHMARKS[name] = Benchmark(func, name, group, repeat, ops)
+        return func
+    return decorator
+
+
+class Context:
+    """Shared state of a run: scale, temporary directory, and fixtures that
+    are built once and reused by several benchmarks (see fixture())."""
+
+    def __init__(self, scale=1):
+        self.scale = scale
+        self.tmpdir = tempfile.mkdtemp(prefix="electroncash-bench-")
+        self.fixtures = {}
+
+    def fixture(self, name, factory):
+        if name not in self.fixtures:
+            self.fixtures[name] = factory(self)
+        return self.fixtures[name]
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def close(self):
+        for value in self.fixtures.values():
+            close = getattr(value, "close", None)
+            if close:
+                close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def git_revision():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True, timeout=10
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def environment():
+    from electroncash import ecc_fast, schnorr
+    from electroncash.version import PACKAGE_VERSION
+
+    return {
+        "version": PACKAGE_VERSION,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "fast_ecc": ecc_fast.is_using_fast_ecc(),
+        "fast_schnorr": schnorr.has_fast_sign(),
+    }
+
+
+def measure(bench, ctx, repeat=None):
+    """Returns the result of a benchmark as a dict."""
+    repeat = repeat or bench.repeat
+    ops = bench.ops(ctx.scale) if callable(bench.ops) else bench.ops
+    t0 = time.perf_counter()
+    func = bench.func(ctx)
+    setup_time = time.perf_counter() - t0
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    # One more call, traced, for memory: tracemalloc slows everything down so
+    # it is kept out of the timings.
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best = min(times)
+    return {
+        "group": bench.group,
+        "repeat": repeat,
+        "ops": ops,
+        "setup": setup_time,
+        "min": best,
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "ops_per_sec": ops / best if best > 0 else None,
+        "peak_memory": peak,
+        "retained_memory": current,
+    }
+
+
+def select(names):
+    """The benchmarks whose name or group is in names (all if empty)."""
+    if not names:
+        return list(BENCHMARKS.values())
+    selected = [b for b in BENCHMARKS.values() if b.name in names or b.group in names]
+    unknown = set(names) - {b.name for b in selected} - {b.group for b in selected}
+    if unknown:
+        raise ValueError("unknown benchmarks: " + ", ".join(sorted(unknown)))
+    return selected
+
+
+def run(names=(), *, scale=1, repeat=None, out=sys.stderr):
+    ctx = Context(scale)
+    results = OrderedDict()
+    try:
+        for bench in select(names):
+            print("{:<32}".format(bench.name), end="", file=out, flush=True)
+            result = measure(bench, ctx, repeat)
+            results[bench.name] = result
+            print(format_result(result), file=out, flush=True)
+    finally:
+        ctx.close()
+    return {
+        "format": FORMAT_VERSION,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "scale": scale,
+        "environment": environment(),
+        "results": results,
+    }
+
+
+def format_time(t):
+    if t < 1e-3:
+        return "{:.1f} us".format(t * 1e6)
+    if t < 1:
+        return "{:.2f} ms".format(t * 1e3)
+    return "{:.3f} s".format(t)
+
+
+def format_memory(n):
+    return "{:.1f} MiB".format(n / 2**20)
+
+
+def format_result(r):
+    rate = "{:>12.1f} ops/s".format(r["ops_per_sec"]) if r["ops_per_sec"] else ""
+    return "{:>12} {:>12} {} peak {}".format(
+        format_time(r["min"]), format_time(r["median"]), rate, format_memory(r["peak_memory"])
+    )
+
+
+def compare(old, new, *, threshold=0.1, out=sys.stdout):
+    """Prints the change of the best time of the benchmarks found in both
+    runs. Returns the names of the benchmarks that got slower by more than
+    threshold (a ratio)."""
+    slower = []
+    print("{:<32} {:>12} {:>12} {:>8} {:>8}".format("benchmark", "old", "new", "time", "memory"), file=out)
+    for name, n in new["results"].items():
+        o = old["results"].get(name)
+        if o is None:
+            continue
+        ratio = n["min"] / o["min"] if o["min"] else float("inf")
+        mem_ratio = n["peak_memory"] / o["peak_memory"] if o["peak_memory"] and n["peak_memory"] else None
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  slower"
+            slower.append(name)
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(
+            "{:<32} {:>12} {:>12} {:>7.2f}x {:>8}{}".format(
+                name, format_time(o["min"]), format_time(n["min"]), ratio,
+                "-" if mem_ratio is None else "{:.2f}x".format(mem_ratio), flag
+            ),
+            file=out,
+        )
+    return slower
@@ -0,0 +1,709 @@
+"""A stand-in ElectrumX server replaying recorded sessions.
+
+    python -m benchmarks.replay capture --upstream HOST:PORT:s -o session.json
+    python -m benchmarks.replay serve session.json [--latency MS] [faults...]
+    python -m benchmarks.replay sync (--session session.json | --server S) --restore TEXT
+
+capture runs a proxy in front of a real server (point a client at it with
+--oneserver --server 127.0.0.1:PORT:t) and records the responses to every
+request, and the notifications, until it is stopped. serve answers the
+requests of the clients with the recorded responses, after the configured
+latency, at the configured bandwidth, and with the configured faults. sync
+times a full synchronization of a wallet with the real Network, Interface,
+Synchronizer and SPV, against a session or a server, and saves the
+results in the format of "python -m benchmarks run" so that they can be
+compared.
+
+A full sync needs the headers from the checkpoint and the merkle proof of
+the checkpoint, which only a real server has: record the sessions with
+sync, through capture, starting from an empty data directory, as the
+replayed client does.
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import shutil
+import socket
+import socketserver
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+SESSION_VERSION = 1
+
+# Answers to the requests that do not depend on the server data, when they
+# were not recorded.
+DEFAULT_RESULTS = {
+    "server.ping": None,
+    "server.version": ["ElectrumX 1.16.0", "1.4"],
+    "server.banner": "",
+    "server.donation_address": "",
+    "server.peers.subscribe": [],
+    "mempool.get_fee_histogram": [],
+}
+
+METHOD_NOT_FOUND = -32601
+
+
+def request_key(method, params):
+    return method + " " + json.dumps(params, sort_keys=True, separators=(",", ":"))
+
+
+class Session:
+    """The responses of a server, by request, and its notifications.
+
+    A request may have several responses, in the order they were recorded,
+    e.g. blockchain.headers.subscribe after a new block. They are replayed
+    in the same order on each connection, the last one being repeated."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # request key -> {"method", "params", "responses": [{"result"} or {"error"}]}
+        self.requests = OrderedDict()
+        # {"offset": seconds since the connection, "method", "params"}
+        self.notifications = []
+
+    def __len__(self):
+        return len(self.requests)
+
+    def record(self, method, params, response):
+        entry = {"error": response["error"]} if response.get("error") else {"result": response.get("result")}
+        with self.lock:
+            key = request_key(method, params)
+            item = self.requests.get(key)
+            if item is None:
+                item = self.requests[key] = {"method": method, "params": params, "responses": []}
+            if not item["responses"] or item["responses"][-1] != entry:
+                item["responses"].append(entry)
+
+    def record_notification(self, method, params, offset):
+        with self.lock:
+            self.notifications.append({"offset": round(offset, 3), "method": method, "params": params})
+
+    def responses(self, method, params):
+        """The recorded responses to a request, or None."""
+        item = self.requests.get(request_key(method, params))
+        return item["responses"] if item else None
+
+    def save(self, path):
+        with self.lock:
+            data = {
+                "version": SESSION_VERSION,
+                "requests": list(self.requests.values()),
+                "notifications": sorted(self.notifications, key=lambda n: n["offset"]),
+            }
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != SESSION_VERSION:
+            raise ValueError("unsupported session version {!r}".format(data.get("version")))
+        session = cls()
+        for item in data["requests"]:
+            session.requests[request_key(item["method"], item["params"])] = item
+        session.notifications = data["notifications"]
+        return session
+
+
+class Faults:
+    """Network conditions and faults of a ReplayServer.
+
+    latency and jitter are in seconds: each response is sent after latency
+    plus a uniform random delay of up to jitter. bandwidth, in bytes per
+    second, limits the sending rate of each connection. Each request gets
+    an error response with probability error_rate, is never answered with
+    probability stall_rate, gets a line of invalid JSON with probability
+    garbage_rate, and makes the server close the connection with
+    probability drop_rate. disconnect_after closes each connection after
+    that many responses. The faults of a connection only depend on seed
+    and on the order of its requests."""
+
+    def __init__(self, *, latency=0.0, jitter=0.0, bandwidth=None, error_rate=0.0,
+                 stall_rate=0.0, garbage_rate=0.0, drop_rate=0.0, disconnect_after=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.garbage_rate = garbage_rate
+        self.drop_rate = drop_rate
+        self.disconnect_after = disconnect_after
+        self.seed = seed
+
+
+class _Closed(Exception):
+    pass
+
+
+class ReplayConnection:
+    """Serves one client of a ReplayServer. Requests are read by the
+    handler thread and the responses are sent, when due, by a writer
+    thread."""
+
+    def __init__(self, server, sock, index):
+        self.server = server
+        self.sock = sock
+        self.faults = server.faults
+        self.rng = random.Random("{}:{}".format(self.faults.seed, index))
+        self.start_time = time.monotonic()
+        # request key -> number of responses already replayed
+        self.cursors = {}
+        self.subscriptions = set()
+        self.pending_notifications = list(server.session.notifications)
+        self.queue = []  # heap of (due time, seq, bytes or None to close)
+        self.seq = 0
+        self.responses_sent = 0
+        self.cond = threading.Condition()
+        self.closed = False
+
+    # -- writer
+
+    def schedule(self, data, delay=0.0):
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.queue, (time.monotonic() + delay, self.seq, data))
+            self.cond.notify()
+
+    def writer(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.closed and (not self.queue or self.queue[0][0] > time.monotonic()):
+                        timeout = self.queue[0][0] - time.monotonic() if self.queue else None
+                        self.cond.wait(timeout)
+                    if self.closed:
+                        return
+                    _, _, data = heapq.heappop(self.queue)
+                if data is None:
+                    raise _Closed()
+                self.send(data)
+        except (_Closed, OSError):
+            self.close()
+
+    def send(self, data):
+        bandwidth = self.faults.bandwidth
+        if not bandwidth:
+            self.sock.sendall(data)
+            return
+        chunk = max(1, int(bandwidth / 20))
+        for i in range(0, len(data), chunk):
+            t0 = time.monotonic()
+            part = data[i:i + chunk]
+            self.sock.sendall(part)
+            wait = len(part) / bandwidth - (time.monotonic() - t0)
+            if wait > 0:
+                time.sleep(wait)
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # -- requests
+
+    def delay(self):
+        faults = self.faults
+        return faults.latency + (self.rng.uniform(0, faults.jitter) if faults.jitter else 0.0)
+
+    def answer(self, request):
+        """Returns the response dict to a request, or None to not answer."""
+        server = self.server
+        method = request.get("method")
+        params = request.get("params", [])
+        wire_id = request.get("id")
+        server.count("requests")
+        responses = server.session.responses(method, params)
+        if responses:
+            key = request_key(method, params)
+            n = self.cursors.get(key, 0)
+            self.cursors[key] = n + 1
+            entry = responses[min(n, len(responses) - 1)]
+        elif method in DEFAULT_RESULTS:
+            entry = {"result": DEFAULT_RESULTS[method]}
+        else:
+            server.count("misses")
+            server.missed(method, params)
+            entry = {"error": {"code": METHOD_NOT_FOUND, "message": "no recorded response"}}
+        if isinstance(method, str) and method.endswith(".subscribe") and "result" in entry:
+            self.subscriptions.add(request_key(method, params[:1]))
+        if wire_id is None:
+            return None
+        return dict(entry, jsonrpc="2.0", id=wire_id)
+
+    def handle_line(self, line):
+        faults = self.faults
+        rng = self.rng
+        try:
+            message = json.loads(line)
+        except ValueError:
+            self.server.count("bad_requests")
+            raise _Closed()
+        batch = isinstance(message, list)
+        requests = message if batch else [message]
+        if rng.random() < faults.drop_rate:
+            self.server.count("drops")
+            self.schedule(None, self.delay())
+            return
+        if rng.random() < faults.stall_rate:
+            self.server.count("stalls")
+            return
+        if rng.random() < faults.garbage_rate:
+            self.server.count("garbage")
+            self.schedule(b'{"jsonrpc": "2.0", "id": \n', self.delay())
+            return
+        error = rng.random() < faults.error_rate
+        responses = []
+        for request in requests:
+            if not isinstance(request, dict):
+                raise _Closed()
+            response = self.answer(request)
+            if response is None:
+                continue
+            if error:
+                self.server.count("errors")
+                response.pop("result", None)
+                response["error"] = {"code": -32603, "message": "injected error"}
+            responses.append(response)
+        if not responses:
+            return
+        payload = responses if batch else responses[0]
+        delay = self.delay()
+        self.schedule(json.dumps(payload).encode("utf-8") + b"\n", delay)
+        self.responses_sent += 1
+        if faults.disconnect_after and self.responses_sent >= faults.disconnect_after:
+            self.server.count("disconnects")
+            self.schedule(None, delay)
+        self.schedule_notifications()
+
+    def schedule_notifications(self):
+        """Sends the recorded notifications of the subscriptions of the
+        client, at their recorded time."""
+        remaining = []
+        now = time.monotonic() - self.start_time
+        for notification in self.pending_notifications:
+            params = notification["params"]
+            # headers notifications go to the headers subscribers, the
+            # scripthash ones to the subscribers of that scripthash
+            keys = (request_key(notification["method"], params[:1]), request_key(notification["method"], []))
+            if not any(key in self.subscriptions for key in keys):
+                remaining.append(notification)
+                continue
+            message = {"jsonrpc": "2.0", "method": notification["method"], "params": params}
+            self.schedule(json.dumps(message).encode("utf-8") + b"\n", max(0.0, notification["offset"] - now))
+        self.pending_notifications = remaining
+
+    def run(self, rfile):
+        writer = threading.Thread(target=self.writer, name="ReplayWriter", daemon=True)
+        writer.start()
+        try:
+            for line in rfile:
+                if self.closed:
+                    break
+                if line.strip():
+                    self.handle_line(line)
+        except (_Closed, OSError, ValueError):
+            pass
+        finally:
+            self.close()
+            writer.join(5)
+
+
+class _ReplayHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        with server.stats_lock:
+            server.stats["connections"] += 1
+            index = server.stats["connections"]
+        ReplayConnection(server, self.connection, index).run(self.rfile)
+
+
+class ReplayServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Answers Electrum protocol requests (over TCP, without SSL) with the
+    responses of a Session. Use port 0 to get a free port, see address().
+
+    The requests that were not recorded get an error, and are counted in
+    stats() by method."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, session, *, host="127.0.0.1", port=0, faults=None):
+        super().__init__((host, port), _ReplayHandler)
+        self.session = session
+        self.faults = faults or Faults()
+        self.stats_lock = threading.Lock()
+        self.stats = dict.fromkeys(("connections", "requests", "misses", "errors", "stalls",
+                                    "garbage", "drops", "disconnects", "bad_requests"), 0)
+        self.missed_methods = {}
+        self.thread = None
+
+    def address(self):
+        """The server string for the client, as in --server."""
+        host, port = self.server_address[:2]
+        return "{}:{}:t".format(host, port)
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def missed(self, method, params):
+        with self.stats_lock:
+            self.missed_methods[str(method)] = self.missed_methods.get(str(method), 0) + 1
+
+    def get_stats(self):
+        with self.stats_lock:
+            return dict(self.stats, missed_methods=dict(self.missed_methods))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="ReplayServer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+# ------------------------------------------------------------------------
+# Capture
+
+
+def connect_upstream(server):
+    host, port, protocol = server.rsplit(":", 2)
+    sock = socket.create_connection((host, int(port)), timeout=30)
+    sock.settimeout(None)
+    if protocol == "s":
+        # Like the client with self-signed certificates, the proxy does not
+        # verify the server: it is only used to record test data.
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        sock = context.wrap_socket(sock, server_hostname=host)
+    elif protocol != "t":
+        raise ValueError("unknown protocol " + protocol)
+    return sock
+
+
+class _CaptureHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        proxy = self.server
+        session = proxy.session
+        start = time.monotonic()
+        pending = {}
+        pending_lock = threading.Lock()
+        try:
+            upstream = connect_upstream(proxy.upstream)
+        except (OSError, ValueError) as e:
+            print("capture: cannot connect to", proxy.upstream, repr(e), file=sys.stderr)
+            return
+        client = self.connection
+
+        def requests(message):
+            return message if isinstance(message, list) else [message]
+
+        def from_server():
+            try:
+                for line in upstream.makefile("rb"):
+                    try:
+                        message = json.loads(line)
+                    except ValueError:
+                        message = None
+                    for response in requests(message) if message is not None else ():
+                        if not isinstance(response, dict):
+                            continue
+                        if response.get("id") is None and isinstance(response.get("method"), str):
+                            session.record_notification(response["method"], response.get("params", []),
+                                                        time.monotonic() - start)
+                            continue
+                        with pending_lock:
+                            request = pending.pop(response.get("id"), None)
+                        if request is not None:
+                            session.record(request[0], request[1], response)
+                    client.sendall(line)
+            except OSError:
+                pass
+            finally:
+                for s in (client, upstream):
+                    try:
+                        s.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+        thread = threading.Thread(target=from_server, name="CaptureReader", daemon=True)
+        thread.start()
+        try:
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    message = None
+                for request in requests(message) if message is not None else ():
+                    if isinstance(request, dict) and request.get("id") is not None:
+                        with pending_lock:
+                            pending[request["id"]] = (request.get("method"), request.get("params", []))
+                upstream.sendall(line)
+        except OSError:
+            pass
+        finally:
+            try:
+                upstream.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            thread.join(5)
+            upstream.close()
+            proxy.save()
+
+
+class CaptureProxy(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Forwards the connections of Electrum clients to the upstream server
+    and records its responses in a Session, saved to path after each
+    connection."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, upstream, path, *, host="127.0.0.1", port=0, session=None):
+        super().__init__((host, port), _CaptureHandler)
+        self.upstream = upstream
+        self.path = path
+        self.session = session or Session()
+        self.save_lock = threading.Lock()
+        self.thread = None
+
+    def address(self):
+        host, port = self.server_address[:2]
+        return "{}:{}:t".format(host, port)
+
+    def save(self):
+        if self.path:
+            with self.save_lock:
+                self.session.save(self.path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="CaptureProxy", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.save()
+
+
+# ------------------------------------------------------------------------
+# Wallet sync
+
+
+def sync_wallet(server, *, wallet_path=None, restore=None, timeout=600):
+    """Synchronizes a copy of the wallet at wallet_path, or a wallet
+    restored from the text restore, from scratch with a new data directory.
+    Returns a dict of timings and counts."""
+    from electroncash.network import Network
+    from electroncash.simple_config import SimpleConfig
+    from electroncash.storage import WalletStorage
+    from electroncash.wallet import Wallet, restore_wallet_from_text
+
+    tmpdir = tempfile.mkdtemp(prefix="electroncash-sync-")
+    network = wallet = None
+    try:
+        config = SimpleConfig({
+            "data_path": tmpdir,
+            "server": server,
+            "oneserver": True,
+            "auto_connect": False,
+            "whitelist_servers_only": False,
+        }, read_user_config_function=lambda path: {})
+        path = os.path.join(tmpdir, "wallet")
+        if wallet_path:
+            shutil.copyfile(wallet_path, path)
+            wallet = Wallet(WalletStorage(path))
+        else:
+            wallet = restore_wallet_from_text(restore, path=path, config=config, encrypt_file=False)["wallet"]
+        t0 = time.perf_counter()
+        network = Network(config)
+        network.start()
+        wallet.start_threads(network)
+        connected = None
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if connected is None and network.is_connected():
+                connected = time.perf_counter() - t0
+            if (connected is not None and wallet.is_up_to_date()
+                    and not wallet.get_unverified_tx_pending_count()):
+                break
+            time.sleep(0.01)
+        else:
+            raise TimeoutError("wallet not synchronized after {} seconds".format(timeout))
+        return {
+            "connect": connected,
+            "sync": time.perf_counter() - t0,
+            "transactions": len(wallet.transactions),
+            "verified": len(wallet.verified_tx),
+            "addresses": len(wallet.get_addresses()),
+        }
+    finally:
+        if wallet is not None:
+            wallet.stop_threads()
+        if network is not None:
+            network.stop()
+            network.join()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# ------------------------------------------------------------------------
+# Command line
+
+
+def add_fault_arguments(parser):
+    group = parser.add_argument_group("network conditions and faults")
+    group.add_argument("--latency", type=float, default=0.0, metavar="MS", help="latency of each response")
+    group.add_argument("--jitter", type=float, default=0.0, metavar="MS", help="random extra latency")
+    group.add_argument("--bandwidth", type=float, metavar="KB/S", help="sending rate of each connection")
+    group.add_argument("--error-rate", type=float, default=0.0)
+    group.add_argument("--stall-rate", type=float, default=0.0)
+    group.add_argument("--garbage-rate", type=float, default=0.0)
+    group.add_argument("--drop-rate", type=float, default=0.0)
+    group.add_argument("--disconnect-after", type=int, metavar="N")
+    group.add_argument("--seed", type=int, default=0)
+
+
+def faults_from_args(args):
+    return Faults(
+        latency=args.latency / 1000, jitter=args.jitter / 1000,
+        bandwidth=args.bandwidth * 1000 if args.bandwidth else None,
+        error_rate=args.error_rate, stall_rate=args.stall_rate, garbage_rate=args.garbage_rate,
+        drop_rate=args.drop_rate, disconnect_after=args.disconnect_after, seed=args.seed,
+    )
+
+
+def wait_for_interrupt():
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.replay",
+                                     description=__doc__.split("\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("serve", help="serve a recorded session")
+    p.add_argument("session")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=50001)
+    add_fault_arguments(p)
+
+    p = sub.add_parser("capture", help="record the sessions of a real server")
+    p.add_argument("--upstream", required=True, metavar="HOST:PORT:PROTOCOL")
+    p.add_argument("-o", "--output", required=True, help="session file, extended if it exists")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=50001)
+
+    p = sub.add_parser("sync", help="time a full wallet sync")
+    source = p.add_mutually_exclusive_group(required=True)
+    source.add_argument("--session", help="replay this session")
+    source.add_argument("--server", metavar="HOST:PORT:PROTOCOL", help="use this server, e.g. a capture proxy")
+    wallet = p.add_mutually_exclusive_group(required=True)
+    wallet.add_argument("--wallet", help="sync a copy of this wallet file")
+    wallet.add_argument("--restore", metavar="TEXT", help="sync a wallet restored from a seed, key or addresses")
+    p.add_argument("--repeat", type=int, default=1)
+    p.add_argument("--timeout", type=float, default=600)
+    p.add_argument("-o", "--output", help="save the results to this JSON file")
+    add_fault_arguments(p)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        server = ReplayServer(Session.load(args.session), host=args.host, port=args.port,
+                              faults=faults_from_args(args))
+        server.start()
+        print("serving", args.session, "on", server.address(), file=sys.stderr)
+        wait_for_interrupt()
+        server.stop()
+        json.dump(server.get_stats(), sys.stdout, indent=2)
+        print()
+    elif args.command == "capture":
+        session = Session.load(args.output) if os.path.exists(args.output) else None
+        proxy = CaptureProxy(args.upstream, args.output, host=args.host, port=args.port, session=session)
+        proxy.start()
+        print("recording", args.upstream, "on", proxy.address(), file=sys.stderr)
+        wait_for_interrupt()
+        proxy.stop()
+        print("recorded", len(proxy.session), "requests to", args.output, file=sys.stderr)
+    elif args.command == "sync":
+        run_sync(args)
+
+
+def run_sync(args):
+    from .harness import FORMAT_VERSION, environment, format_time
+
+    server = None
+    if args.session:
+        server = ReplayServer(Session.load(args.session), faults=faults_from_args(args))
+        server.start()
+    try:
+        runs = []
+        for _ in range(args.repeat):
+            try:
+                run = sync_wallet(server.address() if server else args.server, wallet_path=args.wallet,
+                                  restore=args.restore, timeout=args.timeout)
+            except TimeoutError as e:
+                if server:
+                    # the requests missing from the session are the usual cause
+                    json.dump(server.get_stats(), sys.stderr, indent=2)
+                    print(file=sys.stderr)
+                sys.exit(str(e))
+            print("sync {} (connect {}), {} transactions".format(
+                format_time(run["sync"]), format_time(run["connect"]), run["transactions"]), file=sys.stderr)
+            runs.append(run)
+    finally:
+        if server:
+            server.stop()
+    times = sorted(run["sync"] for run in runs)
+    result = {
+        "group": "network",
+        "repeat": len(runs),
+        "ops": 1,
+        "min": times[0],
+        "median": times[len(times) // 2],
+        "mean": sum(times) / len(times),
+        "ops_per_sec": 1 / times[0],
+        "connect": min(run["connect"] for run in runs),
+        "transactions": runs[0]["transactions"],
+        "verified": runs[0]["verified"],
+        # not measured for the sync
+        "peak_memory": None,
+        "retained_memory": None,
+    }
+    if server:
+        result["server"] = server.get_stats()
+    output = {
+        "format": FORMAT_VERSION,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "scale": 1,
+        "environment": environment(),
+        "results": {"wallet_sync": result},
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,560 @@
+"""Deterministic synthetic wallets, transactions and headers.
+
+The transactions are well formed and consistent with each other: every
+spent coin exists, amounts add up minus a fee, coinbase coins are only
+spent once mature, SLP tokens are only moved by SLP transactions. Their
+signatures are random bytes though, since nothing in the wallet checks
+them.
+
+The transactions are added to a real wallet with add_transaction(), so its
+txi, txo, pruned_txo, addr_history and SLP data are what the synchronizer
+would have produced. They are mined in synthetic blocks, ordered as in
+CTOR blocks, and the wallet gets the matching verified_tx3 and merkle
+proofs. The headers of these blocks follow the ASERT schedule from the
+anchor and chain together, but have no proof of work.
+
+See walletgen.py for the command line front end.
+"""
+import json
+import random
+
+from electroncash import blockchain, keystore, networks
+from electroncash.address import Address, Script
+from electroncash.bitcoin import TYPE_ADDRESS, Hash, hash_decode, hash_encode
+from electroncash.simple_config import SimpleConfig
+from electroncash.slp.slp import Build as SlpBuild
+from electroncash.storage import WalletStorage
+from electroncash.transaction import Transaction
+from electroncash.wallet import Wallet
+
+# BIP39 test vector, so that the wallets have private keys for signing
+SEED = ("abandon abandon abandon abandon abandon abandon abandon abandon "
+        "abandon abandon abandon about")
+
+START_HEIGHT = 700_000
+FEE = 500
+DUST = 546
+COINBASE_MATURITY = 100
+COINBASE_VALUE = 625_000_000
+
+# An address that is not in the wallets
+PAYEE = Address.from_pubkey("02" + "11" * 32)
+
+
+class Shape:
+    """Size and contents of a synthetic wallet.
+
+    addresses and change_addresses are the numbers of addresses that may
+    get a history; the wallet has gap_limit more unused receiving addresses,
+    and 20 more unused change addresses, so that synchronizing it would not
+    create any. The ratios are the probabilities of each kind of
+    transaction, the rest being payments to and from the wallet."""
+
+    def __init__(self, *, addresses=200, change_addresses=None, txs=2000,
+                 multisig=None, spend_ratio=0.3, coinbase_ratio=0.0,
+                 slp_ratio=0.0, slp_tokens=10, frozen_coin_ratio=0.0,
+                 frozen_addresses=0, unconfirmed=0, gap_limit=20,
+                 start_height=START_HEIGHT):
+        self.addresses = addresses
+        self.change_addresses = (max(1, addresses // 10) if change_addresses is None
+                                 else change_addresses)
+        self.txs = txs
+        # None, or a (m, n) tuple
+        self.multisig = multisig
+        self.spend_ratio = spend_ratio
+        self.coinbase_ratio = coinbase_ratio
+        self.slp_ratio = slp_ratio
+        self.slp_tokens = slp_tokens
+        self.frozen_coin_ratio = frozen_coin_ratio
+        self.frozen_addresses = frozen_addresses
+        self.unconfirmed = unconfirmed
+        self.gap_limit = gap_limit
+        self.start_height = start_height
+        if not 0 <= unconfirmed <= txs:
+            raise ValueError("unconfirmed must be between 0 and txs")
+        if multisig is not None and not 1 <= multisig[0] <= multisig[1] <= 15:
+            raise ValueError("bad multisig type {}of{}".format(*multisig))
+
+    @classmethod
+    def production(cls, **kwargs):
+        """The shape of a large wallet seen in production."""
+        shape = dict(addresses=50_000, change_addresses=5_000, txs=100_000,
+                     coinbase_ratio=0.01, slp_ratio=0.05, slp_tokens=20,
+                     frozen_coin_ratio=0.02, frozen_addresses=10, unconfirmed=20)
+        shape.update(kwargs)
+        return cls(**shape)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def make_config(path):
+    return SimpleConfig(
+        {"data_path": path, "fee_per_kb": 1000},
+        read_user_config_function=lambda path: {},
+    )
+
+
+def fake_signature(rng):
+    # 64 byte Schnorr signature + SIGHASH_ALL|SIGHASH_FORKID
+    return rng.getrandbits(512).to_bytes(64, "big").hex() + "41"
+
+
+def random_pubkey(rng):
+    return "02" + rng.getrandbits(256).to_bytes(32, "big").hex()
+
+
+def random_txid(rng):
+    return rng.getrandbits(256).to_bytes(32, "big").hex()
+
+
+def push_hex(data_hex):
+    return Script.push_data(bytes.fromhex(data_hex)).hex()
+
+
+class Spender:
+    """Builds fake-signed inputs spending the coins of an address."""
+
+    def __init__(self, pubkeys, redeem_script=None, m=1):
+        self.pubkeys = pubkeys
+        self.redeem_script = redeem_script
+        self.m = m
+
+    def txin(self, prevout_hash, prevout_n, rng):
+        if self.redeem_script is None:
+            script_sig = push_hex(fake_signature(rng)) + push_hex(self.pubkeys[0])
+            txin_type = "p2pkh"
+        else:
+            script_sig = "00" + "".join(push_hex(fake_signature(rng)) for _ in range(self.m))
+            script_sig += push_hex(self.redeem_script.hex())
+            txin_type = "p2sh"
+        return {
+            "type": txin_type,
+            "prevout_hash": prevout_hash,
+            "prevout_n": prevout_n,
+            "sequence": 0xFFFFFFFE,
+            "scriptSig": script_sig,
+        }
+
+
+def foreign_txin(rng):
+    return Spender([random_pubkey(rng)]).txin(random_txid(rng), rng.randrange(4), rng)
+
+
+def coinbase_txin(height, rng):
+    # BIP34 height, then some extra nonce
+    script_sig = push_hex(height.to_bytes(4, "little").hex()) + push_hex(random_txid(rng)[:16])
+    return {
+        "type": "coinbase",
+        "prevout_hash": "00" * 32,
+        "prevout_n": 0xFFFFFFFF,
+        "sequence": 0xFFFFFFFF,
+        "scriptSig": script_sig,
+    }
+
+
+def make_tx(txins, outputs):
+    """txins: input dicts, outputs: (Address, value) or (type, script
+    output, value) tuples. Returns a complete Transaction."""
+    txouts = [out if len(out) == 3 else (TYPE_ADDRESS,) + tuple(out) for out in outputs]
+    return Transaction(Transaction.from_io(txins, txouts).serialize())
+
+
+class Coin:
+    __slots__ = ("prevout_hash", "prevout_n", "value", "address", "token")
+
+    def __init__(self, prevout_hash, prevout_n, value, address, token=None):
+        self.prevout_hash = prevout_hash
+        self.prevout_n = prevout_n
+        self.value = value
+        self.address = address
+        # (token_id, quantity) of SLP coins
+        self.token = token
+
+
+def pop_random(rng, items):
+    i = rng.randrange(len(items))
+    items[i], items[-1] = items[-1], items[i]
+    return items.pop()
+
+
+class HistoryGenerator:
+    """Generates a history of transactions funding and spending the given
+    wallet addresses.
+
+    spenders maps the receiving addresses to their Spender, change_spenders
+    does the same for the change addresses."""
+
+    def __init__(self, spenders, change_spenders=None, *, shape=None, seed=0):
+        self.shape = shape or Shape()
+        self.rng = random.Random(seed)
+        self.spenders = dict(spenders)
+        self.spenders.update(change_spenders or {})
+        self.addresses = list(spenders)
+        self.change = list(change_spenders or spenders)
+        self.height = self.shape.start_height
+        self.new_block = False
+        self.coins = []
+        # coinbase coins, by the height at which they mature
+        self.immature = {}
+        self.token_coins = []
+        self.tokens = []
+        self.coinbases = set()
+        self.slp_txs = set()
+
+    def foreign_address(self):
+        return Address.from_pubkey(random_pubkey(self.rng))
+
+    def spend(self, coins):
+        return [self.spenders[coin.address].txin(coin.prevout_hash, coin.prevout_n, self.rng)
+                for coin in coins]
+
+    def funding_tx(self):
+        rng = self.rng
+        outputs = [(rng.choice(self.addresses), rng.randrange(10_000, 10**8))
+                   for _ in range(rng.randint(1, 2))]
+        outputs.append((self.foreign_address(), rng.randrange(10_000, 10**8)))
+        rng.shuffle(outputs)
+        return make_tx([foreign_txin(rng)], outputs)
+
+    def spending_tx(self):
+        rng = self.rng
+        spent = [pop_random(rng, self.coins) for _ in range(min(len(self.coins), rng.randint(1, 3)))]
+        total = sum(coin.value for coin in spent) - FEE
+        pay = rng.randrange(total // 4, total // 2 + 1)
+        outputs = [(self.foreign_address(), pay), (rng.choice(self.change), total - pay)]
+        rng.shuffle(outputs)
+        return make_tx(self.spend(spent), outputs)
+
+    def coinbase_tx(self):
+        rng = self.rng
+        # a coinbase is the first transaction of its block
+        self.height += 1
+        self.new_block = True
+        outputs = [(rng.choice(self.addresses), COINBASE_VALUE - rng.randrange(10**6))]
+        return make_tx([coinbase_txin(self.height, rng)], outputs)
+
+    def slp_genesis_tx(self):
+        rng = self.rng
+        n = len(self.tokens)
+        op_return = SlpBuild.GenesisOpReturnOutput_V1(
+            "TK%d" % n, "Token %d" % n, "", "", rng.randint(0, 8), 2, rng.randrange(1, 10**12)
+        )
+        outputs = [op_return, (rng.choice(self.addresses), DUST), (rng.choice(self.addresses), DUST),
+                   (self.foreign_address(), rng.randrange(10_000, 10**7))]
+        return make_tx([foreign_txin(rng)], outputs)
+
+    def slp_send_tx(self):
+        rng = self.rng
+        token_coin = pop_random(rng, self.token_coins)
+        token_id, qty = token_coin.token
+        spent = [token_coin]
+        if self.coins:
+            spent.append(pop_random(rng, self.coins))
+        sent = rng.randrange(1, qty) if qty > 1 else qty
+        quantities = [sent, qty - sent] if qty > sent else [sent]
+        outputs = [SlpBuild.SendOpReturnOutput_V1(token_id, quantities),
+                   (self.foreign_address(), DUST)]
+        if len(quantities) > 1:
+            outputs.append((rng.choice(self.change), DUST))
+        change = sum(coin.value for coin in spent) - DUST * (len(outputs) - 1) - FEE
+        if change > DUST:
+            outputs.append((rng.choice(self.change), change))
+        return make_tx(self.spend(spent), outputs), token_id, quantities
+
+    def slp_tx(self):
+        """Returns a SLP transaction and, for sends, the token id and output
+        quantities."""
+        if len(self.tokens) < self.shape.slp_tokens and (not self.token_coins or self.rng.random() < 0.3):
+            return self.slp_genesis_tx(), None, None
+        return self.slp_send_tx()
+
+    def can_make_slp_tx(self):
+        return len(self.tokens) < self.shape.slp_tokens or bool(self.token_coins)
+
+    def add_coins(self, tx_hash, tx, token_id=None, quantities=None):
+        is_coinbase = tx_hash in self.coinbases
+        outputs = tx.outputs()
+        for n, (_, addr, value) in enumerate(outputs):
+            if addr not in self.spenders:
+                continue
+            if token_id is None and tx_hash in self.slp_txs:
+                # genesis: the token is in output 1, the mint baton in 2
+                # which the generator never uses
+                if n == 1:
+                    qty = outputs[0][1].message.initial_token_mint_quantity
+                    self.token_coins.append(Coin(tx_hash, n, value, addr, (tx_hash, qty)))
+                continue
+            if token_id is not None and 1 <= n <= len(quantities):
+                self.token_coins.append(Coin(tx_hash, n, value, addr, (token_id, quantities[n - 1])))
+                continue
+            coin = Coin(tx_hash, n, value, addr)
+            if is_coinbase:
+                self.immature.setdefault(self.height + COINBASE_MATURITY, []).append(coin)
+            else:
+                self.coins.append(coin)
+
+    def mature_coins(self):
+        for height in [h for h in self.immature if h <= self.height]:
+            self.coins.extend(self.immature.pop(height))
+
+    def next_tx(self, allow_coinbase=True):
+        rng = self.rng
+        shape = self.shape
+        token_id = quantities = None
+        r = rng.random()
+        if allow_coinbase and r < shape.coinbase_ratio:
+            tx = self.coinbase_tx()
+            self.coinbases.add(tx.txid())
+        elif r < shape.coinbase_ratio + shape.slp_ratio and self.can_make_slp_tx():
+            tx, token_id, quantities = self.slp_tx()
+            self.slp_txs.add(tx.txid())
+            if token_id is None:
+                self.tokens.append(tx.txid())
+        elif len(self.coins) > 3 and rng.random() < shape.spend_ratio:
+            tx = self.spending_tx()
+        else:
+            tx = self.funding_tx()
+        tx_hash = tx.txid()
+        self.add_coins(tx_hash, tx, token_id, quantities)
+        return tx_hash, tx
+
+    def generate(self, n_txs, unconfirmed=0):
+        """Returns n_txs (tx_hash, Transaction, height) tuples, in block
+        order, a few transactions per block. The last unconfirmed ones are
+        in the mempool, with height 0."""
+        result = []
+        for i in range(n_txs):
+            confirmed = i < n_txs - unconfirmed
+            tx_hash, tx = self.next_tx(allow_coinbase=confirmed)
+            result.append((tx_hash, tx, self.height if confirmed else 0))
+            if self.new_block:
+                self.new_block = False
+            elif self.rng.random() < 0.3:
+                self.height += self.rng.choice((1, 1, 1, 2, 5))
+            self.mature_coins()
+        return result
+
+
+# ------------------------------------------------------------------------
+# Blocks and headers
+
+
+def merkle_branches(txids):
+    """Returns the merkle root of the block made of txids, and the branch
+    of each of them, as in the blockchain.transaction.get_merkle responses."""
+    level = [hash_decode(txid) for txid in txids]
+    branches = [[] for _ in txids]
+    positions = list(range(len(txids)))
+    while len(level) > 1:
+        if len(level) & 1:
+            level.append(level[-1])
+        for i, pos in enumerate(positions):
+            branches[i].append(hash_encode(level[pos ^ 1]))
+            positions[i] = pos >> 1
+        level = [Hash(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+    return hash_encode(level[0]), branches
+
+
+def ideal_timestamp(height):
+    """Timestamp of the block at height in a chain that follows the ASERT
+    schedule exactly, so that all blocks have the anchor bits."""
+    anchor = networks.net.asert_daa.anchor
+    return anchor.prev_time + 600 * (height - anchor.height + 1)
+
+
+def synthetic_headers(first_height, count, merkle_roots=None, rng=None):
+    """Chained headers, one block every 600 seconds. merkle_roots maps
+    heights to the merkle root of their block, the other blocks get a random
+    one."""
+    rng = rng or random.Random(first_height)
+    merkle_roots = merkle_roots or {}
+    anchor = networks.net.asert_daa.anchor
+    headers = {}
+    prev_hash = "00" * 32
+    for height in range(first_height, first_height + count):
+        header = {
+            "version": 0x20000000,
+            "prev_block_hash": prev_hash,
+            "merkle_root": merkle_roots.get(height) or random_txid(rng),
+            "timestamp": ideal_timestamp(height),
+            "bits": anchor.bits,
+            "nonce": rng.getrandbits(32),
+            "block_height": height,
+        }
+        headers[height] = header
+        prev_hash = blockchain.hash_header(header)
+    return headers
+
+
+def mine(txs, coinbases=(), seed=0):
+    """Puts the confirmed transactions of txs in CTOR ordered blocks,
+    together with foreign transactions.
+
+    Returns the headers by height, from the first to the last block, and the
+    (height, pos, branch) proof of each confirmed transaction."""
+    rng = random.Random(seed)
+    blocks = {}
+    for tx_hash, tx, height in txs:
+        if height > 0:
+            blocks.setdefault(height, []).append(tx_hash)
+    proofs = {}
+    merkle_roots = {}
+    for height, tx_hashes in blocks.items():
+        block = [tx_hash for tx_hash in tx_hashes if tx_hash not in coinbases]
+        block.extend(random_txid(rng) for _ in range(rng.randint(0, 20)))
+        block.sort()
+        coinbase = [tx_hash for tx_hash in tx_hashes if tx_hash in coinbases] or [random_txid(rng)]
+        block = coinbase + block
+        root, branches = merkle_branches(block)
+        merkle_roots[height] = root
+        ours = set(tx_hashes)
+        for pos, (tx_hash, branch) in enumerate(zip(block, branches)):
+            if tx_hash in ours:
+                proofs[tx_hash] = (height, pos, branch)
+    if not blocks:
+        return {}, proofs
+    first, last = min(blocks), max(blocks)
+    headers = synthetic_headers(first, last - first + 1, merkle_roots, rng)
+    return headers, proofs
+
+
+class SyntheticBlockchain(blockchain.Blockchain):
+    """A Blockchain reading its headers from a dict instead of a file."""
+
+    def __init__(self, headers):
+        self.headers_by_height = headers
+        self._cached_asert_anchor = None
+
+    def read_header(self, height, chunk=None):
+        if chunk is not None and chunk.contains_height(height):
+            return chunk.get_header_at_height(height)
+        return self.headers_by_height.get(height)
+
+
+def save_headers(path, headers):
+    """Writes the headers as a JSON object of height: serialized header."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({str(h): blockchain.serialize_header(header) for h, header in sorted(headers.items())}, f)
+
+
+def load_headers(path):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return {int(h): blockchain.deserialize_header(bytes.fromhex(raw), int(h)) for h, raw in data.items()}
+
+
+# ------------------------------------------------------------------------
+# Wallets
+
+
+def new_wallet(path, shape):
+    storage = WalletStorage(path)
+    if storage.file_exists():
+        raise FileExistsError(path)
+    if shape.multisig:
+        m, n = shape.multisig
+        storage.put("wallet_type", "%dof%d" % (m, n))
+        for i in range(n):
+            storage.put("x%d/" % (i + 1), keystore.from_seed(SEED, str(i), seed_type="bip39").dump())
+    else:
+        k = keystore.from_seed(SEED, "", seed_type="bip39")
+        storage.put("keystore", k.dump())
+        storage.put("wallet_type", "standard")
+        storage.put("seed_type", k.seed_type)
+    storage.put("gap_limit", shape.gap_limit)
+    return Wallet(storage)
+
+
+def derive_addresses(wallet, for_change, count):
+    """Creates count addresses, as create_new_address() does, and returns
+    the Spender of each."""
+    spenders = {}
+    addr_list = wallet.change_addresses if for_change else wallet.receiving_addresses
+    multisig = hasattr(wallet, "m")
+    with wallet.lock:
+        for _ in range(count):
+            pubkeys = wallet.derive_pubkeys(for_change, len(addr_list))
+            address = wallet.pubkeys_to_address(pubkeys)
+            addr_list.append(address)
+            wallet.add_address(address)
+            if multisig:
+                redeem_script = wallet.pubkeys_to_redeem_script([bytes.fromhex(k) for k in pubkeys])
+                spenders[address] = Spender(pubkeys, redeem_script, wallet.m)
+            else:
+                spenders[address] = Spender([pubkeys])
+    return spenders
+
+
+def add_history(wallet, txs, proofs, slp_txs=()):
+    """Adds the transactions to the wallet, with the history and verified
+    info the synchronizer and verifier would have given it."""
+    with wallet.lock:
+        for tx_hash, tx, height in txs:
+            wallet.add_transaction(tx_hash, tx)
+            addrs = set(wallet.txi.get(tx_hash, {})) | set(wallet.txo.get(tx_hash, {}))
+            for addr in addrs:
+                wallet._history.setdefault(addr, []).append((tx_hash, height))
+                wallet.tx_addr_hist[tx_hash].add(addr)
+            proof = proofs.get(tx_hash)
+            if proof:
+                height, pos, branch = proof
+                wallet.verified_tx[tx_hash] = (height, ideal_timestamp(height), pos)
+                wallet.add_spv_proof(tx_hash, height, pos, branch)
+            else:
+                wallet.unverified_tx[tx_hash] = height
+        # The generator only makes valid SLP transactions
+        for tx_hash in slp_txs:
+            if tx_hash in wallet.slp.validity:
+                wallet.slp.validity[tx_hash] = 1
+        wallet._addr_bal_cache.clear()
+        wallet._addr_state.invalidate_all()
+
+
+class SyntheticWallet:
+    """A wallet of the given shape, saved at path.
+
+    The keyword arguments other than seed are passed to Shape."""
+
+    def __init__(self, path, *, seed=0, shape=None, n_addresses=None, n_txs=None, **kwargs):
+        # n_addresses and n_txs are shortcuts for the most common parameters
+        if n_addresses is not None:
+            kwargs["addresses"] = n_addresses
+        if n_txs is not None:
+            kwargs["txs"] = n_txs
+        self.path = path
+        self.shape = shape = shape or Shape(**kwargs)
+        self.config = make_config(path + "-data")
+        self.wallet = wallet = new_wallet(path, shape)
+        spenders = derive_addresses(wallet, False, shape.addresses)
+        change_spenders = derive_addresses(wallet, True, shape.change_addresses)
+        derive_addresses(wallet, False, shape.gap_limit)
+        derive_addresses(wallet, True, wallet.gap_limit_for_change)
+        wallet.save_addresses()
+
+        self.generator = HistoryGenerator(spenders, change_spenders, shape=shape, seed=seed)
+        self.txs = self.generator.generate(shape.txs, shape.unconfirmed)
+        self.headers, proofs = mine(self.txs, self.generator.coinbases, seed)
+        add_history(wallet, self.txs, proofs, self.generator.slp_txs)
+        self.freeze(random.Random(seed))
+
+        wallet.save_transactions()
+        wallet.save_verified_tx()
+        wallet.storage.write()
+
+    def freeze(self, rng):
+        wallet = self.wallet
+        shape = self.shape
+        if shape.frozen_coin_ratio:
+            utxos = wallet.get_utxos(exclude_frozen=False)
+            frozen = [utxo for utxo in utxos if rng.random() < shape.frozen_coin_ratio]
+            wallet.set_frozen_coin_state(frozen, True)
+        if shape.frozen_addresses:
+            used = [addr for addr in wallet.get_addresses() if addr in wallet._history]
+            wallet.set_frozen_state(rng.sample(used, min(len(used), shape.frozen_addresses)), True)
+
+    def open(self):
+        return Wallet(WalletStorage(self.path))
+
+    def blockchain(self):
+        return SyntheticBlockchain(self.headers)
@@ -0,0 +1,82 @@
+"""Generates a large synthetic wallet file, for load and stress tests.
+
+    python -m benchmarks.walletgen OUTPUT [--production] [--txs N] ...
+
+The wallet is deterministic: the same options and --seed always give the
+same file. Its keys come from the BIP39 "abandon ... about" test mnemonic
+(with the passphrases "0", "1", ... for the cosigners of multisig
+wallets), so it can sign, but it must never receive real coins. See
+synthetic.py for what the history contains.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from .synthetic import Shape, SyntheticWallet, save_headers
+
+
+def multisig_type(text):
+    try:
+        m, n = (int(x) for x in text.lower().split("of"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected MofN, e.g. 2of3")
+    return m, n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.walletgen", description=__doc__.split("\n")[0])
+    parser.add_argument("output", help="path of the wallet file to create")
+    parser.add_argument("--production", action="store_true",
+                        help="start from the shape of a large production wallet (%s)"
+                        % ", ".join("%s=%s" % kv for kv in Shape.production().to_dict().items()
+                                    if kv[0] in ("addresses", "txs")))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--addresses", type=int, help="receiving addresses with a history")
+    parser.add_argument("--change-addresses", type=int, help="change addresses with a history")
+    parser.add_argument("--txs", type=int, help="number of transactions")
+    parser.add_argument("--multisig", type=multisig_type, metavar="MofN", help="make a multisig wallet")
+    parser.add_argument("--spend-ratio", type=float)
+    parser.add_argument("--coinbase-ratio", type=float)
+    parser.add_argument("--slp-ratio", type=float)
+    parser.add_argument("--slp-tokens", type=int, help="number of SLP tokens created")
+    parser.add_argument("--frozen-coin-ratio", type=float)
+    parser.add_argument("--frozen-addresses", type=int)
+    parser.add_argument("--unconfirmed", type=int, help="number of mempool transactions")
+    parser.add_argument("--gap-limit", type=int)
+    parser.add_argument("--headers", metavar="FILE",
+                        help="also save the headers of the blocks of the history, as JSON")
+    args = parser.parse_args(argv)
+
+    options = {name: value for name, value in vars(args).items()
+               if value is not None and name not in ("output", "production", "seed", "headers")}
+    shape = Shape.production(**options) if args.production else Shape(**options)
+    if os.path.exists(args.output):
+        parser.error("{} already exists".format(args.output))
+
+    t0 = time.time()
+    synthetic = SyntheticWallet(args.output, seed=args.seed, shape=shape)
+    if args.headers:
+        save_headers(args.headers, synthetic.headers)
+    wallet = synthetic.wallet
+    summary = {
+        "path": args.output,
+        "seed": args.seed,
+        "shape": shape.to_dict(),
+        "transactions": len(wallet.transactions),
+        "addresses": len(wallet.get_addresses()),
+        "balance": wallet.get_balance(),
+        "utxos": len(wallet.get_utxos(exclude_frozen=False, exclude_slp=False)),
+        "frozen_coins": len(wallet.frozen_coins),
+        "slp_tokens": len(synthetic.generator.tokens),
+        "blocks": len(synthetic.headers),
+        "size": os.path.getsize(args.output),
+        "seconds": round(time.time() - t0, 1),
+    }
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
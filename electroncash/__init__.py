@@ -1,19 +1,48 @@
+import importlib
 import logging
 
 from .version import PACKAGE_VERSION
-from .util import format_satoshis, print_msg, print_error, set_verbosity
-from .wallet import Synchronizer, Wallet
-from .storage import WalletStorage
-from .network import Network, pick_random_server
-from .interface import Connection, Interface
-from .simple_config import SimpleConfig, get_config, set_config
-from . import bitcoin
-from . import transaction
-from . import daemon
-from .transaction import Transaction
-from .plugins import BasePlugin
-from .commands import Commands, known_commands
-from . import address
-from . import cashacct  # has a side-effect: registers itself with ScriptOut protocol system
 
 root_logger = logging.getLogger(__name__)
+
+# The names exported by the package, and the submodule defining each of them.
+# The submodules are only imported when one of their names is first accessed
+# (PEP 562), so that "import electroncash" and the command line tools that
+# don't need a wallet or a network don't pay for loading the whole stack.
+_LAZY_ATTRIBUTES = {
+    'format_satoshis': 'util',
+    'print_msg': 'util',
+    'print_error': 'util',
+    'set_verbosity': 'util',
+    'Synchronizer': 'wallet',
+    'Wallet': 'wallet',
+    'WalletStorage': 'storage',
+    'Network': 'network',
+    'pick_random_server': 'network',
+    'Connection': 'interface',
+    'Interface': 'interface',
+    'SimpleConfig': 'simple_config',
+    'get_config': 'simple_config',
+    'set_config': 'simple_config',
+    'Transaction': 'transaction',
+    'BasePlugin': 'plugins',
+    'Commands': 'commands',
+    'known_commands': 'commands',
+}
+
+__all__ = ['PACKAGE_VERSION', 'root_logger', *_LAZY_ATTRIBUTES]
+
+
+def __getattr__(name):
+    try:
+        module_name = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    value = getattr(importlib.import_module('.' + module_name, __name__), name)
+    # Cache it, so that __getattr__ is only called once per name
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
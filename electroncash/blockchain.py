@@ -22,13 +22,16 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import mmap
 import os
 import threading
 
+from collections import OrderedDict, deque
 from typing import Optional
 
 from . import asert_daa
 from . import networks
+from . import tracing
 from . import util
 
 from . import bitcoin
@@ -84,6 +87,10 @@ MAX_TARGET = bits_to_target(MAX_BITS)
 NULL_HEADER = bytes([0]) * HEADER_SIZE
 NULL_HASH_BYTES = bytes([0]) * 32
 NULL_HASH_HEX = NULL_HASH_BYTES.hex()
+# Number of deserialized headers (and header hashes) kept in memory per
+# Blockchain. This covers a couple of chunks, which is more than what the
+# difficulty adjustment algorithms need to look back.
+HEADER_CACHE_SIZE = 8192
 
 def serialize_header(res):
     s = bitcoin.int_to_hex(res.get('version'), 4) \
@@ -197,9 +204,44 @@ class HeaderChunk:
     def get_header_at_index(self, index):
         return self.headers[index]
 
+class HeaderCache:
+    ''' A small LRU mapping of height -> value. Not thread-safe, the owning
+    Blockchain protects it with its lock. '''
+
+    def __init__(self, maxlen=HEADER_CACHE_SIZE):
+        self.maxlen = maxlen
+        self.d = OrderedDict()
+
+    def get(self, height):
+        value = self.d.get(height)
+        if value is not None:
+            self.d.move_to_end(height)
+        return value
+
+    def put(self, height, value):
+        self.d[height] = value
+        self.d.move_to_end(height)
+        if len(self.d) > self.maxlen:
+            self.d.popitem(last=False)
+
+    def invalidate(self, from_height=None):
+        ''' Forget all heights >= from_height, or everything if from_height
+        is None. '''
+        if from_height is None:
+            self.d.clear()
+            return
+        for height in [h for h in self.d if h >= from_height]:
+            del self.d[height]
+
+
 class Blockchain(util.PrintError):
     """
     Manages blockchain headers and their verification
+
+    The headers file is memory-mapped for reading, and recently used
+    deserialized headers and header hashes are kept in LRU caches.  All
+    writes go through write(), which unmaps the file first and invalidates
+    the affected cache entries.
     """
 
     def __init__(self, config, base_height, parent_base_height):
@@ -208,6 +250,10 @@ class Blockchain(util.PrintError):
         self.base_height = base_height
         self.parent_base_height = parent_base_height
 
+        self._mmap = None
+        self._header_cache = HeaderCache()
+        self._hash_cache = HeaderCache()
+
         self.lock = threading.Lock()
         with self.lock:
             self.update_size()
@@ -255,20 +301,57 @@ class Blockchain(util.PrintError):
             return self._size
 
     def update_size(self):
+        ''' Must be called with self.lock held, after the headers file was
+        modified. '''
+        self._close_mmap()
+        self._header_cache.invalidate()
+        self._hash_cache.invalidate()
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
 
-    def verify_header(self, header, prev_header, bits=None):
-        prev_header_hash = hash_header(prev_header)
-        this_header_hash = hash_header(header)
+    def _get_mmap(self):
+        ''' Returns a read-only memory map of the headers file, or None if the
+        file is missing or empty. Must be called with self.lock held. '''
+        if self._mmap is None:
+            try:
+                with open(self.path(), 'rb') as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        return None
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+        return self._mmap
+
+    def _close_mmap(self):
+        ''' Must be called with self.lock held. '''
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def close_mmap(self):
+        ''' Release the memory map of the headers file. It is transparently
+        re-opened on the next read. Call this before modifying, renaming or
+        truncating the file outside of write(), as Windows does not allow
+        that on a mapped file. '''
+        with self.lock:
+            self._close_mmap()
+
+    def verify_header(self, header, prev_header, bits=None, *,
+                      this_header_hash=None, prev_header_hash=None):
+        ''' The hashes of the headers may be passed in if they are already
+        known, to avoid computing them again. '''
+        if prev_header_hash is None:
+            prev_header_hash = hash_header(prev_header)
+        if this_header_hash is None:
+            this_header_hash = hash_header(header)
         if prev_header_hash != header.get('prev_block_hash'):
             raise VerifyError("prev hash mismatch: %s vs %s" % (prev_header_hash, header.get('prev_block_hash')))
 
         # We do not need to check the block difficulty if the chain of linked header hashes was proven correct against our checkpoint.
         if bits is not None:
             # checkpoint BitcoinCash fork block
-            if (header.get('block_height') == networks.net.BITCOIN_CASH_FORK_BLOCK_HEIGHT and hash_header(header) != networks.net.BITCOIN_CASH_FORK_BLOCK_HASH):
-                err_str = "block at height %i is not cash chain fork block. hash %s" % (header.get('block_height'), hash_header(header))
+            if (header.get('block_height') == networks.net.BITCOIN_CASH_FORK_BLOCK_HEIGHT and this_header_hash != networks.net.BITCOIN_CASH_FORK_BLOCK_HASH):
+                err_str = "block at height %i is not cash chain fork block. hash %s" % (header.get('block_height'), this_header_hash)
                 raise VerifyError(err_str)
             if bits != header.get('bits'):
                 raise VerifyError("bits mismatch: %s vs %s" % (bits, header.get('bits')))
@@ -276,27 +359,83 @@ class Blockchain(util.PrintError):
             if int('0x' + this_header_hash, 16) > target:
                 raise VerifyError("insufficient proof of work: %s vs target %s" % (int('0x' + this_header_hash, 16), target))
 
-    def verify_chunk(self, chunk_base_height, chunk_data):
-        chunk = HeaderChunk(chunk_base_height, chunk_data)
+    @tracing.traced('blockchain.verify_chunk')
+    def verify_chunk(self, chunk_base_height, chunk_data, chunk=None):
+        if chunk is None:
+            chunk = HeaderChunk(chunk_base_height, chunk_data)
 
         prev_header = None
         if chunk_base_height != 0:
             prev_header = self.read_header(chunk_base_height - 1)
+        prev_header_hash = hash_header(prev_header)
 
         header_count = len(chunk_data) // HEADER_SIZE
-        for i in range(header_count):
+        # Hash every header exactly once, straight from the raw chunk data.
+        header_hashes = [
+            bitcoin.hash_encode(bitcoin.Hash(chunk_data[i * HEADER_SIZE : (i + 1) * HEADER_SIZE]))
+            for i in range(header_count)
+        ]
+        for i, bits in enumerate(self.get_chunk_bits(chunk)):
             header = chunk.get_header_at_index(i)
             # Check the chain of hashes and the difficulty.
-            bits = self.get_bits(header, chunk)
-            self.verify_header(header, prev_header, bits)
+            self.verify_header(header, prev_header, bits,
+                               this_header_hash=header_hashes[i],
+                               prev_header_hash=prev_header_hash)
             prev_header = header
+            prev_header_hash = header_hashes[i]
+
+    def get_chunk_bits(self, chunk):
+        ''' Generate the required bits for every header of the chunk, in
+        order. This gives the same result as calling get_bits() for each
+        header, but for ASERT blocks it keeps a rolling window of the last 11
+        timestamps for the median time past and resolves the ASERT anchor
+        only once, instead of reading and sorting 11 headers and looking up
+        the anchor for every single header. Headers using an older DAA go
+        through get_bits(). '''
+        base_height = chunk.base_height
+        window = deque(maxlen=11)
+        for h in range(max(0, base_height - 11), base_height):
+            prev = self.read_header(h, chunk)
+            if prev is None:
+                # Missing history (sparse pre-checkpoint data), take the slow
+                # path which will raise a meaningful error if it matters.
+                for header in chunk.headers:
+                    yield self.get_bits(header, chunk)
+                return
+            window.append(prev['timestamp'])
+
+        asert_daa = networks.net.asert_daa
+        activation_mtp = asert_daa.MTP_ACTIVATION_TIME
+        anchor = None
+        prior = self.read_header(base_height - 1, chunk) if base_height > 0 else None
+        for header in chunk.headers:
+            height = header['block_height']
+            if height == 0 or not window:
+                bits = self.get_bits(header, chunk)
+            else:
+                daa_mtp = sorted(window)[len(window) // 2]
+                if daa_mtp < activation_mtp:
+                    bits = self.get_bits(header, chunk)
+                elif networks.net.TESTNET and header['timestamp'] - prior['timestamp'] > 20*60:
+                    # testnet 20 minute rule
+                    bits = MAX_BITS
+                else:
+                    if anchor is None:
+                        anchor = self.get_asert_anchor(prior, daa_mtp, chunk)
+                        assert anchor is not None, "Failed to find ASERT anchor block for chain {!r}".format(self)
+                    bits = asert_daa.next_bits_aserti3_2d(anchor.bits,
+                                                          prior['timestamp'] - anchor.prev_time,
+                                                          height - 1 - anchor.height)
+            yield bits
+            window.append(header['timestamp'])
+            prior = header
 
     def path(self):
         d = util.get_headers_dir(self.config)
         filename = 'blockchain_headers' if self.parent_base_height is None else os.path.join('forks', 'fork_%d_%d'%(self.parent_base_height, self.base_height))
         return os.path.join(d, filename)
 
-    def save_chunk(self, base_height, chunk_data):
+    def save_chunk(self, base_height, chunk_data, chunk=None):
         chunk_offset = (base_height - self.base_height) * HEADER_SIZE
         if chunk_offset < 0:
             chunk_data = chunk_data[-chunk_offset:]
@@ -306,6 +445,12 @@ class Blockchain(util.PrintError):
         top_height = base_height + (len(chunk_data) // HEADER_SIZE) - 1
         truncate = top_height > networks.net.VERIFICATION_BLOCK_HEIGHT
         self.write(chunk_data, chunk_offset, truncate)
+        if chunk is not None:
+            # We just deserialized and verified these, keep them around.
+            with self.lock:
+                for header in chunk.headers[-HEADER_CACHE_SIZE:]:
+                    if header['block_height'] >= self.base_height:
+                        self._header_cache.put(header['block_height'], dict(header))
         self.swap_with_parent()
 
     def swap_with_parent(self):
@@ -318,6 +463,8 @@ class Blockchain(util.PrintError):
         parent_base_height = self.parent_base_height
         base_height = self.base_height
         parent = self.parent()
+        for b in blockchains.values():
+            b.close_mmap()
         with open(self.path(), 'rb') as f:
             my_data = f.read()
         with open(parent.path(), 'rb') as f:
@@ -332,10 +479,16 @@ class Blockchain(util.PrintError):
         self.parent_base_height = parent.parent_base_height; parent.parent_base_height = parent_base_height
         self.base_height = parent.base_height; parent.base_height = base_height
         self._size = parent._size; parent._size = parent_branch_size
+        # the height ranges of both branches changed
+        for b in (self, parent):
+            with b.lock:
+                b._header_cache.invalidate()
+                b._hash_cache.invalidate()
         # move files
         for b in blockchains.values():
             if b in [self, parent]: continue
             if b.old_path != b.path():
+                b.close_mmap()
                 self.print_error("renaming", b.old_path, b.path())
                 os.rename(b.old_path, b.path())
         # update pointers
@@ -345,6 +498,7 @@ class Blockchain(util.PrintError):
     def write(self, data, offset, truncate=True):
         filename = self.path()
         with self.lock:
+            self._close_mmap()
             with open(filename, 'rb+') as f:
                 if truncate and offset != self._size*HEADER_SIZE:
                     f.seek(offset)
@@ -353,7 +507,11 @@ class Blockchain(util.PrintError):
                 f.write(data)
                 f.flush()
                 os.fsync(f.fileno())
-            self.update_size()
+            # Only the headers from the write offset upwards changed.
+            first_height = self.base_height + offset // HEADER_SIZE
+            self._header_cache.invalidate(first_height)
+            self._hash_cache.invalidate(first_height)
+            self._size = os.path.getsize(filename) // HEADER_SIZE
 
     def save_header(self, header):
         delta = header.get('block_height') - self.base_height
@@ -376,22 +534,38 @@ class Blockchain(util.PrintError):
         if height > self.height():
             return
         delta = height - self.base_height
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
-                f.seek(delta * HEADER_SIZE)
-                h = f.read(HEADER_SIZE)
-            # Is it a pre-checkpoint header that has never been requested?
-            if h == NULL_HEADER:
-                return None
-            return deserialize_header(h, height)
+        with self.lock:
+            header = self._header_cache.get(height)
+            if header is None:
+                m = self._get_mmap()
+                if m is None:
+                    return None
+                h = m[delta * HEADER_SIZE : (delta + 1) * HEADER_SIZE]
+                # Is it a pre-checkpoint header that has never been requested?
+                if len(h) != HEADER_SIZE or h == NULL_HEADER:
+                    return None
+                header = deserialize_header(h, height)
+                self._header_cache.put(height, header)
+        # callers may modify the returned dict
+        return dict(header)
 
     def get_hash(self, height):
         if height == -1:
             return NULL_HASH_HEX
         elif height == 0:
             return networks.net.GENESIS
-        return hash_header(self.read_header(height))
+        if 0 <= height < self.base_height:
+            return self.parent().get_hash(height)
+        with self.lock:
+            header_hash = self._hash_cache.get(height)
+        if header_hash is not None:
+            return header_hash
+        header = self.read_header(height)
+        header_hash = hash_header(header)
+        if header is not None:
+            with self.lock:
+                self._hash_cache.put(height, header_hash)
+        return header_hash
 
     # Not used.
     def BIP9(self, height, flag):
@@ -641,8 +815,8 @@ class Blockchain(util.PrintError):
 
         try:
             if not proof_was_provided:
-                self.verify_chunk(base_height, hexdata)
-            self.save_chunk(base_height, hexdata)
+                self.verify_chunk(base_height, hexdata, chunk)
+            self.save_chunk(base_height, hexdata, chunk)
             return CHUNK_ACCEPTED
         except VerifyError as e:
             self.print_error('verify_chunk failed: {}'.format(e))
@@ -5,13 +5,13 @@
 # This file Copyright (C) 2019 Calin Culianu <calin.culianu@gmail.com>
 # License: MIT License
 #
+import sys
 import time
 import threading
 import queue
 import weakref
 import math
-from collections import defaultdict
-from .util import PrintError, print_error
+from collections import OrderedDict
 
 class ExpiringCache:
     ''' A fast cache useful for storing tens of thousands of lightweight items.
@@ -33,7 +33,13 @@ class ExpiringCache:
     amount results from format_satoshis), rather than regenerate them, as a
     performance tweak.
 
-    ExpiringCache automatically has old items expire if `maxlen' is exceeded.
+    The least recently used items are evicted by put() as soon as the cache
+    holds more than `maxlen' items, or, if `max_bytes' is not None, more than
+    `max_bytes' bytes. The size of an item is estimated once, when it is put
+    in the cache, by the `sizeof' function (by default, the shallow size of
+    the key and of the value, see approx_size). Caches of large objects, or
+    of objects of widely varying size, should give a `sizeof' function that
+    is cheap and accurate enough for their values.
 
     Or, alternatively, if `timeout' is not None (and a positive nonzero number)
     items are auto-removed if they are older than `timeout' seconds (even if
@@ -42,44 +48,106 @@ class ExpiringCache:
     below).
 
     Items are timestamped with a 'tick count' (granularity of 10 seconds per
-    tick). Their timestamp is updated each time they are accessed via `get' (so
-    that only the oldest items that are least useful are the first to expire on
-    cache overflow).
+    tick). Their timestamp is updated each time they are accessed via `get'.
+    A background thread removes the timed out items every tick.
 
-    get() and put() are fast. A background thread is used to safely
-    expire items when the cache overflows (so that get and put never stall
-    to manage the cache's size and/or to flush old items).  This background
-    thread runs every 10 seconds -- so caches may temporarily overflow past
-    their maxlen for up to 10 seconds. '''
-    def __init__(self, *, maxlen=10000, name="An Unnamed Cache", timeout=None):
+    get() and put() are O(1). The cache keeps counts of hits, misses and
+    evictions, see stats(). '''
+    def __init__(self, *, maxlen=10000, name="An Unnamed Cache", timeout=None,
+                 max_bytes=None, sizeof=None):
         assert maxlen > 0
+        assert max_bytes is None or max_bytes > 0
         timeout = (isinstance(timeout, (float, int)) and timeout > 0.0 and timeout) or None
         self.timeout_ticks = timeout and math.ceil(timeout/_ExpiringCacheMgr.tick_interval)
         self.maxlen = maxlen
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or approx_size
         self.name = name
-        self.d = dict()
+        self.lock = threading.Lock()
+        # key -> [tick, size, value], least recently used first
+        self.d = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
         _ExpiringCacheMgr.add_cache(self)
     def get(self, key, default=None):
-        res = self.d.get(key)
-        if res is not None:
-            # cache hit
-            res[0] = _ExpiringCacheMgr.tick  # update tick access time for this cache hit
-            return res[1]
-        # cache miss
-        return default
+        with self.lock:
+            res = self.d.get(key)
+            if res is not None:
+                # cache hit
+                self.hits += 1
+                res[0] = _ExpiringCacheMgr.tick  # update tick access time for this cache hit
+                self.d.move_to_end(key)
+                return res[2]
+            # cache miss
+            self.misses += 1
+            return default
     def put(self, key, value):
-        self.d[key] = [_ExpiringCacheMgr.tick, value]
+        size = approx_size(key) + self.sizeof(value)
+        with self.lock:
+            old = self.d.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self.d[key] = [_ExpiringCacheMgr.tick, size, value]
+            self.nbytes += size
+            while self.d and (len(self.d) > self.maxlen
+                              or (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                self.nbytes -= self.d.popitem(last=False)[1][1]
+                self.evictions += 1
+    def pop(self, key, default=None):
+        with self.lock:
+            res = self.d.pop(key, None)
+            if res is None:
+                return default
+            self.nbytes -= res[1]
+            return res[2]
+    def clear(self):
+        with self.lock:
+            self.d.clear()
+            self.nbytes = 0
+    def expire(self, tick_cutoff):
+        ''' Removes the items last accessed before tick_cutoff. Returns the
+        number of items removed. '''
+        ct = 0
+        with self.lock:
+            # items are ordered by access time, so the expired ones are first
+            while self.d:
+                key, entry = next(iter(self.d.items()))
+                if entry[0] >= tick_cutoff:
+                    break
+                del self.d[key]
+                self.nbytes -= entry[1]
+                ct += 1
+            self.expirations += ct
+        return ct
     def size_bytes(self):
-        ''' Returns the cache's memory usage in bytes. This is done by doing a
-        deep, recursive examination of the cache contents. '''
-        return get_object_size(
-            self.d.copy()  # prevent iterating over a mutating dict.
-        )
+        ''' Returns the approximate memory usage of the cache contents in
+        bytes, as estimated when the items were put in the cache. See
+        get_object_size for an accurate (and slow) measure. '''
+        return self.nbytes
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'items': len(self.d),
+                'maxlen': self.maxlen,
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
     def copy_dict(self):
         ''' Returns a copy of the cache contents. Useful for seriliazing
         or otherwise examining the cache. The returned dict format is:
-        d[item_key] -> [tick, item_value]'''
-        return self.d.copy()
+        d[item_key] -> [tick, size, item_value]'''
+        with self.lock:
+            return dict(self.d)
     def __len__(self):
         return len(self.d)
     def __repr__(self):
@@ -89,20 +157,44 @@ class ExpiringCache:
                 if self.timeout_ticks
                 else self.timeout_ticks)
         )
-        return (f'<{__class__.__name__} "{name}" at {address}, {length} item{"s" if length != 1 else ""} (maxlen={maxlen} timeout={timeout})>')
+        return (f'<{__class__.__name__} "{name}" at {address}, {length} item{"s" if length != 1 else ""} (maxlen={maxlen} max_bytes={self.max_bytes} timeout={timeout})>')
+
+
+def approx_size(obj):
+    ''' The size of obj, and of the items of obj if it is a tuple or a list.
+    Cheap enough to be called for every item put in a cache. '''
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(map(sys.getsizeof, obj))
+    return size
 
-class _ExpiringCacheMgr(PrintError):
+
+def all_caches_stats():
+    ''' Returns the stats() of all the live caches, biggest first. '''
+    mgr = _ExpiringCacheMgr._instance
+    if not mgr:
+        return []
+    with _ExpiringCacheMgr._lock:
+        caches = tuple(mgr.caches)
+    return sorted((c.stats() for c in caches), key=lambda d: d['bytes'], reverse=True)
+
+class _ExpiringCacheMgr:
     '''Do not use this class directly. Instead just create ExpiringCache
     instances and that will handle the creation of this object automatically
     and its lifecycle.
 
     This is a singleton that manages the ExpiringCaches. It creates a thread
-    that wakes up every tick_interval seconds and expires old items from
-    overflowing extant caches.
+    that wakes up every tick_interval seconds and removes the timed out items
+    of extant caches.
 
     Note that after the last cache is gc'd the manager thread will exit and
     this singleton object also will expire and clean itself up automatically.'''
 
+    def print_error(self, *msg):
+        # util imports this module at load time, so it is imported here
+        from .util import print_error
+        print_error("[{}]".format(type(self).__name__), *msg)
+
     # This lock is used to lock _instance and self.caches.
     # NOTE: This lock *must* be a recursive lock as the gc callback function
     # may end up executing in the same thread as our add_cache() method,
@@ -110,7 +202,7 @@ class _ExpiringCacheMgr(PrintError):
     _lock = threading.RLock()
     _instance = None
     tick = 0
-    tick_interval = 10.0  # seconds; we wake up this often to update 'tick' and also to expire old items for overflowing caches
+    tick_interval = 10.0  # seconds; we wake up this often to update 'tick' and also to remove timed out items
     debug = False  # If true we print to console when caches expire and go away
 
     def __init__(self, add_iter=None):
@@ -180,82 +272,17 @@ class _ExpiringCacheMgr(PrintError):
                     pass
                 cls.tick += 1
                 for c in tuple(self.caches):  # prevent cache from dying while we iterate
-                    # 1. timeout check (off by default unless client code specified a timeout)
-                    if c.timeout_ticks and len(c.d) and 0 == (cls.tick % c.timeout_ticks):
-                        # expire timed-out items first, if any. This check only runs every timeout_ticks ticks.
+                    # timeout check (off by default unless client code specified a timeout)
+                    if c.timeout_ticks and len(c.d):
                         t0 = time.time()
-                        num = cls._remove_timed_out_items(c.d, cls.tick - c.timeout_ticks)
+                        num = c.expire(cls.tick - c.timeout_ticks)
                         tf = time.time()
                         if num:
                             self.print_error("{}: flushed {} timed-out items in {:.02f} msec".format(c.name, num, (tf-t0)*1e3))
-                    # 2. maxlen check (always on)
-                    len_c = len(c.d)  # capture length here as c.d may mutate and grow while this code executes.
-                    if len_c > c.maxlen:
-                        t0 = time.time()
-                        num = cls._try_to_expire_old_items(c.d, len_c - c.maxlen)
-                        tf = time.time()
-                        self.print_error("{}: flushed {} items in {:.02f} msec".format(c.name, num, (tf-t0)*1e3))
         finally:
             if cls.debug:
                 self.print_error("thread exit")
 
-    @classmethod
-    def _try_to_expire_old_items(cls, d_orig, num):
-        d = d_orig.copy()  # yes, this is slow but this makes it so we don't need locks.
-        if len(d) < num or num <= 0:
-            # cache modified from underneath our feet. We abort gracefully and complain.
-            print_error(f'[{__class__.__name__}] Cache data may have been removed by another thread. Aborting flush operation and will try again later...')
-            return 0
-
-        # bin the cache.dict items by 'tick' (when they were last accessed)
-        bins = defaultdict(list)
-        for k,v in d.items():
-            tick = v[0]
-            bins[tick].append(k)
-        del d
-
-        # Now, expire the old items starting with the oldest until we
-        # expire num items. Note that during this loop it's possible
-        # for items to get their timestamp updated by ExpiringCache.get().
-        # This loop will not detect that situation and will expire them anyway.
-        # This is fine, because it's a corner case and in the interests of
-        # keeping this code as simple as possible, we don't bother to guard
-        # against that.
-        ct = 0
-        sorted_bin_keys = sorted(bins.keys())
-        while ct < num and bins:
-            tick = sorted_bin_keys[0]
-            for key in bins[tick]:
-                # KeyError here should never happen in normal use, but it
-                # may if client code is messing with the .d dict.
-                try: del d_orig[key]  # despite appearances, this is atomic (thread-safe)
-                except KeyError: pass
-                ct += 1
-                if ct >= num:
-                    break
-            else:
-                del bins[tick]
-                del sorted_bin_keys[0]
-        return ct
-
-    @classmethod
-    def _remove_timed_out_items(cls, d_orig, tick_cutoff):
-        d = d_orig.copy()  # yes, this is slow but this makes it so we don't need locks.
-        if not len(d) or tick_cutoff < 0:
-            # cache modified from underneath our feet. We abort gracefully and complain.
-            print_error(f'[{__class__.__name__}] Cache data may have been removed by another thread. Aborting flush operation and will try again later...')
-            return 0
-
-        # scan the cache.dict for items whose 'tick' is older than tick_cutoff
-        ct = 0
-        for k,v in d.items():
-            tick = v[0]
-            if tick < tick_cutoff:
-                try: del d_orig[k]  # despite appearances, this is atomic (thread-safe)
-                except KeyError: pass
-                ct += 1
-        return ct
-
 
 def get_object_size(obj_0):
     ''' Debug tool -- returns the amount of memory taken by an object in bytes
@@ -264,7 +291,8 @@ def get_object_size(obj_0):
     import sys
     import warnings
     from numbers import Number
-    from collections import Set, Mapping, deque
+    from collections import deque
+    from collections.abc import Mapping, Set
 
     try: # Python 2
         zero_depth_bases = (basestring, Number, xrange, bytearray)
@@ -1236,7 +1236,7 @@ class CashAcct(util.PrintError, verifier.SPVDelegate):
         self.wallet.storage.put('cash_accounts_data', data)
 
         if write:
-            self.wallet.storage.write()
+            self.wallet.save_scheduler.mark_dirty()
 
     def get_verified(self, ca_name) -> Info:
         ''' Returns the Info object for ca_name of the form: Name#123.1234
@@ -1745,13 +1745,8 @@ class CashAcct(util.PrintError, verifier.SPVDelegate):
             # Since we have a chain reorg, invalidate the processed block and
             # minimal_ch_cache to force revalidation of our collision hashes.
             # FIXME: Do this more elegantly. This casts a pretty wide net.
-            # NB: I believe assiging a new {} to .d is safer than d.clear()
-            # in this case as the caches._ExpiringCacheMgr doesn't like it
-            # when you remove items from the existing dict, but should run ok
-            # if you just assign a new dict (it keeps a working reference as
-            # it flushes the cache)... so assigning to .d is safer in this case.
-            self.minimal_ch_cache.d = {}
-            self.processed_blocks.d = {}
+            self.minimal_ch_cache.clear()
+            self.processed_blocks.clear()
 
     def add_transaction_hook(
         self, txid: str, tx: object, script: ScriptOutput
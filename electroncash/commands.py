@@ -33,11 +33,13 @@ import os
 import queue
 import sys
 import time
+import urllib.parse
 
 from decimal import Decimal as PyDecimal  # Qt 5.12 also exports Decimal
 from functools import wraps
 
 from . import bitcoin
+from . import memdiag
 from . import util
 from .constants import PROJECT_NAME, SCRIPT_NAME, XEC
 from .address import Address, AddressError
@@ -45,10 +47,7 @@ from .bitcoin import hash_160, CASH, TYPE_ADDRESS
 from .i18n import _
 from .mnemo import Mnemonic_Electrum, make_bip39_words
 from .plugins import run_hook
-from .wallet import create_new_wallet, restore_wallet_from_text
-from .transaction import Transaction, multisig_script, OPReturn
 from .util import bfh, format_satoshis, json_decode, to_bytes
-from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
 from .simple_config import SimpleConfig
 
 known_commands = {}
@@ -189,6 +188,7 @@ class Commands:
         """Create a new wallet.
         If you want to be prompted for an argument, type '?' or ':' (concealed)
         """
+        from .wallet import create_new_wallet
         d = create_new_wallet(path=wallet_path,
                               passphrase=passphrase,
                               password=password,
@@ -207,6 +207,7 @@ class Commands:
         or bitcoin cash private keys.
         If you want to be prompted for an argument, type '?' or ':' (concealed)
         """
+        from .wallet import restore_wallet_from_text
         d = restore_wallet_from_text(text,
                                      path=wallet_path,
                                      passphrase=passphrase,
@@ -285,10 +286,31 @@ class Commands:
         return self.network.synchronous_get(('blockchain.scripthash.get_history', [sh]))
 
     @command('w')
-    def listunspent(self):
+    def listunspent(self, offset=0, limit=None, cursor=None):
         """List unspent outputs. Returns the list of unspent transaction
         outputs in your wallet."""
-        l = self.wallet.get_utxos(exclude_frozen=False)
+        if offset or limit is not None or cursor is not None:
+            addr_utxos = {}
+
+            def get_utxo(prevout):
+                # the coin as it is now, None if spent since the first page
+                prevout_hash, prevout_n = prevout.split(':')
+                for addr, l in self.wallet.txo.get(prevout_hash, {}).items():
+                    if any(n == int(prevout_n) for n, v, is_cb in l):
+                        if addr not in addr_utxos:
+                            addr_utxos[addr] = self.wallet.get_addr_utxo(addr)
+                        x = addr_utxos[addr].get(prevout)
+                        # like get_utxos(), skip the coins with SLP tokens
+                        return x if x and not x['slp_token'] else None
+                return None
+
+            with self.wallet.lock:
+                l = self.wallet.listing_pager.page(
+                    'listunspent',
+                    lambda: map(paged_commands['listunspent'], self.wallet.get_utxos(exclude_frozen=False)),
+                    get_utxo, offset, limit, cursor)
+        else:
+            l = self.wallet.get_utxos(exclude_frozen=False)
         for i in l:
             v = i["value"]
             i["value"] = str(PyDecimal(v)/CASH) if v is not None else None
@@ -309,6 +331,7 @@ class Commands:
         Inputs must have a redeemPubkey.
         Outputs must be a list of {'address':address, 'value':satoshi_amount}.
         """
+        from .transaction import Transaction
         keypairs = {}
         inputs = jsontx.get('inputs')
         outputs = jsontx.get('outputs')
@@ -336,6 +359,7 @@ class Commands:
     @command('wp')
     def signtransaction(self, tx, privkey=None, password=None):
         """Sign a transaction. The wallet keys will be used unless a private key is provided."""
+        from .transaction import Transaction
         tx = Transaction(tx, sign_schnorr=self.wallet and self.wallet.is_schnorr_enabled())
         if privkey:
             txin_type, privkey2, compressed = bitcoin.deserialize_privkey(privkey)
@@ -348,18 +372,21 @@ class Commands:
     @command('')
     def deserialize(self, tx):
         """Deserialize a serialized transaction"""
+        from .transaction import Transaction
         tx = Transaction(tx)
         return self._EnsureDictNamedTuplesAreJSONSafe(tx.deserialize().copy())
 
     @command('n')
     def broadcast(self, tx):
         """Broadcast a transaction to the network. """
+        from .transaction import Transaction
         tx = Transaction(tx)
         return self.network.broadcast_transaction(tx)
 
     @command('')
     def createmultisig(self, num, pubkeys):
         """Create multisig address"""
+        from .transaction import multisig_script
         assert isinstance(pubkeys, list), (type(num), type(pubkeys))
         redeem_script = multisig_script(pubkeys, num)
         address = bitcoin.hash160_to_p2sh(hash_160(bfh(redeem_script)))
@@ -442,9 +469,28 @@ class Commands:
         return self.network.synchronous_get(('blockchain.transaction.get_merkle', [txid, int(height)]))
 
     @command('n')
-    def getservers(self):
-        """Return the list of available servers"""
-        return self.network.get_servers()
+    def getservers(self, health=False):
+        """Return the list of available servers. With --health, include for
+        each host the connection statistics and health score recorded for
+        each of its ports (a lower score is better)."""
+        from .network import serialize_server
+        servers = self.network.get_servers()
+        if not health:
+            return servers
+        out = {}
+        for host, portmap in servers.items():
+            portmap = dict(portmap)
+            stats = {}
+            for protocol in 'st':
+                port = portmap.get(protocol)
+                if port:
+                    d = self.network.server_health.snapshot(
+                        serialize_server(host, port, protocol))
+                    if d is not None:
+                        stats[protocol] = d
+            portmap['health'] = stats
+            out[host] = portmap
+        return out
 
     @command('')
     def version(self):
@@ -519,6 +565,7 @@ class Commands:
 
     def _mktx(self, outputs, fee=None, feerate=None, change_addr=None, domain=None, nocheck=False,
               unsigned=False, password=None, locktime=None, op_return=None, op_return_raw=None, addtransaction=False):
+        from .transaction import OPReturn
         if fee is not None and feerate is not None:
             raise ValueError("Cannot specify both 'fee' and 'feerate' at the same time!")
         if op_return and op_return_raw:
@@ -579,7 +626,8 @@ class Commands:
         return tx.as_dict()
 
     @command('w')
-    def history(self, year=0, show_addresses=False, show_fiat=False, use_net=False, timeout=30.0):
+    def history(self, year=0, show_addresses=False, show_fiat=False, use_net=False, timeout=30.0,
+                offset=0, limit=None, cursor=None):
         """Wallet history. Returns the transaction history of your wallet."""
         t0 = time.time()
         year, show_addresses, show_fiat, use_net, timeout = (
@@ -588,7 +636,10 @@ class Commands:
         def time_remaining(): return max(timeout - (time.time()-t0), 0)
         kwargs = { 'show_addresses'   : show_addresses,
                    'fee_calc_timeout' : timeout,
-                   'download_inputs'  : use_net,        }
+                   'download_inputs'  : use_net,
+                   'offset'           : offset,
+                   'limit'            : limit,
+                   'cursor'           : cursor,         }
         if year:
             start_date = datetime.datetime(year, 1, 1)
             end_date = datetime.datetime(year+1, 1, 1)
@@ -649,20 +700,24 @@ class Commands:
         return results
 
     @command('w')
-    def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False):
+    def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False,
+                      offset=0, limit=None, cursor=None):
         """List wallet addresses. Returns the list of all addresses in your wallet. Use optional arguments to filter the results."""
+        filters = dict(receiving=receiving, change=change, frozen=frozen, unused=unused, funded=funded)
+        if offset or limit is not None or cursor is not None:
+            if cursor is not None:
+                try:
+                    cursor = Address.from_string(cursor)
+                except AddressError:
+                    raise ValueError(f'invalid cursor {cursor!r}') from None
+            selected = self.wallet.listing_pager.page(
+                ('listaddresses', *sorted(filters.items())),
+                lambda: self.wallet.get_filtered_addresses(**filters),
+                lambda addr: addr, offset, limit, cursor)
+        else:
+            selected = self.wallet.get_filtered_addresses(**filters)
         out = []
-        for addr in self.wallet.get_addresses():
-            if frozen and not self.wallet.is_frozen(addr):
-                continue
-            if receiving and self.wallet.is_change(addr):
-                continue
-            if change and not self.wallet.is_change(addr):
-                continue
-            if unused and self.wallet.is_used(addr):
-                continue
-            if funded and self.wallet.is_empty(addr):
-                continue
+        for addr in selected:
             item = addr.to_full_ui_string()
             if labels or balance:
                 item = (item,)
@@ -676,6 +731,7 @@ class Commands:
     @command('n')
     def gettransaction(self, txid):
         """Retrieve a transaction. """
+        from .transaction import Transaction
         if self.wallet and txid in self.wallet.transactions:
             tx = self.wallet.transactions[txid]
         else:
@@ -712,6 +768,7 @@ class Commands:
         return res
 
     def _format_request(self, out):
+        from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
         pr_str = {
             PR_UNKNOWN: 'Unknown',
             PR_UNPAID: 'Pending',
@@ -739,6 +796,7 @@ class Commands:
     @command('w')
     def listrequests(self, pending=False, expired=False, paid=False):
         """List the payment requests you made."""
+        from .paymentrequest import PR_PAID, PR_UNPAID, PR_EXPIRED
         out = self.wallet.get_sorted_requests(self.config)
         if pending:
             f = PR_UNPAID
@@ -810,20 +868,15 @@ class Commands:
 
     @command('n')
     def notify(self, address, URL):
-        """Watch an address. Everytime the address changes, a http POST is sent to the URL."""
-        def callback(x):
-            import urllib.request
-            headers = {'content-type':'application/json'}
-            data = {'address':address, 'status':x.get('result')}
-            serialized_data = util.to_bytes(json.dumps(data))
-            try:
-                req = urllib.request.Request(URL, serialized_data, headers)
-                response_stream = urllib.request.urlopen(req, timeout=5)
-                util.print_error('Got Response for %s' % address)
-            except BaseException as e:
-                util.print_error(str(e))
-        h = Address.from_string(address).to_scripthash_hex()
-        self.network.send([('blockchain.scripthash.subscribe', [h])], callback)
+        """Watch an address. Everytime the address changes, a http POST is sent to the URL.
+        Watches are kept across daemon restarts. Use an empty URL to stop watching the address."""
+        from .webhooks import AddressNotifier
+        notifier = AddressNotifier.get(self.network)
+        if not URL:
+            return notifier.remove(address)
+        if urllib.parse.urlsplit(URL).scheme not in ('http', 'https'):
+            raise ValueError('URL must be an http or https URL')
+        notifier.add(address, URL)
         return True
 
     @command('wn')
@@ -837,6 +890,36 @@ class Commands:
         to config settings (static/dynamic)"""
         return self.config.fee_per_kb()
 
+    @command('')
+    def memstats(self):
+        """Memory used by the process, the caches and, if a wallet is
+        loaded, by each data structure of the wallet"""
+        return memdiag.report([self.wallet] if self.wallet else [])
+
+    @command('')
+    def memsnapshot(self, name=None, limit=20, stop=False):
+        """Take a snapshot of the memory allocations and return the biggest
+        allocation sites. Tracing starts with the first snapshot: the
+        allocations made before are not seen, and the process is slower
+        until tracing is stopped."""
+        if stop:
+            memdiag.stop_tracing()
+            return True
+        name = memdiag.take_snapshot(name)['name']
+        return memdiag.top(name, limit=limit)
+
+    @command('')
+    def memdiff(self, old, new=None, limit=20):
+        """Compare two memory snapshots and return the allocation sites that
+        changed the most"""
+        return memdiag.diff(old, new, limit=limit)
+
+    @command('')
+    def memobjects(self, limit=30):
+        """Count the live objects of each type, and the change of these
+        counts since the previous call"""
+        return memdiag.object_counts(limit)
+
     @command('')
     def help(self):
         # for the python console
@@ -855,6 +938,7 @@ param_descriptions = {
     'key': 'Variable name',
     'pubkey': 'Public key',
     'message': 'Clear text message. Use quotes if it contains spaces.',
+    'old': 'Name of a memory snapshot',
     'encrypted': 'Encrypted message',
     'amount': f'Amount to be sent (in {XEC.ticker}). Type \'!\' '
               f'to send the maximum available.',
@@ -875,19 +959,25 @@ command_options = {
     'expired':     (None, "Show only expired requests."),
     'fee':         ("-f", f"Transaction fee (absolute, in {XEC.ticker})"),
     'feerate':     (None, "Transaction fee rate (in sat/byte)"),
+    'cursor':      (None, "Start the list right after this item: a txid for history, txid:n for listunspent, or an address"),
     'force':       (None, "Create new address beyond gap limit, if no more addresses are available."),
     'from_addr':   ("-F", "Source address (must be a wallet address; use sweep to spend from non-wallet address)."),
     'frozen':      (None, "Show only frozen addresses"),
     'funded':      (None, "Show only funded addresses"),
+    'health':      (None, "Show the health statistics of each server"),
     'imax':        (None, "Maximum number of inputs"),
     'index_url':   (None, 'Override the URL where you would like users to be shown the BIP70 Payment Request'),
     'labels':      ("-l", "Show the labels of listed addresses"),
     'language':    ("-L", "Default language for wordlist"),
+    'limit':       (None, "Maximum number of items to return"),
     'locktime':    (None, "Set locktime block number"),
     'memo':        ("-m", "Description of the request"),
+    'name':        (None, "Name of the memory snapshot"),
     'nbits':       (None, "Number of bits of entropy"),
+    'new':         (None, "Name of the memory snapshot to compare to. Default: take a new one"),
     'new_password':(None, "New Password"),
     'nocheck':     (None, "Do not verify aliases"),
+    'offset':      (None, "Number of items to skip"),
     'op_return':   (None, "Specify string data to add to the transaction as an OP_RETURN output"),
     'op_return_raw': (None, 'Specify raw hex data to add to the transaction as an OP_RETURN output (0x6a aka the OP_RETURN byte will be auto-prepended for you so do not include it)'),
     'paid':        (None, "Show only paid requests."),
@@ -900,6 +990,7 @@ command_options = {
     'seed_type':   (None, "The type of seed to create, currently: 'electrum' and 'bip39' is supported. Default 'bip39'."),
     'show_addresses': (None, "Show input and output addresses"),
     'show_fiat':   (None, "Show fiat value of transactions"),
+    'stop':        (None, "Stop tracing memory allocations and forget the snapshots"),
     'timeout':     (None, "Timeout in seconds to wait for the overall operation to complete. Defaults to 30.0."),
     'unsigned':    ("-u", "Do not sign transaction"),
     'unused':      (None, "Show only unused addresses"),
@@ -909,8 +1000,13 @@ command_options = {
 }
 
 
+def tx_from_str(txt):
+    # transaction.py is only imported when a command takes a transaction
+    from .transaction import tx_from_str
+    return tx_from_str(txt)
+
+
 # don't use floats because of rounding errors
-from .transaction import tx_from_str
 json_loads = lambda x: json.loads(x, parse_float=lambda x: str(PyDecimal(x)))
 arg_types = {
     'num': int,
@@ -926,6 +1022,16 @@ arg_types = {
     'fee': lambda x: str(PyDecimal(x)) if x is not None else None,
     'amount': lambda x: str(PyDecimal(x)) if x != '!' else '!',
     'locktime': int,
+    'offset': int,
+    'limit': int,
+}
+
+# Commands returning lists that can be paged with offset/limit/cursor, and
+# the cursor of an item of their result
+paged_commands = {
+    'history': lambda item: item['txid'],
+    'listaddresses': lambda item: item if isinstance(item, str) else item[0],
+    'listunspent': lambda item: '{}:{}'.format(item['prevout_hash'], item['prevout_n']),
 }
 
 config_variables = {
@@ -983,7 +1089,7 @@ def get_parser():
     add_global_options(parser_gui)
     # daemon
     parser_daemon = subparsers.add_parser('daemon', help="Run Daemon")
-    parser_daemon.add_argument("subcommand", nargs='?', help="start, stop, status, load_wallet, close_wallet. Other commands may be added by plugins.")
+    parser_daemon.add_argument("subcommand", nargs='?', help="start, stop, status, load_wallet, close_wallet, rpcstats, notifystats, caches, metrics, memory. Other commands may be added by plugins.")
     parser_daemon.add_argument("subargs", nargs='*', metavar='arg', help="additional arguments (used by plugins)")
     #parser_daemon.set_defaults(func=run_daemon)
     add_network_options(parser_daemon)
@@ -995,6 +1101,9 @@ def get_parser():
         add_global_options(p)
         if cmdname == 'restore':
             p.add_argument("-o", "--offline", action="store_true", dest="offline", default=False, help="Run offline")
+        if cmdname in paged_commands:
+            p.add_argument("--ndjson", action="store_true", dest="ndjson", default=False,
+                           help="Print one JSON item per line, fetching the list from the daemon page by page")
         for optname, default in zip(cmd.options, cmd.defaults):
             a, help = command_options[optname]
             b = '--' + optname
@@ -25,23 +25,28 @@
 # SOFTWARE.
 import ast
 import os
+import threading
 import time
 import sys
+from collections import OrderedDict
 
 from .constants import PROJECT_NAME, SCRIPT_NAME
 
 import jsonrpclib
-from .jsonrpc import VerifyingJSONRPCServer
+from .jsonrpc import VerifyingJSONRPCServer, DEFAULT_RPC_MAX_QUEUED, DEFAULT_RPC_WORKERS
 
 from .version import PACKAGE_VERSION
-from .network import Network
 from .util import (json_decode, DaemonThread, print_error, to_string,
                    standardize_path)
-from .wallet import Wallet
-from .storage import WalletStorage
+from .caches import all_caches_stats
 from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
-from .exchange_rate import FxThread
+from . import memdiag
+from . import tracing
+
+# Default number of closed wallets kept in memory by a daemon without GUI, so
+# that opening them again does not load them from their file again
+DEFAULT_WARM_WALLETS = 4
 
 
 def get_lockfile(config):
@@ -139,6 +144,8 @@ def get_rpc_credentials(config):
         rpc_password = to_string(pw_b64, 'ascii')
         config.set_key('rpcuser', rpc_user)
         config.set_key('rpcpassword', rpc_password, save=True)
+        # The daemon and its clients must agree on them
+        config.flush()
     elif rpc_password == '':
         from .util import print_stderr
         print_stderr('WARNING: RPC authentication is disabled.')
@@ -148,10 +155,21 @@ def get_rpc_credentials(config):
 class Daemon(DaemonThread):
 
     def __init__(self, config, fd, is_gui, plugins, *, listen_jsonrpc=True):
+        # Imported here, so that the command line client, which only needs
+        # get_server(), doesn't load the network and wallet modules.
+        from .exchange_rate import FxThread
+        from .network import Network
+        from .webhooks import AddressNotifier
         DaemonThread.__init__(self)
         self.plugins = plugins
         self.config = config
         self.listen_jsonrpc = listen_jsonrpc
+        # Spans and counters of the hot paths, see tracing.py
+        if config.get('tracing'):
+            tracing.set_enabled(True)
+        self.metrics_server = None
+        if config.get('metrics_port'):
+            self.init_metrics_server(config)
         if config.get('offline'):
             self.network = None
         else:
@@ -163,18 +181,62 @@ class Daemon(DaemonThread):
         self.gui = None
         self.server = None
         self.wallets = {}
+        # Commands on the same wallet are serialized, commands on different
+        # wallets may run concurrently. path -> RLock
+        self.wallet_locks = {}
+        self.wallet_locks_lock = threading.Lock()
+        # Closed wallets, path -> (file stamp, wallet), least recently closed
+        # first. See load_wallet. Not used with a GUI, which attaches its
+        # windows and the state of its plugins to the wallets.
+        self.warm_wallets = OrderedDict()
+        self.warm_wallets_lock = threading.Lock()
+        try:
+            self.max_warm_wallets = max(0, int(config.get('warm_wallets', DEFAULT_WARM_WALLETS)))
+        except (TypeError, ValueError):
+            self.max_warm_wallets = DEFAULT_WARM_WALLETS
+        if is_gui:
+            self.max_warm_wallets = 0
         if listen_jsonrpc:
             # Setup JSONRPC server
             self.init_server(config, fd, is_gui)
+        if self.network:
+            # Resume the address watches of the notify command
+            AddressNotifier.restore(self.network)
+        # Setup the websocket server notifying payment requests
+        self.websocket_server = None
+        if self.network and config.get('websocket_server'):
+            from . import websockets
+            self.websocket_server = websockets.WebSocketServer(config, self.network, self.wallets)
+            self.websocket_server.start()
+
+    def init_metrics_server(self, config):
+        from .metrics_server import MetricsServer
+        host = config.get('metrics_host', '127.0.0.1')
+        try:
+            self.metrics_server = MetricsServer(host, int(config.get('metrics_port')))
+        except (OSError, TypeError, ValueError) as e:
+            self.print_error('failed to start the metrics server:', repr(e))
+            return
+        self.metrics_server.start()
+        self.print_error('metrics served on {}:{}'.format(*self.metrics_server.server_address[:2]))
 
     def init_server(self, config, fd, is_gui):
         host = config.get('rpchost', '127.0.0.1')
         port = config.get('rpcport', 0)
 
         rpc_user, rpc_password = get_rpc_credentials(config)
+        try:
+            workers = max(0, int(config.get('rpcworkers', DEFAULT_RPC_WORKERS)))
+        except (TypeError, ValueError):
+            workers = DEFAULT_RPC_WORKERS
+        try:
+            max_queued = max(0, int(config.get('rpcmaxqueued', DEFAULT_RPC_MAX_QUEUED)))
+        except (TypeError, ValueError):
+            max_queued = DEFAULT_RPC_MAX_QUEUED
         try:
             server = VerifyingJSONRPCServer((host, port), logRequests=False,
-                                            rpc_user=rpc_user, rpc_password=rpc_password)
+                                            rpc_user=rpc_user, rpc_password=rpc_password,
+                                            workers=workers, max_queued=max_queued)
         except Exception as e:
             self.print_error('Warning: cannot initialize RPC server on host', host, e)
             os.close(fd)
@@ -188,9 +250,50 @@ class Daemon(DaemonThread):
         server.register_function(self.run_daemon, 'daemon')
         self.cmd_runner = Commands(self.config, None, self.network)
         for cmdname in known_commands:
-            server.register_function(getattr(self.cmd_runner, cmdname), cmdname)
+            server.register_function(self._make_rpc_command(cmdname), cmdname)
         server.register_function(self.run_cmdline, 'run_cmdline')
 
+    def _make_rpc_command(self, cmdname):
+        def rpc_command(*args, wallet=None, **kwargs):
+            # With named params, the caller can pick any loaded wallet by
+            # path or file name. Otherwise, bind the wallet now: load_wallet
+            # may switch the wallet of cmd_runner while the command runs.
+            if wallet is not None:
+                wallet = self.find_wallet(wallet)
+            else:
+                wallet = self.cmd_runner.wallet
+            cmd_runner = Commands(self.config, wallet, self.network)
+            func = getattr(cmd_runner, cmdname)
+            if not known_commands[cmdname].requires_wallet or wallet is None:
+                return func(*args, **kwargs)
+            with self.get_wallet_lock(wallet):
+                return func(*args, **kwargs)
+        rpc_command.__name__ = cmdname
+        return rpc_command
+
+    def find_wallet(self, ref):
+        ''' Returns the loaded wallet whose path, or file name, is ref. '''
+        if not isinstance(ref, str) or not ref:
+            raise ValueError('wallet must be a wallet path or file name')
+        wallet = self.wallets.get(standardize_path(ref))
+        if wallet is not None:
+            return wallet
+        matches = [w for path, w in list(self.wallets.items())
+                   if os.path.basename(path) == ref]
+        if len(matches) > 1:
+            raise ValueError(f'Wallet name "{ref}" is ambiguous, use its full path')
+        if not matches:
+            raise ValueError(f'Wallet "{ref}" is not loaded')
+        return matches[0]
+
+    def get_wallet_lock(self, wallet):
+        path = wallet.storage.path
+        with self.wallet_locks_lock:
+            lock = self.wallet_locks.get(path)
+            if lock is None:
+                lock = self.wallet_locks[path] = threading.RLock()
+            return lock
+
     def ping(self):
         return True
 
@@ -198,8 +301,8 @@ class Daemon(DaemonThread):
         config = SimpleConfig(config_options)
         sub = config.get('subcommand')
         subargs = config.get('subargs')
-        plugin_cmd = self.plugins and self.plugins.daemon_commands.get(sub)
-        if subargs and sub in [None, 'start', 'stop', 'status']:
+        plugin_cmd = self.plugins and self.plugins.get_daemon_command(sub)
+        if subargs and sub in [None, 'start', 'stop', 'status', 'rpcstats', 'notifystats', 'caches', 'metrics', 'memory']:
             return "Unexpected arguments: {!r}. {!r} takes no options.".format(subargs, sub)
         if subargs and sub in ['load_wallet', 'close_wallet']:
             return "Unexpected arguments: {!r}. Provide options to {!r} using the -w and -wp options.".format(subargs, sub)
@@ -217,6 +320,20 @@ class Daemon(DaemonThread):
                 response = True
             else:
                 response = False
+        elif sub == 'rpcstats':
+            response = self.server.method_stats.to_dict() if self.server else {}
+        elif sub == 'notifystats':
+            notifier = self.network and getattr(self.network, 'address_notifier', None)
+            if notifier:
+                response = dict(notifier.dispatcher.stats(), watches=len(notifier.watches))
+            else:
+                response = {}
+        elif sub == 'caches':
+            response = all_caches_stats()
+        elif sub == 'metrics':
+            response = tracing.snapshot()
+        elif sub == 'memory':
+            response = memdiag.report(list(self.wallets.values()))
         elif sub == 'status':
             if self.network:
                 p = self.network.get_parameters()
@@ -265,6 +382,13 @@ class Daemon(DaemonThread):
         if path in self.wallets:
             wallet = self.wallets[path]
             return wallet
+        wallet = self.pop_warm_wallet(path, password)
+        if wallet is not None:
+            wallet.start_threads(self.network)
+            self.wallets[path] = wallet
+            return wallet
+        from .storage import WalletStorage
+        from .wallet import Wallet
         storage = WalletStorage(path, manual_upgrades=True)
         if not storage.file_exists():
             return
@@ -290,8 +414,53 @@ class Daemon(DaemonThread):
     def get_wallet(self, path):
         return self.wallets.get(path)
 
+    @staticmethod
+    def get_file_stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def keep_warm_wallet(self, path, wallet):
+        """Keeps the stopped wallet in memory, for load_wallet to use it
+        again as long as its file is not modified."""
+        if not self.max_warm_wallets:
+            return
+        stamp = self.get_file_stamp(path)
+        if stamp is None or wallet.storage.modified:
+            return
+        with self.warm_wallets_lock:
+            self.warm_wallets.pop(path, None)
+            self.warm_wallets[path] = stamp, wallet
+            while len(self.warm_wallets) > self.max_warm_wallets:
+                self.warm_wallets.popitem(last=False)
+
+    def pop_warm_wallet(self, path, password):
+        """Returns the wallet kept by keep_warm_wallet, if its file was not
+        modified since it was stopped. Raises InvalidPassword if the wallet
+        is encrypted and password is not its password."""
+        with self.warm_wallets_lock:
+            stamp, wallet = self.warm_wallets.pop(path, (None, None))
+        if wallet is None or stamp != self.get_file_stamp(path):
+            return None
+        if wallet.storage.is_encrypted():
+            if not password:
+                # keep it for the next attempt
+                self.keep_warm_wallet(path, wallet)
+                return None
+            try:
+                wallet.storage.check_password(password)
+            except BaseException:
+                self.keep_warm_wallet(path, wallet)
+                raise
+        self.print_error("reusing the loaded wallet", path)
+        return wallet
+
     def delete_wallet(self, path):
         self.stop_wallet(path)
+        with self.warm_wallets_lock:
+            self.warm_wallets.pop(path, None)
         if os.path.exists(path):
             os.unlink(path)
             return True
@@ -301,7 +470,11 @@ class Daemon(DaemonThread):
         # Issue #659 wallet may already be stopped.
         if path in self.wallets:
             wallet = self.wallets.pop(path)
-            wallet.stop_threads()
+            with self.get_wallet_lock(wallet):
+                wallet.stop_threads()
+            with self.wallet_locks_lock:
+                self.wallet_locks.pop(path, None)
+            self.keep_warm_wallet(path, wallet)
 
     def run_cmdline(self, config_options):
         password = config_options.get('password')
@@ -328,20 +501,36 @@ class Daemon(DaemonThread):
         cmd_runner = Commands(config, wallet, self.network)
         func = getattr(cmd_runner, cmd.name)
         try:
-            result = func(*args, **kwargs)
+            if wallet is not None:
+                with self.get_wallet_lock(wallet):
+                    result = func(*args, **kwargs)
+            else:
+                result = func(*args, **kwargs)
         except TypeError as e:
             raise Exception("Wrapping TypeError to prevent JSONRPC-Pelix from hiding traceback") from e
+        finally:
+            # This config only lives for this command, and the next one reads
+            # the config file: write the changes now, e.g. of setconfig.
+            config.flush()
         return result
 
     def run(self):
         while self.is_running():
             self.server.handle_request() if self.server else time.sleep(0.1)
+        if self.server:
+            self.server.server_close()
         for k, wallet in self.wallets.items():
             wallet.stop_threads()
         if self.network:
+            notifier = getattr(self.network, 'address_notifier', None)
+            if notifier:
+                notifier.stop()
             self.print_error("shutting down network")
             self.network.stop()
             self.network.join()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        self.config.flush()
         self.on_stop()
 
     def stop(self):
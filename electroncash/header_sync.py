@@ -0,0 +1,299 @@
+# Electrum ABC - lightweight eCash client
+# Copyright (C) 2020 The Electrum ABC developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Pipelined header catch-up.
+
+The legacy catch-up logic in network.py requests one chunk of at most 2016
+headers from the catching-up interface, waits for it, connects it and only
+then requests the next one. The HeaderSyncScheduler keeps several chunk
+requests in flight at once, spread across all verified interfaces, buffers
+chunks that complete out of order and connects them to the blockchain
+strictly in height order.
+"""
+import time
+
+from . import blockchain
+from .interface import Interface
+from .util import PrintError
+
+# Maximum number of headers the server will return for a single request
+MAX_CHUNK_SIZE = 2016
+
+# Default number of chunk requests kept in flight during catch-up
+DEFAULT_PIPELINE_DEPTH = 8
+
+# A helper interface that has not answered a chunk request after this many
+# seconds has its request re-issued to another interface
+STALL_TIMEOUT = 20
+
+
+class HeaderSyncScheduler(PrintError):
+    """Schedules block header chunk requests during catch-up.
+
+    Only one catch-up session is handled at a time: the one started by the
+    interface that owns `blockchain.catch_up`. That interface is the
+    "leader". Other interfaces in default mode that advertise a tip high
+    enough are used as helpers to download chunks in parallel. Chunks from
+    helpers go through exactly the same verification as chunks from the
+    leader, and a chunk that fails to connect is simply re-requested from the
+    leader, so helpers can speed things up but can never corrupt the chain.
+
+    Must only be used from the network thread.
+    """
+
+    def __init__(self, network):
+        self.network = network
+        self.depth = self.get_pipeline_depth(network.config)
+        self._reset()
+
+    def diagnostic_name(self):
+        return "HeaderSync"
+
+    @staticmethod
+    def get_pipeline_depth(config):
+        depth = config and config.get("header_sync_depth", DEFAULT_PIPELINE_DEPTH)
+        try:
+            return max(1, int(depth))
+        except (TypeError, ValueError):
+            return DEFAULT_PIPELINE_DEPTH
+
+    def _reset(self):
+        self.leader = None
+        self.chain = None
+        # Next height to be scheduled for download
+        self.next_height = None
+        # base_height -> (server, count, time sent, leader_only)
+        self.in_flight = {}
+        # base_height -> (server, chunk_data) for chunks waiting to be
+        # connected because a lower chunk has not arrived yet
+        self.completed = {}
+        # (base_height, count, leader_only) ranges that must be re-requested
+        self.retry = []
+        # (server, base_height) of stalled requests that were re-issued
+        # elsewhere. A late answer is still welcome.
+        self.abandoned = set()
+
+    def is_active(self):
+        return self.leader is not None
+
+    def start(self, interface, chain, from_height):
+        """Start a pipelined catch-up of `chain` from `from_height` up to the
+        tip of `interface`.  Returns False if pipelining is disabled or
+        another session is running, in which case the caller should fall
+        back to requesting a single chunk."""
+        if self.depth <= 1:
+            return False
+        if self.is_active():
+            if self.leader is interface and self.chain is chain:
+                # Already running for this very catch-up
+                return True
+            return False
+        self.leader = interface
+        self.chain = chain
+        self.next_height = from_height
+        interface.print_error(
+            "pipelined catch up from {} to {} (depth {})".format(
+                from_height, interface.tip, self.depth
+            )
+        )
+        self._fill()
+        return True
+
+    def is_scheduled(self, interface, base_height):
+        """Return True if a chunk response for `base_height` belongs to the
+        running session."""
+        if not self.is_active():
+            return False
+        if (interface.server, base_height) in self.abandoned:
+            return True
+        entry = self.in_flight.get(base_height)
+        return entry is not None and entry[0] == interface.server
+
+    def _candidates(self, top_height, leader_only):
+        if leader_only:
+            return [self.leader]
+        candidates = [self.leader]
+        for i in self.network.get_interfaces(interfaces=True):
+            if (
+                i is not self.leader
+                and i.mode == Interface.MODE_DEFAULT
+                and i.tip >= top_height
+            ):
+                candidates.append(i)
+        return candidates
+
+    def _pick_interface(self, top_height, leader_only):
+        load = {}
+        for server, *_ in self.in_flight.values():
+            load[server] = load.get(server, 0) + 1
+        candidates = self._candidates(top_height, leader_only)
+        # Least loaded first, then the healthiest server
+        health = self.network.server_health
+        return min(candidates, key=lambda i: (load.get(i.server, 0), health.score(i.server)))
+
+    def _request(self, base_height, count, leader_only=False):
+        top_height = base_height + count - 1
+        interface = self._pick_interface(top_height, leader_only)
+        if not self.network.request_headers(interface, base_height, count, silent=True):
+            return False
+        self.in_flight[base_height] = (interface.server, count, time.time(), leader_only)
+        return True
+
+    def _fill(self):
+        # Retries are always sent regardless of depth: they are usually the
+        # gap that the buffered out-of-order chunks are waiting on.
+        while self.retry:
+            base_height, count, leader_only = self.retry[0]
+            if not self._request(base_height, count, leader_only):
+                return
+            self.retry.pop(0)
+        while len(self.in_flight) + len(self.completed) < self.depth:
+            tip = self.leader.tip
+            if self.next_height > tip:
+                return
+            count = min(MAX_CHUNK_SIZE, tip - self.next_height + 1)
+            if not self._request(self.next_height, count):
+                return
+            self.next_height += count
+
+    def on_chunk(self, interface, base_height, chunk_data):
+        """Handle a chunk response previously accepted by is_scheduled()."""
+        header_count = len(chunk_data) // blockchain.HEADER_SIZE
+        if (interface.server, base_height) in self.abandoned:
+            self.abandoned.discard((interface.server, base_height))
+            if header_count and base_height not in self.completed:
+                self.completed[base_height] = (interface.server, chunk_data)
+            self._connect_completed()
+            return
+        server, count, _, leader_only = self.in_flight.pop(base_height)
+        if header_count < count:
+            # The server's tip moved backwards, or it is misbehaving. Get the
+            # rest from the leader, up to its tip.
+            if server == self.leader.server and not header_count:
+                # Asking the leader again would get the same answer
+                self.abort("empty chunk {} from leader".format(base_height))
+                return
+            rest_height = base_height + header_count
+            top_height = min(base_height + count - 1, self.leader.tip)
+            if rest_height <= top_height:
+                self.retry.append((rest_height, top_height - rest_height + 1, True))
+        if header_count:
+            self.completed[base_height] = (server, chunk_data)
+        self._connect_completed()
+
+    def on_request_failed(self, interface, base_height):
+        """An error response was received for a scheduled chunk request."""
+        self.abandoned.discard((interface.server, base_height))
+        entry = self.in_flight.get(base_height)
+        if entry is None or entry[0] != interface.server:
+            return
+        del self.in_flight[base_height]
+        server, count, _, leader_only = entry
+        if interface is self.leader:
+            self.abort("error response from leader")
+            return
+        self.retry.append((base_height, count, True))
+        self._fill()
+
+    def on_connection_down(self, server):
+        if not self.is_active():
+            return
+        if server == self.leader.server:
+            self.abort("leader disconnected")
+            return
+        self.abandoned = {a for a in self.abandoned if a[0] != server}
+        for base_height, entry in list(self.in_flight.items()):
+            if entry[0] == server:
+                del self.in_flight[base_height]
+                self.retry.append((base_height, entry[1], entry[3]))
+        self._fill()
+
+    def check_stalled(self):
+        """Called periodically from the network loop to re-issue requests
+        that a helper interface is sitting on."""
+        if not self.is_active():
+            return
+        now = time.time()
+        for base_height, entry in list(self.in_flight.items()):
+            server, count, sent, leader_only = entry
+            if server != self.leader.server and now - sent > STALL_TIMEOUT:
+                self.print_error(
+                    "chunk {} stalled on {}, re-requesting".format(base_height, server)
+                )
+                del self.in_flight[base_height]
+                self.abandoned.add((server, base_height))
+                self.retry.append((base_height, count, True))
+        self._fill()
+
+    def abort(self, reason):
+        if self.is_active():
+            self.leader.print_error("pipelined catch up aborted:", reason)
+        self._reset()
+
+    def _connect_completed(self):
+        chain = self.chain
+        # Drop anything already covered by the chain, e.g. a late answer to a
+        # request that was re-issued.
+        for base_height in list(self.completed):
+            server, chunk_data = self.completed[base_height]
+            top_height = base_height + len(chunk_data) // blockchain.HEADER_SIZE - 1
+            if top_height <= chain.height():
+                del self.completed[base_height]
+
+        while chain.height() + 1 in self.completed:
+            base_height = chain.height() + 1
+            server, chunk_data = self.completed.pop(base_height)
+            header_count = len(chunk_data) // blockchain.HEADER_SIZE
+            connect_state = chain.connect_chunk(base_height, chunk_data)
+            if connect_state == blockchain.CHUNK_ACCEPTED:
+                self.leader.print_error(
+                    "connected chunk, height={} count={} from {}".format(
+                        base_height, header_count, server
+                    )
+                )
+                continue
+            if server != self.leader.server:
+                self.print_error(
+                    "chunk {} from helper {} did not connect (reason={}),"
+                    " re-requesting from leader".format(base_height, server, connect_state)
+                )
+                self.retry.append((base_height, header_count, True))
+                break
+            leader = self.leader
+            self.abort("chunk {} did not connect (reason={})".format(base_height, connect_state))
+            if connect_state != blockchain.CHUNK_FORKS:
+                self.network.connection_down(leader.server)
+            return
+
+        if chain.height() >= self.leader.tip and not self.in_flight:
+            self._finish()
+        else:
+            self._fill()
+
+    def _finish(self):
+        leader = self.leader
+        chain = self.chain
+        self._reset()
+        leader.set_mode(Interface.MODE_DEFAULT)
+        leader.print_error("catch up done", chain.height())
+        chain.catch_up = None
+        self.network.switch_lagging_interface()
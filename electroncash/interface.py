@@ -314,11 +314,13 @@ class Interface(util.PrintError):
     MODE_CATCH_UP = 'catch_up'
     MODE_VERIFICATION = 'verification'
 
-    def __init__(self, server, socket, *, max_message_bytes=0, config=None):
+    def __init__(self, server, socket, *, max_message_bytes=0, config=None, stats=None):
         self.server = server
         self.config = config
         self.host, self.port, _ = server.rsplit(':', 2)
         self.socket = socket
+        # server_health.ServerStats updated with response latencies, or None
+        self.stats = stats
 
         self.pipe = util.JSONSocketPipe(socket, max_message_bytes=max_message_bytes)
         # Dump network messages.  Set at runtime from the console.
@@ -326,6 +328,8 @@ class Interface(util.PrintError):
         self.request_time = time.time()
         self.unsent_requests = []
         self.unanswered_requests = {}
+        # wire id -> time the request was written to the socket
+        self.request_send_times = {}
         self.last_send = time.time()
 
         self.mode = None
@@ -423,10 +427,12 @@ class Interface(util.PrintError):
             return False
 
         self.unsent_requests = self.unsent_requests[n:]
+        now = time.time()
         for request in wire_requests:
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.request_send_times[request[2]] = now
         return True
 
     def ping_required(self):
@@ -498,7 +504,10 @@ class Interface(util.PrintError):
                 responses.append((None, response))
             else:
                 request = self.unanswered_requests.pop(wire_id, None)
+                sent = self.request_send_times.pop(wire_id, None)
                 if request:
+                    if self.stats is not None and sent is not None:
+                        self._record_response(request, response, time.time() - sent)
                     responses.append((request, response))
                 else:
                     self.print_error("unknown wire ID", wire_id)
@@ -507,6 +516,12 @@ class Interface(util.PrintError):
 
         return responses
 
+    def _record_response(self, request, response, latency):
+        if request[0] == 'server.ping':
+            self.stats.record_ping(latency)
+        self.stats.record_response(latency, self.pipe.last_message_size,
+                                   error=bool(response.get('error')))
+
 
 def check_cert(host, cert):
     try:
@@ -24,11 +24,49 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
+from jsonrpclib.SimpleJSONRPCServer import (SimpleJSONRPCServer, SimpleJSONRPCRequestHandler,
+                                            NoMulticallResult, validate_request)
+from jsonrpclib.jsonrpc import Fault
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 
-from . import util
+from . import tracing, util
+from .tracing import LatencyHistogram
+
+# Default number of threads serving RPC connections
+DEFAULT_RPC_WORKERS = 8
+
+# Default number of connections waiting for a worker. More connections are
+# answered with 503 Service Unavailable.
+DEFAULT_RPC_MAX_QUEUED = 64
+
+# Idle keep-alive connections are closed after this many seconds: a
+# connection holds on to its worker while it is open
+KEEPALIVE_TIMEOUT = 2.0
+
+# Largest accepted JSON-RPC batch
+MAX_BATCH_SIZE = 1000
+
+
+class RPCMethodStats:
+    ''' Thread-safe collection of per-method LatencyHistograms. '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def add(self, method, duration, error=False):
+        with self.lock:
+            h = self.histograms.get(method)
+            if h is None:
+                h = self.histograms[method] = LatencyHistogram()
+            h.add(duration, error)
+
+    def to_dict(self):
+        with self.lock:
+            return {method: h.to_dict() for method, h in sorted(self.histograms.items())}
 
 
 class RPCAuthCredentialsInvalid(Exception):
@@ -48,13 +86,45 @@ class RPCAuthUnsupportedType(Exception):
 
 # based on http://acooke.org/cute/BasicHTTPA0.html by andrew cooke
 class VerifyingJSONRPCServer(SimpleJSONRPCServer):
+    ''' JSON-RPC server with basic authentication.
 
-    def __init__(self, *args, rpc_user, rpc_password, **kargs):
+    Connections are served concurrently by a pool of `workers` threads, and
+    HTTP/1.1 keep-alive is supported, and the calls of a JSON-RPC batch are
+    run in parallel on a separate pool of as many threads. At most
+    `max_queued` connections wait for a worker, the next ones are answered
+    with 503 Service Unavailable. With workers=0, requests are handled one
+    at a time in the thread calling handle_request(). The duration of every
+    call is recorded per method in self.method_stats. '''
+
+    def __init__(self, *args, rpc_user, rpc_password, workers=0,
+                 max_queued=DEFAULT_RPC_MAX_QUEUED, **kargs):
 
         self.rpc_user = rpc_user
         self.rpc_password = rpc_password
+        self.method_stats = RPCMethodStats()
+        # Connections being served or waiting for a worker
+        self.max_pending = workers + max(0, max_queued)
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.executor = (ThreadPoolExecutor(max_workers=workers, thread_name_prefix='RPCWorker')
+                         if workers > 0 else None)
+        # Batch entries get their own pool: a connection worker waiting on
+        # its batch must not starve the entries of threads.
+        self.batch_executor = (ThreadPoolExecutor(max_workers=workers, thread_name_prefix='RPCBatch')
+                               if workers > 0 else None)
 
         class VerifyingRequestHandler(SimpleJSONRPCRequestHandler):
+            if workers > 0:
+                protocol_version = 'HTTP/1.1'
+                timeout = KEEPALIVE_TIMEOUT
+
+            def log_error(myself, format, *args):
+                if format.startswith('Request timed out'):
+                    # an idle keep-alive connection, nothing to report
+                    util.print_error('[RPC]', format % args)
+                else:
+                    SimpleJSONRPCRequestHandler.log_error(myself, format, *args)
+
             def parse_request(myself):
                 # first, call the original implementation which returns
                 # True if all OK so far
@@ -74,6 +144,86 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
         SimpleJSONRPCServer.__init__(
             self, requestHandler=VerifyingRequestHandler, *args, **kargs)
 
+    def process_request(self, request, client_address):
+        if self.executor is None:
+            return super().process_request(request, client_address)
+        with self.pending_lock:
+            busy = self.pending >= self.max_pending
+            if not busy:
+                self.pending += 1
+        if busy:
+            tracing.count('rpc.rejected')
+            self._reject_request(request)
+            return
+        self.executor.submit(self._process_request_thread, request, client_address)
+
+    def _reject_request(self, request):
+        try:
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\n'
+                            b'Retry-After: 1\r\n'
+                            b'Content-Length: 0\r\n'
+                            b'Connection: close\r\n\r\n')
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _process_request_thread(self, request, client_address):
+        # Same as socketserver.ThreadingMixIn.process_request_thread
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.pending_lock:
+                self.pending -= 1
+
+    def server_close(self):
+        super().server_close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.batch_executor.shutdown(wait=False)
+
+    def _unmarshaled_dispatch(self, request, dispatch_method=None):
+        if not isinstance(request, list) or not request:
+            return super()._unmarshaled_dispatch(request, dispatch_method)
+        if len(request) > MAX_BATCH_SIZE:
+            return Fault(-32600, 'Request invalid -- batch too large ({} > {}).'
+                         .format(len(request), MAX_BATCH_SIZE), config=self.json_config).dump()
+        if self.batch_executor is None or len(request) == 1:
+            responses = [self._dispatch_batch_entry(entry, dispatch_method)
+                         for entry in request]
+        else:
+            futures = [self.batch_executor.submit(self._dispatch_batch_entry, entry, dispatch_method)
+                       for entry in request]
+            responses = [f.result() for f in futures]
+        # Notifications get no response
+        responses = [r for r in responses if r is not None]
+        if not responses:
+            raise NoMulticallResult('No result')
+        return responses
+
+    def _dispatch_batch_entry(self, entry, dispatch_method):
+        result = validate_request(entry, self.json_config)
+        if isinstance(result, Fault):
+            return result.dump()
+        response = self._marshaled_single_dispatch(entry, dispatch_method)
+        if isinstance(response, Fault):
+            return response.dump()
+        return response
+
+    def _dispatch(self, method, params, config=None):
+        t0 = time.monotonic()
+        error = True
+        try:
+            result = super()._dispatch(method, params, config)
+            error = isinstance(result, Fault)
+            return result
+        finally:
+            duration = time.monotonic() - t0
+            self.method_stats.add(method, duration, error)
+            tracing.observe('rpc.' + method, duration, error)
+
     def authenticate(self, headers):
         if self.rpc_password == '':
             # RPC authentication is disabled
@@ -0,0 +1,324 @@
+# Electrum ABC - lightweight eCash client
+# Copyright (C) 2020 The Electrum ABC developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Memory diagnostics, to find out what holds the memory of a long running
+process.
+
+- report(): memory of the process, of the caches and of the data
+  structures of the wallets (see wallet_sizes()).
+- take_snapshot(), top() and diff(): tracemalloc snapshots of the
+  allocation sites, and the difference between two of them. Tracing starts
+  with the first snapshot and slows the process down until stop_tracing().
+- object_counts(): the number of live objects of each type, and the change
+  since the previous call.
+
+Everything is computed on demand, with the "memstats", "memsnapshot",
+"memdiff" and "memobjects" commands (also available in the Qt console)
+and the "daemon memory" command.
+"""
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+
+from .caches import all_caches_stats, get_object_size
+
+# Number of snapshots kept, the oldest are forgotten first
+MAX_SNAPSHOTS = 8
+
+_lock = threading.Lock()
+_snapshots = OrderedDict()  # name -> (time, tracemalloc.Snapshot)
+_snapshot_counter = 0
+_last_counts = None
+
+# Ignore the allocations of tracemalloc itself and of the import machinery
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def process_memory():
+    ''' Resident set size of the process and its peak, in bytes, where
+    the platform tells. '''
+    result = {}
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            result['rss'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return result
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    result['peak_rss'] = peak if sys.platform == 'darwin' else peak * 1024
+    return result
+
+
+# ---------------------------------------------------------------------------
+# tracemalloc snapshots
+
+def is_tracing():
+    return tracemalloc.is_tracing()
+
+
+def start_tracing(nframes=1):
+    ''' Returns False if tracemalloc was already tracing. '''
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(nframes)
+    return True
+
+
+def stop_tracing():
+    ''' Stops tracemalloc and forgets the snapshots. '''
+    with _lock:
+        _snapshots.clear()
+    tracemalloc.stop()
+
+
+def snapshot_names():
+    with _lock:
+        return list(_snapshots)
+
+
+def take_snapshot(name=None):
+    ''' Takes and keeps a tracemalloc snapshot, starting tracemalloc if
+    needed: allocations made before that are not seen. Returns a summary
+    of the snapshot. '''
+    global _snapshot_counter
+    start_tracing()
+    snapshot = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+    with _lock:
+        _snapshot_counter += 1
+        name = name or 'snapshot-{}'.format(_snapshot_counter)
+        _snapshots.pop(name, None)
+        _snapshots[name] = (time.time(), snapshot)
+        while len(_snapshots) > MAX_SNAPSHOTS:
+            _snapshots.popitem(last=False)
+    return _summary(name, snapshot)
+
+
+def _get_snapshot(name):
+    with _lock:
+        if name is None:
+            if not _snapshots:
+                raise KeyError('no snapshot, take one first')
+            name = next(reversed(_snapshots))
+        try:
+            return name, _snapshots[name][1]
+        except KeyError:
+            raise KeyError('unknown snapshot {!r}, snapshots: {}'.format(name, ', '.join(_snapshots) or 'none')) from None
+
+
+def _summary(name, snapshot):
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'name': name,
+        'size': sum(trace.size for trace in snapshot.traces),
+        'blocks': len(snapshot.traces),
+        'traced_current': current,
+        'traced_peak': peak,
+    }
+
+
+def _where(stat):
+    frame = stat.traceback[0]
+    return '{}:{}'.format(frame.filename, frame.lineno)
+
+
+def top(name=None, *, key_type='lineno', limit=20):
+    ''' The biggest allocation sites of a snapshot (by default, the last
+    one). key_type is 'lineno' or 'filename'. '''
+    name, snapshot = _get_snapshot(name)
+    stats = snapshot.statistics(key_type)[:limit]
+    return dict(_summary(name, snapshot), top=[
+        {'where': _where(stat), 'size': stat.size, 'count': stat.count}
+        for stat in stats
+    ])
+
+
+def diff(old, new=None, *, key_type='lineno', limit=20):
+    ''' The allocation sites that grew or shrank the most between the
+    snapshots old and new. Without new, a new snapshot is taken. '''
+    old, old_snapshot = _get_snapshot(old)
+    if new is None:
+        new = take_snapshot()['name']
+    new, new_snapshot = _get_snapshot(new)
+    stats = new_snapshot.compare_to(old_snapshot, key_type)[:limit]
+    return {
+        'old': old,
+        'new': new,
+        'size_diff': (sum(trace.size for trace in new_snapshot.traces)
+                      - sum(trace.size for trace in old_snapshot.traces)),
+        'top': [
+            {'where': _where(stat), 'size': stat.size, 'size_diff': stat.size_diff,
+             'count': stat.count, 'count_diff': stat.count_diff}
+            for stat in stats
+        ],
+    }
+
+
+# ---------------------------------------------------------------------------
+# Object counts
+
+def _type_name(obj):
+    t = type(obj)
+    return '{}.{}'.format(t.__module__, t.__qualname__)
+
+
+def count_objects(classes=None):
+    ''' Number of live objects tracked by the garbage collector, by type
+    name. Scalars like str and int are not tracked. With classes, only
+    counts the instances of these classes, by class name. '''
+    gc.collect()
+    if classes is None:
+        return Counter(_type_name(obj) for obj in gc.get_objects())
+    classes = tuple(classes)
+    counts = Counter()
+    for obj in gc.get_objects():
+        if isinstance(obj, classes):
+            for class_ in classes:
+                if isinstance(obj, class_):
+                    counts[class_.__name__] += 1
+    return counts
+
+
+def object_counts(limit=30):
+    ''' The most common types of live objects, with the change of their
+    count since the previous call. '''
+    global _last_counts
+    counts = count_objects()
+    with _lock:
+        last, _last_counts = _last_counts, counts
+    deltas = Counter(counts)
+    if last is not None:
+        deltas.subtract(last)
+    changed = sorted((name for name, n in deltas.items() if n), key=lambda name: -abs(deltas[name]))
+    return {
+        'total': sum(counts.values()),
+        'top': [{'type': name, 'count': n} for name, n in counts.most_common(limit)],
+        'deltas': ([{'type': name, 'count': counts[name], 'delta': deltas[name]}
+                    for name in changed[:limit]] if last is not None else None),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Wallets
+
+def _storage_data(wallet):
+    # WalletStorage.put() changes the dict under the storage lock, and not
+    # the wallet lock, e.g. from the writer thread: walk a shallow copy made
+    # under it. put() stores copies of the values, and does not change them
+    # afterwards.
+    with wallet.storage.lock:
+        return dict(wallet.storage.data)
+
+
+def _storage_raw(wallet):
+    with wallet.storage.lock:
+        return wallet.storage.raw
+
+
+# (name, getter) of the data structures of a wallet
+WALLET_STRUCTURES = (
+    ('storage', _storage_data),
+    ('storage_raw', _storage_raw),
+    ('transactions', lambda w: w.transactions),
+    ('txi', lambda w: w.txi),
+    ('txo', lambda w: w.txo),
+    ('pruned_txo', lambda w: w.pruned_txo),
+    ('tx_fees', lambda w: w.tx_fees),
+    ('history', lambda w: w._history),
+    ('tx_addr_hist', lambda w: w.tx_addr_hist),
+    ('verified_tx', lambda w: w.verified_tx),
+    ('unverified_tx', lambda w: w.unverified_tx),
+    ('spv_proofs', lambda w: w.spv_proofs),
+    ('addresses', lambda w: w.get_addresses()),
+    ('addr_balance_cache', lambda w: w._addr_bal_cache),
+    ('frozen_coins', lambda w: w.frozen_coins),
+    ('labels', lambda w: w.labels),
+    ('slp_validity', lambda w: w.slp.validity),
+    ('slp_token_quantities', lambda w: w.slp.token_quantities),
+    ('slp_txo_byaddr', lambda w: w.slp.txo_byaddr),
+    ('slp_txo_token_id', lambda w: w.slp.txo_token_id),
+    ('cashacct_wallet_reg_tx', lambda w: w.cashacct.wallet_reg_tx),
+    ('cashacct_ext_reg_tx', lambda w: w.cashacct.ext_reg_tx),
+    ('cashacct_v_tx', lambda w: w.cashacct.v_tx),
+    ('cashacct_v_by_addr', lambda w: w.cashacct.v_by_addr),
+    ('cashacct_v_by_name', lambda w: w.cashacct.v_by_name),
+)
+
+
+def wallet_sizes(wallet):
+    ''' The number of items and the deep size in bytes of each data
+    structure of the wallet. Each structure is measured on its own: objects
+    shared by several of them, e.g. the addresses, count in each.
+
+    This holds the wallet lock while walking every object of the wallet,
+    which takes a while on large wallets, and the storage lock only while
+    copying the top of the storage data. '''
+    result = OrderedDict()
+    with wallet.lock:
+        for name, getter in WALLET_STRUCTURES:
+            try:
+                obj = getter(wallet)
+            except AttributeError:
+                # e.g. a wallet type without this structure
+                continue
+            if obj is None:
+                continue
+            result[name] = {
+                'items': len(obj),
+                'bytes': get_object_size(obj),
+            }
+    return result
+
+
+def report(wallets=()):
+    ''' Memory of the process, of the garbage collector, of tracemalloc,
+    of the caches, and of the data structures of the wallets. '''
+    traced_current, traced_peak = tracemalloc.get_traced_memory()
+    return {
+        'process': process_memory(),
+        'gc': {
+            'objects': len(gc.get_objects()),
+            'garbage': len(gc.garbage),
+            'counts': gc.get_count(),
+        },
+        'tracemalloc': {
+            'tracing': tracemalloc.is_tracing(),
+            'current': traced_current,
+            'peak': traced_peak,
+            'snapshots': snapshot_names(),
+        },
+        'caches': all_caches_stats(),
+        'wallets': {wallet.diagnostic_name(): wallet_sizes(wallet) for wallet in wallets},
+    }
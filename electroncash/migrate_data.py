@@ -11,12 +11,10 @@ import os
 import shutil
 from typing import Optional
 
-from .network import DEFAULT_WHITELIST_SERVERS_ONLY, DEFAULT_AUTO_CONNECT
 from .simple_config import read_user_config, save_user_config, SimpleConfig
 from .util import get_user_dir
 from .version import VERSION_TUPLE, PACKAGE_VERSION
 
-from electroncash_plugins.fusion.conf import DEFAULT_SERVERS
 
 _logger = logging.getLogger(__name__)
 
@@ -89,6 +87,7 @@ def replace_src_dest_in_config(src: str, dest: str, config: dict):
 def reset_server_config(config: dict):
     # Reset server selection policy to make sure we don't start on the
     # wrong chain.
+    from .network import DEFAULT_WHITELIST_SERVERS_ONLY, DEFAULT_AUTO_CONNECT
     config["whitelist_servers_only"] = DEFAULT_WHITELIST_SERVERS_ONLY
     config["auto_connect"] = DEFAULT_AUTO_CONNECT
     config["server"] = ""
@@ -201,6 +200,7 @@ def update_config():
         previous_host = config["cashfusion_server"][0]
         if previous_host in INVALID_FUSION_HOSTS:
             _logger.info("Updating default CashFusion server")
+            from electroncash_plugins.fusion.conf import DEFAULT_SERVERS
             config["cashfusion_server"] = DEFAULT_SERVERS[0]
 
     # Migrate all users to the XEC unit
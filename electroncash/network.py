@@ -45,6 +45,10 @@ from . import networks
 from .i18n import _
 from .interface import Connection, Interface
 from . import blockchain
+from .header_sync import HeaderSyncScheduler
+from .request_multiplexer import RequestMultiplexer
+from .server_health import ServerHealth
+from . import tracing
 from . import version
 from .tor import TorController, check_proxy_bypass_tor_control
 from .utils import Event
@@ -113,9 +117,15 @@ def get_eligible_servers(hostmap=None, protocol="s", exclude_set=set()):
         hostmap = networks.net.DEFAULT_SERVERS
     return list(set(filter_protocol(hostmap, protocol)) - exclude_set)
 
-def pick_random_server(hostmap = None, protocol = 's', exclude_set = set()):
+def pick_random_server(hostmap = None, protocol = 's', exclude_set = set(), health = None):
+    '''Pick a random eligible server. If a ServerHealth instance is given,
+    servers with a better health score are more likely to be picked.'''
     eligible = get_eligible_servers(hostmap, protocol, exclude_set)
-    return random.choice(eligible) if eligible else None
+    if not eligible:
+        return None
+    if health is not None:
+        return health.pick_weighted(eligible)
+    return random.choice(eligible)
 
 def servers_to_hostmap(servers):
     ''' Takes an iterable of HOST:PORT:PROTOCOL strings and breaks them into
@@ -277,6 +287,7 @@ class Network(util.DaemonThread):
         self.debug = False
         self.irc_servers = {} # returned by interface (list from irc)
         self.recent_servers = self.read_recent_servers()
+        self.server_health = ServerHealth(self.server_health_file())
 
         self.banner = ''
         self.donation_address = ''
@@ -284,6 +295,8 @@ class Network(util.DaemonThread):
         # callbacks passed with subscriptions
         self.subscriptions = defaultdict(list)
         self.sub_cache = {}                     # note: needs self.interface_lock
+        # identical client requests from several wallets are sent only once
+        self.multiplexer = RequestMultiplexer()
         # callbacks set by the GUI
         self.callbacks = defaultdict(list)
 
@@ -307,6 +320,7 @@ class Network(util.DaemonThread):
         self.auto_connect = self.config.get('auto_connect', DEFAULT_AUTO_CONNECT)
         self.connecting = set()
         self.requested_chunks = set()
+        self.header_sync = HeaderSyncScheduler(self)
         self.socket_queue = queue.Queue()
         if Network.INSTANCE:
             # This happens on iOS which kills and restarts the daemon on app sleep/wake
@@ -402,6 +416,11 @@ class Network(util.DaemonThread):
     def recent_servers_file(self):
         return os.path.join(self.config.path, "recent-servers")
 
+    def server_health_file(self):
+        if not self.config.path:
+            return None
+        return os.path.join(self.config.path, "recent-servers-health")
+
     def read_recent_servers(self):
         if not self.config.path:
             return []
@@ -421,6 +440,7 @@ class Network(util.DaemonThread):
                 f.write(s)
         except:
             pass
+        self.server_health.save()
 
     def get_server_height(self):
         with self.interface_lock:
@@ -450,13 +470,19 @@ class Network(util.DaemonThread):
     def is_up_to_date(self):
         return self.unanswered_requests == {}
 
-    def queue_request(self, method, params, interface=None, *, callback=None, max_qlen=None):
+    def queue_request(self, method, params, interface=None, *, callback=None, max_qlen=None, share=True):
         """ If you want to queue a request on any interface it must go through
         this function so message ids are properly tracked.
         Returns the monotonically increasing message id for this request.
         May return None if queue is too full (max_qlen). (max_qlen is only
         considered if callback is not None.)
 
+        Client requests for the primary interface that only depend on their
+        params (see request_multiplexer.py) are shared: if an identical
+        request is already in flight the callback is attached to it, and
+        cached results are delivered from the network loop. Pass share=False
+        to always send the request.
+
         Note that the special argument interface='random' will queue the request
         on a random, currently active (connected) interface.  Otherwise
         `interface` should be None or a valid Interface instance.
@@ -467,11 +493,20 @@ class Network(util.DaemonThread):
               later when an interface becomes available
             - If callback is not supplied: an AssertionError exception is raised
         """
+        if (callback and share and interface is None
+                and self.multiplexer.is_shareable(method)):
+            if max_qlen and len(self.unanswered_requests) >= max_qlen:
+                return None
+            if self.multiplexer.submit(method, params, callback):
+                tracing.count('network.requests_shared')
+                return self.message_id()
         if interface is None:
             interface = self.interface
         elif interface == 'random':
-            interface = random.choice(self.get_interfaces(interfaces=True)
-                                      or (None,))  # may set interface to None if no interfaces
+            # favour fast servers, may set interface to None if no interfaces
+            with self.interface_lock:
+                interface = self.interfaces.get(
+                    self.server_health.pick_weighted(self.interfaces.keys()))
         message_id = self.message_id() # Note: self.message_id is a Monotonic (thread-safe) counter-object, see util.Monotonic
         if callback:
             if max_qlen and len(self.unanswered_requests) >= max_qlen:
@@ -487,6 +522,7 @@ class Network(util.DaemonThread):
         if self.debug:
             self.print_error(interface.host, "-->", method, params, message_id)
         interface.queue_request(method, params, message_id)
+        tracing.count('network.requests')
         if self is not Network.INSTANCE:
             self.print_error("*** WARNING: queueing request on a stale instance!")
         return message_id
@@ -497,7 +533,7 @@ class Network(util.DaemonThread):
         old_reqs = self.unanswered_requests
         self.unanswered_requests = {}
         for m_id, request in old_reqs.items():
-            message_id = self.queue_request(request[0], request[1], callback = request[2])
+            message_id = self.queue_request(request[0], request[1], callback = request[2], share = False)
             assert message_id is not None
         self.queue_request('server.banner', [])
         self.queue_request('server.donation_address', [])
@@ -591,6 +627,7 @@ class Network(util.DaemonThread):
                 self.print_error("connecting to %s as new interface" % server_key)
                 self.set_status('connecting')
             self.connecting.add(server_key)
+            self.server_health.connect_started_now(server_key)
             c = Connection(server_key, self.socket_queue, self.config.path,
                            lambda x: x.bad_certificate.append_weak(self.on_bad_certificate))
 
@@ -604,7 +641,8 @@ class Network(util.DaemonThread):
     def start_random_interface(self):
         exclude_set = self.get_unavailable_servers()
         hostmap = self.get_servers() if not self.is_whitelist_only() else self.whitelisted_servers_hostmap
-        server_key = pick_random_server(hostmap, self.protocol, exclude_set)
+        server_key = pick_random_server(hostmap, self.protocol, exclude_set,
+                                        health=self.server_health)
         if server_key:
             self.start_interface(server_key)
 
@@ -657,6 +695,7 @@ class Network(util.DaemonThread):
             self.connecting = set()
             # Get a new queue - no old pending connections thanks!
             self.socket_queue = queue.Queue()
+        self.server_health.save()
 
     def set_parameters(self, host, port, protocol, proxy, auto_connect):
         with self.interface_lock:
@@ -715,12 +754,13 @@ class Network(util.DaemonThread):
         return server
 
     def switch_to_random_interface(self):
-        """Switch to a random connected server other than the current one"""
+        """Switch to a connected server other than the current one, picked
+        at random among those with the best health score"""
         servers = self.get_interfaces()    # Those in connected state
         if self.default_server in servers:
             servers.remove(self.default_server)
         if servers:
-            self.switch_to_interface(random.choice(servers))
+            self.switch_to_interface(self.server_health.pick_best(servers))
 
     def switch_lagging_interface(self):
         """If auto_connect and lagging, switch interface"""
@@ -729,7 +769,7 @@ class Network(util.DaemonThread):
             header = self.blockchain().read_header(self.get_local_height())
             filtered = list(map(lambda x:x[0], filter(lambda x: x[1].tip_header==header, self.interfaces.items())))
             if filtered:
-                choice = random.choice(filtered)
+                choice = self.server_health.pick_best(filtered)
                 self.switch_to_interface(choice, self.SWITCH_LAGGING)
 
     SWITCH_DEFAULT = 'SWITCH_DEFAULT'
@@ -843,6 +883,7 @@ class Network(util.DaemonThread):
 
     def process_responses(self, interface):
         responses = interface.get_responses()
+        tracing.count('network.responses', len(responses))
         for request, response in responses:
             if request:
                 method, params, message_id = request
@@ -887,8 +928,13 @@ class Network(util.DaemonThread):
             if method.endswith('.subscribe'):
                 with self.interface_lock:
                     self.sub_cache[k] = response
+            # Other wallets waiting for the same request
+            shared = self.multiplexer.on_response(method, params, response) if request else ()
             # Response is now in canonical form
             self.process_response(interface, request, response, callbacks)
+            for callback, r in shared:
+                if callback not in callbacks:
+                    callback(r)
 
     def subscribe_to_scripthashes(self, scripthashes, callback):
         msgs = [('blockchain.scripthash.subscribe', [sh])
@@ -906,6 +952,10 @@ class Network(util.DaemonThread):
                 self.pending_sends.append((messages, callback))
 
     def process_pending_sends(self):
+        # Deliver the responses to shared requests served from the cache
+        for callback, response in self.multiplexer.pop_ready():
+            callback(response)
+
         # Requests needs connectivity.  If we don't have an interface,
         # we cannot process them.
         if not self.interface:
@@ -942,6 +992,38 @@ class Network(util.DaemonThread):
                     ct += 1
         return ct
 
+    def unsubscribe_from_scripthashes(self, scripthashes, callback):
+        '''Removes callback from the subscriptions to scripthashes. A
+        scripthash left with no callbacks is forgotten: it is not subscribed
+        to again on the next server, and until then its notifications are
+        ignored (see unsubscribe).'''
+        method = 'blockchain.scripthash.subscribe'
+        scripthashes = set(scripthashes)
+        with self.pending_sends_lock:
+            sends = []
+            for messages, _callback in self.pending_sends:
+                if _callback == callback:
+                    messages = [(m, params) for m, params in messages
+                                if m != method or params[0] not in scripthashes]
+                    if not messages:
+                        continue
+                sends.append((messages, _callback))
+            self.pending_sends = sends
+        defunct = []
+        with self.lock:
+            for h in scripthashes:
+                k = self.get_index(method, [h])
+                callbacks = self.subscriptions.get(k)
+                if callbacks and callback in callbacks:
+                    callbacks.remove(callback)
+                if not callbacks:
+                    self.subscriptions.pop(k, None)
+                    self.subscribed_addresses.discard(h)
+                    defunct.append(k)
+        with self.interface_lock:
+            for k in defunct:
+                self.sub_cache.pop(k, None)
+
     def unsubscribe(self, callback):
         '''Unsubscribe a callback to free object references to enable GC.
         It is advised that this function only be called from the network thread
@@ -972,10 +1054,15 @@ class Network(util.DaemonThread):
         # If the interface ends up answering these requests, they will just
         # be safely ignored. This is better than the alternative which is to
         # keep references to an object that declared itself defunct.
-        ct = 0
+        ct = self.multiplexer.cancel(callback)
         for message_id, client_req in self.unanswered_requests.copy().items():
             if callback == client_req[2]:
-                self.unanswered_requests.pop(message_id, None) # guard against race conditions here. Note: this usually is called from the network thread but who knows what future programmers may do. :)
+                # If other wallets wait for this shared request, hand it over
+                waiter = self.multiplexer.take_waiter(client_req[0], client_req[1])
+                if waiter is not None:
+                    client_req[2] = waiter
+                else:
+                    self.unanswered_requests.pop(message_id, None) # guard against race conditions here. Note: this usually is called from the network thread but who knows what future programmers may do. :)
                 ct += 1
         ct2 = self._cancel_pending_sends(callback)
         if ct or ct2:
@@ -997,11 +1084,13 @@ class Network(util.DaemonThread):
         for b in self.blockchains.values():
             if b.catch_up == server:
                 b.catch_up = None
+        self.header_sync.on_connection_down(server)
 
     def new_interface(self, server_key, socket):
         self.add_recent_server(server_key)
 
-        interface = Interface(server_key, socket, max_message_bytes=self.MAX_MESSAGE_BYTES, config=self.config)
+        interface = Interface(server_key, socket, max_message_bytes=self.MAX_MESSAGE_BYTES, config=self.config,
+                              stats=self.server_health.get(server_key))
         interface.blockchain = None
         interface.tip_header = None
         interface.tip = 0
@@ -1015,6 +1104,8 @@ class Network(util.DaemonThread):
         self.queue_request('server.version', params, interface)
         # The interface will immediately respond with it's last known header.
         self.queue_request('blockchain.headers.subscribe', [], interface)
+        # Measure the round trip time right away for server selection
+        self.queue_request('server.ping', [], interface)
 
         if server_key == self.default_server:
             self.switch_to_interface(server_key, self.SWITCH_DEFAULT)
@@ -1026,6 +1117,7 @@ class Network(util.DaemonThread):
             server, socket = self.socket_queue.get()
             if server in self.connecting:
                 self.connecting.remove(server)
+            self.server_health.connect_finished(server, bool(socket))
             if socket:
                 self.remove_bad_certificate(server)
                 self.new_interface(server, socket)
@@ -1038,9 +1130,11 @@ class Network(util.DaemonThread):
             interfaces = list(self.interfaces.values())
         for interface in interfaces:
             if interface.has_timed_out():
+                self.server_health.record_timeout(interface.server)
                 self.connection_down(interface.server)
             elif interface.ping_required():
                 self.queue_request('server.ping', [], interface)
+        self.header_sync.check_stalled()
 
         now = time.time()
         # nodes
@@ -1112,6 +1206,8 @@ class Network(util.DaemonThread):
             # Ensure the chunk can be rerequested, but only if the request originated from us.
             if request and request[1][0] // 2016 in self.requested_chunks:
                 self.requested_chunks.remove(request[1][0] // 2016)
+            if request and self.header_sync.is_scheduled(interface, request[1][0]):
+                self.header_sync.on_request_failed(interface, request[1][0])
             return
 
         # Ignore unsolicited chunks
@@ -1158,6 +1254,13 @@ class Network(util.DaemonThread):
             self.connection_down(interface.server)
             return
 
+        if not proof_was_provided and self.header_sync.is_scheduled(interface, request_base_height):
+            # Part of a pipelined catch-up, possibly served by a helper
+            # interface. The scheduler connects chunks in height order.
+            self.header_sync.on_chunk(interface, request_base_height, bytes.fromhex(hexdata))
+            self.notify('blockchain_updated')
+            return
+
         verification_top_height = self.checkpoint_servers_verified.get(interface.server, {}).get('height', None)
         was_verification_request = verification_top_height and request_base_height == verification_top_height - 147 + 1 and actual_header_count == 147
 
@@ -1388,7 +1491,8 @@ class Network(util.DaemonThread):
         # If not finished, get the next header
         if next_height:
             if interface.mode == Interface.MODE_CATCH_UP and interface.tip > next_height:
-                self.request_headers(interface, next_height, 2016)
+                if not self.header_sync.start(interface, interface.blockchain, next_height):
+                    self.request_headers(interface, next_height, 2016)
             else:
                 self.request_header(interface, next_height)
         else:
@@ -1411,6 +1515,7 @@ class Network(util.DaemonThread):
             self.print_error("{} bad file descriptors detected and shut down: {}".format(len(bad), bad))
         return bad
 
+    @tracing.traced('network.wait_on_sockets')
     def wait_on_sockets(self):
         def try_to_recover(err):
             self.print_error("wait_on_sockets: {} raised by select() call.. trying to recover...".format(err))
@@ -1474,6 +1579,7 @@ class Network(util.DaemonThread):
     def init_headers_file(self):
         b = self.blockchains[0]
         filename = b.path()
+        b.close_mmap()
         # NB: HEADER_SIZE = 80 bytes
         length = blockchain.HEADER_SIZE * (networks.net.VERIFICATION_BLOCK_HEIGHT + 1)
         if not os.path.exists(filename) or os.path.getsize(filename) < length:
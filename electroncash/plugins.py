@@ -23,6 +23,7 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import ast
 import codecs
 import json
 import os
@@ -70,6 +71,49 @@ INTERNAL_USE_PREFIX = 'use_'
 EXTERNAL_USE_PREFIX = 'use_external_'
 
 
+def _literal_value(node):
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, (ast.List, ast.Tuple)):
+        values = [_literal_value(e) for e in node.elts]
+        return values if isinstance(node, ast.List) else tuple(values)
+    if isinstance(node, ast.Dict) and None not in node.keys:
+        return {_literal_value(k): _literal_value(v) for k, v in zip(node.keys, node.values)}
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        return _literal_value(node.left) + _literal_value(node.right)
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == '_'
+            and len(node.args) == 1 and not node.keywords):
+        # Translated later, by retranslate_internal_plugin_metadata
+        return _literal_value(node.args[0])
+    raise ValueError('not a literal: ' + ast.dump(node))
+
+
+def read_plugin_metadata(init_path):
+    """ Reads the metadata of an internal plugin from its __init__.py without
+    importing it: the names assigned a literal at the top level, where
+    _("some text") is read as "some text". Imports are ignored. Returns None
+    if the file does anything else, the package must then be imported. """
+    try:
+        with open(init_path, 'rb') as f:
+            tree = ast.parse(f.read(), init_path)
+    except (OSError, SyntaxError, ValueError):
+        return None
+    metadata = {}
+    for stmt in tree.body:
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            continue
+        if isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant):
+            continue  # docstring
+        if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1
+                and isinstance(stmt.targets[0], ast.Name)):
+            return None
+        try:
+            metadata[stmt.targets[0].id] = _literal_value(stmt.value)
+        except (ValueError, TypeError):
+            return None
+    return metadata
+
+
 class Plugins(DaemonThread):
 
     @profiler
@@ -85,6 +129,9 @@ class Plugins(DaemonThread):
         self.internal_plugin_metadata = {}
         self.external_plugins = {}
         self.external_plugin_metadata = {}
+        # daemon command -> (plugin name, is_external), for the enabled
+        # plugins that are loaded on the first use of one of their commands
+        self.deferred_daemon_commands = {}
         self.device_manager = DeviceMgr(config)
         self.load_internal_plugins()
         self.load_external_plugins()
@@ -140,8 +187,14 @@ class Plugins(DaemonThread):
             # do not load plugins that rely on untrusted servers, for now
             if name in ["labels", "cosigner_pool"]:
                 continue
-            m = loader.find_module(name).load_module(name)
-            d = m.__dict__
+            init_path = os.path.join(self.internal_plugins_pkgpath, name, '__init__.py')
+            d = read_plugin_metadata(init_path)
+            if d is None:
+                self.print_error(f"cannot read the metadata of plugin {name} statically, importing it")
+                d = loader.find_module(name).load_module(name).__dict__
+            else:
+                d['__name__'] = name
+                d['__file__'] = init_path
             if not self.register_plugin(name, d):
                 continue
             self.internal_plugin_metadata[name] = d
@@ -157,6 +210,8 @@ class Plugins(DaemonThread):
                 conf_value = True
                 self.config.set_key(conf_key, conf_value)
             if not d.get('requires_wallet_type') and conf_value:
+                if self.defer_plugin(name, d, is_external=False):
+                    continue
                 try:
                     self.load_internal_plugin(name)
                 except BaseException as e:
@@ -187,12 +242,50 @@ class Plugins(DaemonThread):
             self.external_plugin_metadata[package_name] = metadata
 
             if not metadata.get('requires_wallet_type') and self.config.get(EXTERNAL_USE_PREFIX + package_name):
+                if self.defer_plugin(package_name, metadata, is_external=True):
+                    continue
                 try:
                     self.load_external_plugin(package_name)
                 except BaseException as e:
                     traceback.print_exc(file=sys.stdout) # shouldn't this be... suppressed unless -v?
                     self.print_error(f"cannot initialize plugin {package_name} {e!r}")
 
+    def defer_plugin(self, name, metadata, *, is_external):
+        """ Whether an enabled plugin can wait until it is needed, instead of
+        being loaded at startup:
+        - the hardware wallet plugins are loaded when a keystore of their
+          type is opened (see register_keystore), or by get_hardware_support,
+        - on the command line, the plugins listing their daemon commands in
+          their metadata ('daemon_commands') are loaded on the first use of
+          one of them (see get_daemon_command). """
+        if metadata.get('registers_keystore'):
+            return True
+        commands = metadata.get('daemon_commands')
+        if self.gui_name != 'cmdline' or not commands:
+            return False
+        for cmdname in commands:
+            self.deferred_daemon_commands.setdefault(cmdname, (name, is_external))
+        self.print_error("deferred loading plugin", name)
+        return True
+
+    def get_daemon_command(self, cmdname):
+        """ The daemon command cmdname of a plugin, loading the plugin if
+        it was deferred. """
+        if cmdname not in self.daemon_commands and cmdname in self.deferred_daemon_commands:
+            name, is_external = self.deferred_daemon_commands[cmdname]
+            # All the commands of the plugin are registered when it is loaded
+            for c, v in list(self.deferred_daemon_commands.items()):
+                if v == (name, is_external):
+                    del self.deferred_daemon_commands[c]
+            try:
+                if is_external:
+                    self.load_external_plugin(name)
+                else:
+                    self.load_internal_plugin(name)
+            except BaseException as e:
+                self.print_error(f"cannot initialize plugin {name}: {e!r} {traceback.format_exc()}")
+        return self.daemon_commands.get(cmdname)
+
     def get_internal_plugin(self, name, force_load=False):
         if force_load and name not in self.internal_plugins:
             self.load_internal_plugin(name)
@@ -0,0 +1,177 @@
+# Electrum ABC - lightweight eCash client
+# Copyright (C) 2020 The Electrum ABC developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Sharing of identical client requests between wallets.
+
+When the daemon has several wallets loaded, their Synchronizer and SPV jobs
+often ask the server for exactly the same things: wallets sharing cosigners
+subscribe to the same scripthashes, fetch the same histories, transactions
+and merkle proofs. The RequestMultiplexer lets the Network send such a
+request only once while it is in flight, hand the response to every
+interested callback, and keep immutable results (raw transactions, merkle
+proofs) around for a while so that later requests are answered locally.
+"""
+from .caches import ExpiringCache
+
+# Requests with these methods only depend on their params and can be shared
+# while in flight
+SHAREABLE_METHODS = frozenset(
+    (
+        "blockchain.scripthash.subscribe",
+        "blockchain.scripthash.get_history",
+        "blockchain.transaction.get",
+        "blockchain.transaction.get_merkle",
+    )
+)
+
+# Successful responses to these methods are cached. Merkle proofs are
+# invalidated by a reorg: the verifier forgets the proofs that fail to
+# verify, and clears them all when the chain changes, see forget() and
+# clear_cache(). The timeout only bounds how long unused proofs are kept.
+CACHED_METHODS = {
+    "blockchain.transaction.get": None,
+    "blockchain.transaction.get_merkle": 600.0,
+}
+
+
+class RequestMultiplexer:
+    """Keeps track of the shareable requests in flight and of the callbacks
+    waiting for them.
+
+    Must only be used from the network thread."""
+
+    def __init__(self, *, cache_size=2000):
+        # (method, params) -> callbacks waiting on the request in flight,
+        # besides the one it was sent for
+        self.pending = {}
+        self.caches = {
+            method: ExpiringCache(
+                maxlen=cache_size, name="Network {} cache".format(method), timeout=timeout
+            )
+            for method, timeout in CACHED_METHODS.items()
+        }
+        # responses served from the cache, to be delivered from the network
+        # loop: (callback, response)
+        self.ready = []
+        # counters, for diagnostics
+        self.n_sent = 0
+        self.n_joined = 0
+        self.n_cache_hits = 0
+
+    @staticmethod
+    def key(method, params):
+        return method, tuple(params)
+
+    def is_shareable(self, method):
+        return method in SHAREABLE_METHODS
+
+    def submit(self, method, params, callback):
+        """Called before sending a shareable request. Returns True if the
+        request does not need to be sent, because callback will be served
+        from the cache or from a request already in flight."""
+        k = self.key(method, params)
+        cache = self.caches.get(method)
+        if cache is not None:
+            response = cache.get(k[1])
+            if response is not None:
+                self.n_cache_hits += 1
+                self.ready.append((callback, self._copy(response, method, params)))
+                return True
+        waiters = self.pending.get(k)
+        if waiters is not None:
+            if callback not in waiters:
+                waiters.append(callback)
+            self.n_joined += 1
+            return True
+        self.pending[k] = []
+        self.n_sent += 1
+        return False
+
+    def on_response(self, method, params, response):
+        """Called with each response to a request. Returns the extra
+        callbacks that were waiting for it."""
+        if method not in SHAREABLE_METHODS:
+            return []
+        k = self.key(method, params)
+        cache = self.caches.get(method)
+        if cache is not None and response.get("error") is None and response.get("result") is not None:
+            cache.put(k[1], response)
+        return [(cb, self._copy(response, method, params)) for cb in self.pending.pop(k, ())]
+
+    def forget(self, method, params):
+        """Removes the cached response to a request, e.g. a merkle proof
+        that did not verify."""
+        cache = self.caches.get(method)
+        if cache is not None:
+            cache.pop(self.key(method, params)[1])
+
+    def clear_cache(self, method):
+        """Removes all the cached responses to method, e.g. the merkle
+        proofs after a reorg."""
+        cache = self.caches.get(method)
+        if cache is not None:
+            cache.clear()
+
+    def take_waiter(self, method, params):
+        """Called when the callback a request was sent for gets cancelled.
+        Returns one of the other callbacks waiting for it, which should
+        become the owner of the request, or None if there are none."""
+        k = self.key(method, params)
+        waiters = self.pending.get(k)
+        if waiters:
+            return waiters.pop(0)
+        self.pending.pop(k, None)
+        return None
+
+    def cancel(self, callback):
+        """Forget callback everywhere. Returns the number of removals."""
+        ct = 0
+        for waiters in self.pending.values():
+            if callback in waiters:
+                waiters.remove(callback)
+                ct += 1
+        ready = [item for item in self.ready if item[0] != callback]
+        ct += len(self.ready) - len(ready)
+        self.ready = ready
+        return ct
+
+    def pop_ready(self):
+        ready, self.ready = self.ready, []
+        return ready
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "waiting": sum(len(w) for w in self.pending.values()),
+            "sent": self.n_sent,
+            "joined": self.n_joined,
+            "cache_hits": self.n_cache_hits,
+            "cached": {method: len(cache) for method, cache in self.caches.items()},
+        }
+
+    @staticmethod
+    def _copy(response, method, params):
+        # Each callback gets its own dict, as some of them write to it
+        response = dict(response)
+        response["method"] = method
+        response["params"] = params
+        return response
@@ -0,0 +1,290 @@
+# Electrum ABC - lightweight eCash client
+# Copyright (C) 2020 The Electrum ABC developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Per-server health model.
+
+Every server we connect to gets a ServerStats record holding its connect
+time, `server.ping` round trip time, response latency and throughput, as
+well as counts of errors, timeouts and failed connection attempts. These are
+combined into a single score (an estimate, in seconds, of how long a typical
+request takes, inflated by the failure rate) that the network uses to prefer
+fast and reliable servers. The records are persisted next to the
+`recent-servers` file so that the knowledge survives restarts.
+"""
+import json
+import os
+import random
+import threading
+import time
+
+from .util import PrintError
+
+# Weight of a new sample in the exponentially weighted moving averages
+EWMA_ALPHA = 0.3
+
+# Latency (seconds) assumed for a server we know nothing about
+DEFAULT_LATENCY = 1.0
+
+# Size of a "typical" large response (a chunk of ~1000 headers), used to turn
+# the measured throughput into a transfer time
+REFERENCE_RESPONSE_BYTES = 80_000
+
+# Only responses at least this large are used as throughput samples: for
+# small ones the transfer time is dominated by latency.
+MIN_THROUGHPUT_SAMPLE_BYTES = 16_384
+
+# How much a 100% failure rate multiplies the score
+FAILURE_WEIGHT = 4.0
+
+# When the event counters exceed this they are halved, so that the failure
+# ratio reflects recent behaviour
+MAX_EVENTS = 200
+
+# Servers whose score is within this factor of the best one are considered
+# equally good when picking the primary interface
+PREFERRED_FACTOR = 1.5
+
+# Maximum number of records kept on disk
+MAX_RECORDS = 100
+
+
+def _ewma(old, sample):
+    if old is None:
+        return sample
+    return old + EWMA_ALPHA * (sample - old)
+
+
+class ServerStats:
+    """Health counters for a single server."""
+
+    __slots__ = (
+        "connect_time",
+        "ping_rtt",
+        "latency",
+        "throughput",
+        "responses",
+        "errors",
+        "timeouts",
+        "connects",
+        "connect_failures",
+        "bytes_received",
+        "last_seen",
+    )
+
+    FLOAT_FIELDS = ("connect_time", "ping_rtt", "latency", "throughput", "last_seen")
+    COUNT_FIELDS = (
+        "responses",
+        "errors",
+        "timeouts",
+        "connects",
+        "connect_failures",
+        "bytes_received",
+    )
+
+    def __init__(self):
+        for k in self.FLOAT_FIELDS:
+            setattr(self, k, None)
+        for k in self.COUNT_FIELDS:
+            setattr(self, k, 0)
+
+    def record_connect(self, duration):
+        self.connect_time = _ewma(self.connect_time, duration)
+        self.connects += 1
+        self.last_seen = time.time()
+        self._decay()
+
+    def record_connect_failure(self):
+        self.connect_failures += 1
+        self._decay()
+
+    def record_ping(self, rtt):
+        self.ping_rtt = _ewma(self.ping_rtt, rtt)
+
+    def record_response(self, latency, size=0, error=False):
+        self.responses += 1
+        if error:
+            self.errors += 1
+        self.latency = _ewma(self.latency, latency)
+        self.bytes_received += size
+        if size >= MIN_THROUGHPUT_SAMPLE_BYTES:
+            self.throughput = _ewma(self.throughput, size / max(latency, 0.001))
+        self.last_seen = time.time()
+        self._decay()
+
+    def record_timeout(self):
+        self.timeouts += 1
+        self._decay()
+
+    def _decay(self):
+        if self.responses + self.connects + self.connect_failures + self.timeouts > MAX_EVENTS:
+            for k in ("responses", "errors", "timeouts", "connects", "connect_failures"):
+                setattr(self, k, getattr(self, k) // 2)
+
+    def failure_ratio(self):
+        failures = self.errors + self.timeouts + self.connect_failures
+        total = self.responses + self.timeouts + self.connects + self.connect_failures
+        if not total:
+            return 0.0
+        return min(1.0, failures / total)
+
+    def score(self):
+        """Estimated cost in seconds of a typical request. Lower is better."""
+        latency = self.ping_rtt
+        if latency is None:
+            latency = self.latency
+        if latency is None:
+            latency = self.connect_time
+        if latency is None:
+            latency = DEFAULT_LATENCY
+        if self.throughput:
+            latency += REFERENCE_RESPONSE_BYTES / self.throughput
+        return latency * (1.0 + FAILURE_WEIGHT * self.failure_ratio())
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.FLOAT_FIELDS + self.COUNT_FIELDS}
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls()
+        for k in cls.FLOAT_FIELDS:
+            v = d.get(k)
+            if isinstance(v, (int, float)) and v >= 0:
+                setattr(stats, k, float(v))
+        for k in cls.COUNT_FIELDS:
+            v = d.get(k)
+            if isinstance(v, int) and v >= 0:
+                setattr(stats, k, v)
+        return stats
+
+
+class ServerHealth(PrintError):
+    """Registry of ServerStats keyed by 'host:port:protocol' server string.
+
+    Updated from the network thread; snapshot() and save() may be called from
+    any thread."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stats = {}
+        # server -> time the connection attempt was started
+        self.connect_started = {}
+        self.load()
+
+    def diagnostic_name(self):
+        return "ServerHealth"
+
+    def get(self, server):
+        """Return the ServerStats for server, creating it if needed."""
+        with self.lock:
+            stats = self.stats.get(server)
+            if stats is None:
+                stats = self.stats[server] = ServerStats()
+            return stats
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict):
+            return
+        with self.lock:
+            for server, d in data.items():
+                if isinstance(server, str) and isinstance(d, dict):
+                    self.stats[server] = ServerStats.from_dict(d)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            # keep the most recently seen servers
+            items = sorted(
+                self.stats.items(), key=lambda kv: kv[1].last_seen or 0, reverse=True
+            )[:MAX_RECORDS]
+            s = json.dumps({k: v.to_dict() for k, v in items}, indent=4, sort_keys=True)
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(s)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            self.print_error("failed to save:", repr(e))
+
+    def snapshot(self, server):
+        """Return a JSON-friendly dict describing server, or None if it is
+        unknown."""
+        with self.lock:
+            stats = self.stats.get(server)
+            if stats is None:
+                return None
+            d = stats.to_dict()
+        d["failure_ratio"] = round(stats.failure_ratio(), 3)
+        d["score"] = round(stats.score(), 4)
+        return d
+
+    def score(self, server):
+        with self.lock:
+            stats = self.stats.get(server)
+        return stats.score() if stats is not None else DEFAULT_LATENCY
+
+    # Connection attempts
+
+    def connect_started_now(self, server):
+        self.connect_started[server] = time.time()
+
+    def connect_finished(self, server, ok):
+        started = self.connect_started.pop(server, None)
+        stats = self.get(server)
+        if not ok:
+            stats.record_connect_failure()
+        elif started is not None:
+            stats.record_connect(time.time() - started)
+
+    def record_timeout(self, server):
+        self.get(server).record_timeout()
+
+    # Selection
+
+    def pick_best(self, servers, rng=random):
+        """Pick a server for the primary interface: a random one among those
+        whose score is within PREFERRED_FACTOR of the best score."""
+        servers = list(servers)
+        if not servers:
+            return None
+        scores = {s: self.score(s) for s in servers}
+        best = min(scores.values())
+        preferred = [s for s in servers if scores[s] <= best * PREFERRED_FACTOR]
+        return rng.choice(preferred)
+
+    def pick_weighted(self, servers, rng=random):
+        """Pick a server with a probability inversely proportional to its
+        score, used to spread load while favouring fast servers. Servers we
+        know nothing about still get a fair chance of being tried."""
+        servers = list(servers)
+        if not servers:
+            return None
+        weights = [1.0 / max(self.score(s), 0.001) for s in servers]
+        return rng.choices(servers, weights=weights)[0]
@@ -1,7 +1,9 @@
+import atexit
 import json
 import threading
 import os
 import stat
+import weakref
 from decimal import Decimal as PyDecimal
 
 from . import util
@@ -24,6 +26,15 @@ def set_config(c):
 
 FINAL_CONFIG_VERSION = 2
 
+# The configs with changes not written yet, flushed at exit
+_unflushed_configs = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all():
+    for c in list(_unflushed_configs):
+        c.flush()
+
 
 class SimpleConfig(PrintError):
     """
@@ -42,6 +53,10 @@ class SimpleConfig(PrintError):
     slider_steps: int = 10
     """Number of possible equidistant fee rate settings (starting with
     max_slider_fee / slider_steps)"""
+    flush_delay: float = 1.0
+    """Seconds between a change of the user config and the write of the
+    config file, from a background thread. All the changes made in the
+    meantime are written at once."""
 
     def __init__(self, options=None, read_user_config_function=None,
                  read_user_dir_function=None):
@@ -52,6 +67,15 @@ class SimpleConfig(PrintError):
         # This lock needs to be acquired for updating and reading the config in
         # a thread-safe way.
         self.lock = threading.RLock()
+        # Serializes the writes of the config file. Never acquire self.lock
+        # while holding it.
+        self.flush_lock = threading.Lock()
+        self.dirty = False
+        self.flush_timer = None
+        # Versions of the user config snapshotted and written by flush(), so
+        # that an older snapshot never overwrites a newer one
+        self.flushed_version = 0
+        self.written_version = 0
 
         # The following two functions are there for dependency injection when
         # testing.
@@ -130,7 +154,7 @@ class SimpleConfig(PrintError):
             else:
                 self.user_config.pop(key, None)
             if save:
-                self.save_user_config()
+                self.schedule_flush()
 
     def get(self, key, default=None):
         with self.lock:
@@ -188,10 +212,53 @@ class SimpleConfig(PrintError):
     def is_modifiable(self, key):
         return key not in self.cmdline_options
 
+    def schedule_flush(self):
+        """Marks the user config as changed, it is written by flush() after
+        flush_delay seconds, unless flushed earlier."""
+        with self.lock:
+            self.dirty = True
+            if self.flush_timer is not None:
+                return
+            _unflushed_configs.add(self)
+            self.flush_timer = threading.Timer(self.flush_delay, self.flush)
+            self.flush_timer.name = 'SimpleConfig.flush'
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def flush(self):
+        """Writes the user config now if it changed since the last write.
+        Call it where other processes must see the change right away, and
+        at shutdown."""
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            _unflushed_configs.discard(self)
+            if not self.dirty or not self.path:
+                return
+            self.dirty = False
+            self.flushed_version += 1
+            version = self.flushed_version
+            text = json.dumps(self.user_config, indent=4, sort_keys=True)
+        with self.flush_lock:
+            if version < self.written_version:
+                return
+            try:
+                _write_user_config(text, self.path)
+                self.written_version = version
+                return
+            except OSError as e:
+                self.print_error("Warning: cannot write config file:", repr(e))
+        # Try again on the next change, or at exit
+        with self.lock:
+            self.dirty = True
+            _unflushed_configs.add(self)
+
     def save_user_config(self):
-        if not self.path:
-            return
-        save_user_config(self.user_config, self.path)
+        """Writes the user config now."""
+        with self.lock:
+            self.dirty = True
+        self.flush()
 
     def get_new_wallet_directory(self):
         """Return the path to the directory where new wallets are saved.
@@ -337,8 +404,17 @@ def save_user_config(config: dict, path: str):
 
     :param config: Configuration dictionary.
     """
+    _write_user_config(json.dumps(config, indent=4, sort_keys=True), path)
+
+
+def _write_user_config(text: str, path: str):
+    """Replaces the config file atomically: it is either the old or the new
+    config, never a truncated file."""
     config_path = os.path.join(path, "config")
-    s = json.dumps(config, indent=4, sort_keys=True)
-    with open(config_path, "w", encoding='utf-8') as f:
-        f.write(s)
-    os.chmod(config_path, stat.S_IREAD | stat.S_IWRITE)
+    temp_path = config_path + ".tmp"
+    with open(temp_path, "w", encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(temp_path, stat.S_IREAD | stat.S_IWRITE)
+    os.replace(temp_path, config_path)
@@ -25,7 +25,10 @@
 # SOFTWARE.
 import os
 import ast
+import atexit
 import threading
+import time
+import weakref
 import json
 import copy
 import re
@@ -50,6 +53,18 @@ FINAL_SEED_VERSION = 17     # electrum >= 2.7 will set this to prevent
 
 TMP_SUFFIX = ".tmp.{}".format(os.getpid())
 
+# The save schedulers with data not saved yet, flushed at exit
+_unflushed_schedulers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all():
+    for scheduler in list(_unflushed_schedulers):
+        try:
+            scheduler.flush()
+        except Exception as e:
+            scheduler.print_error("Warning: cannot save wallet:", repr(e))
+
 
 def multisig_type(wallet_type):
     '''If wallet_type is mofn multi-sig, return [m, n],
@@ -76,6 +91,17 @@ class WalletStorage(PrintError):
         self.print_error("wallet path", path)
         self.manual_upgrades = manual_upgrades
         self.lock = threading.RLock()
+        # Serializes the writes of the wallet file. Never acquire self.lock
+        # while holding it.
+        self.write_lock = threading.Lock()
+        # Notified with write_lock held when a write is done
+        self.write_done = threading.Condition(self.write_lock)
+        # Versions of the data serialized, written, and done being written
+        # (or failed) by write(), so that an older serialization never
+        # overwrites a newer one
+        self.write_version = 0
+        self.written_version = 0
+        self.done_version = 0
         self.data = {}
         self._file_exists = in_memory_only or (self.path and os.path.exists(self.path))
         self.modified = False
@@ -251,17 +277,47 @@ class WalletStorage(PrintError):
 
     @profiler
     def write(self):
+        """Writes the wallet file now, if the storage was modified. This can
+        be called from any thread: the file is replaced atomically. When it
+        returns, the data is on disk, even if another thread was writing
+        it."""
         if self._in_memory_only:
             return
         with self.lock:
-            self._write()
+            if self.modified:
+                s = self._serialize()
+                self.modified = False
+                self.write_version += 1
+            else:
+                s = None
+            version = self.write_version
+        if s is None:
+            # Wait for the thread writing the latest serialization, if any
+            with self.write_done:
+                self.write_done.wait_for(lambda: self.done_version >= version)
+                if self.written_version >= version:
+                    return
+            # it failed
+            return self.write()
+        # The file is written without holding self.lock, so that the other
+        # threads can keep using the storage meanwhile
+        try:
+            with self.write_done:
+                if version > self.written_version:
+                    self._write(s)
+                    self.written_version = version
+                # else a newer serialization was already written
+        except BaseException:
+            # write it again next time
+            with self.lock:
+                self.modified = True
+            raise
+        finally:
+            with self.write_done:
+                self.done_version = max(self.done_version, version)
+                self.write_done.notify_all()
 
-    def _write(self):
-        if threading.currentThread().isDaemon():
-            self.print_error('warning: daemon thread cannot write wallet')
-            return
-        if not self.modified:
-            return
+    def _serialize(self):
         s = json.dumps(self.data,
                        indent=None if self.pubkey else 4,  # Fast settings if encrypted,
                        sort_keys=not self.pubkey)          # readable settings otherwise.
@@ -271,7 +327,9 @@ class WalletStorage(PrintError):
             enc_magic = self._get_encryption_magic()
             s = bitcoin.encrypt_message(c, self.pubkey, enc_magic)
             s = s.decode('utf8')
+        return s
 
+    def _write(self, s):
         temp_path = self.path + TMP_SUFFIX
         with open(temp_path, "w", encoding='utf-8') as f:
             f.write(s)
@@ -293,7 +351,6 @@ class WalletStorage(PrintError):
         self.raw = s
         self._file_exists = True
         self.print_error("saved", self.path)
-        self.modified = False
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -638,3 +695,114 @@ class WalletStorage(PrintError):
                 # creation was complete if electrum was run from source
                 msg += "\nPlease open this file with Electrum 1.9.8, and move your coins to a new wallet."
         raise BaseException(msg)
+
+
+class SaveScheduler(PrintError):
+    """Saves a wallet storage from a dedicated writer thread.
+
+    Instead of writing the wallet file themselves, callers mark what changed
+    with mark_dirty(). At most max_delay seconds later, the writer thread
+    saves everything marked in the meantime at once: it calls the savers of
+    the dirty data, which put it in the storage, then writes the storage.
+
+    flush() is a durable barrier: when it returns, everything marked dirty
+    before the call is on disk."""
+
+    max_delay: float = 5.0
+    """Maximum number of seconds between marking data dirty and writing it
+    to the wallet file."""
+
+    def __init__(self, storage, savers=None):
+        """savers: dict of name -> function putting this data in the
+        storage. They are called from the writer thread, in this order."""
+        self.storage = storage
+        self.savers = dict(savers or {})
+        # Protects pending, dirty_since and thread, and wakes up the writer
+        # thread
+        self.cond = threading.Condition()
+        # Held while saving, by the writer thread or by flush()
+        self.save_lock = threading.Lock()
+        self.pending = set()
+        # time.monotonic() of the oldest mark not saved yet, or None
+        self.dirty_since = None
+        self.thread = None
+
+    def diagnostic_name(self):
+        return "SaveScheduler/" + os.path.basename(self.storage.path or "")
+
+    def mark_dirty(self, *names):
+        """Marks the data of the savers names as changed, to be saved by the
+        writer thread within max_delay. Without names, only writes what was
+        already put in the storage."""
+        with self.cond:
+            self._mark(names)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="SaveScheduler", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def _mark(self, names):
+        for name in names:
+            if name not in self.savers:
+                raise ValueError("unknown saver: {}".format(name))
+        self.pending.update(names)
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+        _unflushed_schedulers.add(self)
+
+    def run(self):
+        me = threading.current_thread()
+        while True:
+            with self.cond:
+                while self.thread is me:
+                    if self.dirty_since is None:
+                        self.cond.wait()
+                        continue
+                    delay = self.dirty_since + self.max_delay - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                if self.thread is not me:
+                    # stopped
+                    return
+            try:
+                self._save()
+            except Exception as e:
+                # the data is marked dirty again, try again later
+                self.print_error("Warning: cannot save wallet:", repr(e))
+
+    def _save(self):
+        with self.save_lock:
+            with self.cond:
+                names, self.pending = self.pending, set()
+                self.dirty_since = None
+                _unflushed_schedulers.discard(self)
+            try:
+                for name, saver in self.savers.items():
+                    if name in names:
+                        saver()
+                self.storage.write()
+            except BaseException:
+                with self.cond:
+                    self._mark(names)
+                raise
+
+    def flush(self, *names):
+        """Saves and writes now, in the calling thread, everything marked
+        dirty so far and the data of the savers names. Use it where the
+        wallet file must be up to date, e.g. after broadcasting a
+        transaction. Never call it while holding the locks used by the
+        savers, e.g. the wallet lock."""
+        with self.cond:
+            self._mark(names)
+        self._save()
+
+    def stop(self, *names):
+        """Stops the writer thread and flushes. The next mark_dirty() starts
+        it again."""
+        with self.cond:
+            thread, self.thread = self.thread, None
+            self.cond.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush(*names)
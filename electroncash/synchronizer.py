@@ -26,6 +26,9 @@
 
 from threading import Lock
 import hashlib
+import heapq
+import itertools
+import time
 import traceback
 
 from .transaction import Transaction
@@ -33,6 +36,139 @@ from .util import ThreadJob, bh2u
 from . import networks
 from .bitcoin import InvalidXKeyFormat
 
+# Default maximum number of blockchain.transaction.get requests in flight
+DEFAULT_MAX_TX_REQUESTS = 100
+
+# Confirmed transactions at most this many blocks below the local chain tip
+# are downloaded before the ones needed to resolve pruned_txo entries
+RECENT_BLOCKS = 6
+
+# Minimum interval in seconds between two sync_progress callbacks
+PROGRESS_INTERVAL = 0.5
+
+# Download priorities, lowest first
+PRIORITY_UNCONFIRMED = 0
+PRIORITY_RECENT = 1
+PRIORITY_PRUNED = 2
+PRIORITY_DEFAULT = 3
+
+
+def _status_bytes(entries):
+    return ''.join(tx_hash + ':%d:' % height for tx_hash, height in entries).encode('ascii')
+
+
+class AddressStatusCache:
+    '''Computes Electrum protocol address statuses (the sha256 of the
+    concatenated "tx_hash:height:" strings of an address history) and caches
+    them per scripthash.
+
+    A cached status is returned as is while the history list it was computed
+    from is unchanged. When the history changed, the hash state of its
+    confirmed prefix is reused if that prefix is still the same, so that only
+    new and unconfirmed entries are hashed again. This matters for addresses
+    with very long histories that keep receiving transactions.'''
+
+    class Entry:
+        __slots__ = ('hist', 'hist_len', 'status', 'prefix', 'prefix_hasher')
+
+    def __init__(self):
+        self.entries = {}
+
+    def get_status(self, h, scripthash=None):
+        if not h:
+            return None
+        entry = self.entries.get(scripthash) if scripthash is not None else None
+        if entry is not None and entry.hist is h and entry.hist_len == len(h):
+            return entry.status
+        k = 0
+        hasher = hashlib.sha256()
+        if entry is not None:
+            n = len(entry.prefix)
+            if len(h) >= n and h[:n] == entry.prefix:
+                k = n
+                hasher = entry.prefix_hasher.copy()
+        # Extend the confirmed prefix. Histories are sorted by height with
+        # mempool entries (height <= 0) last.
+        m = k
+        while m < len(h) and h[m][1] > 0:
+            m += 1
+        hasher.update(_status_bytes(h[k:m]))
+        prefix_hasher = hasher.copy()
+        hasher.update(_status_bytes(h[m:]))
+        status = bh2u(hasher.digest())
+        if scripthash is not None:
+            entry = self.Entry()
+            entry.hist = h
+            entry.hist_len = len(h)
+            entry.status = status
+            entry.prefix = h[:m]
+            entry.prefix_hasher = prefix_hasher
+            self.entries[scripthash] = entry
+        return status
+
+    def clear(self):
+        self.entries.clear()
+
+
+class TxDownloadQueue:
+    '''Priority queue of transactions to download.
+
+    Unconfirmed transactions come first, then confirmed transactions from the
+    most recent blocks, then transactions whose outputs are spent by a
+    transaction we already have (pruned_txo entries, needed for a correct
+    balance), then everything else by decreasing height. The priority of a
+    queued transaction can be raised with promote().
+
+    get_local_height is a callable returning the current chain height.'''
+
+    def __init__(self, get_local_height):
+        self.get_local_height = get_local_height
+        self.heap = []
+        # tx_hash -> (priority, -height) of the live heap entry
+        self.queued = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.queued)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.queued
+
+    def _key(self, tx_height, priority):
+        if tx_height <= 0:
+            priority = PRIORITY_UNCONFIRMED
+        elif priority is None:
+            recent = tx_height > self.get_local_height() - RECENT_BLOCKS
+            priority = PRIORITY_RECENT if recent else PRIORITY_DEFAULT
+        return (priority, -tx_height)
+
+    def push(self, tx_hash, tx_height, priority=None):
+        key = self._key(tx_height, priority)
+        old = self.queued.get(tx_hash)
+        if old is not None and old <= key:
+            return
+        self.queued[tx_hash] = key
+        heapq.heappush(self.heap, (key, next(self.counter), tx_hash, tx_height))
+
+    def promote(self, tx_hash, priority):
+        '''Raise the priority of tx_hash if it is queued.'''
+        old = self.queued.get(tx_hash)
+        if old is not None and priority < old[0]:
+            self.push(tx_hash, -old[1], priority)
+
+    def pop(self):
+        '''Returns the (tx_hash, tx_height) with the highest priority.'''
+        while self.heap:
+            key, _, tx_hash, tx_height = heapq.heappop(self.heap)
+            if self.queued.get(tx_hash) == key:
+                del self.queued[tx_hash]
+                return tx_hash, tx_height
+        raise IndexError('pop from an empty TxDownloadQueue')
+
+    def clear(self):
+        self.heap.clear()
+        self.queued.clear()
+
 
 class Synchronizer(ThreadJob):
     '''The synchronizer keeps the wallet up-to-date with its set of
@@ -42,6 +178,12 @@ class Synchronizer(ThreadJob):
     we don't have the full history of, and requests binary transaction
     data of any transactions the wallet doesn't have.
 
+    Transactions are downloaded in priority order (see TxDownloadQueue) with
+    at most `synchronizer_max_tx_requests` requests in flight. Progress is
+    reported with the 'sync_progress' network callback, which receives the
+    wallet, the number of transactions received and the total number of
+    transactions to download.
+
     External interface: __init__() and add() member functions.
     '''
 
@@ -51,11 +193,20 @@ class Synchronizer(ThreadJob):
         self.cleaned_up = False
         self._need_release = False
         self.new_addresses = set()
-        # Entries are (tx_hash, tx_height) tuples
+        # Transactions queued or in flight, tx_hash -> tx_height
         self.requested_tx = {}
+        self.tx_queue = TxDownloadQueue(network.get_local_height)
+        self.tx_in_flight = set()
+        self.max_tx_requests = self.get_max_tx_requests(network.config)
+        # Progress of the current download batch
+        self.tx_done = 0
+        self.tx_total = 0
+        self._progress_dirty = False
+        self._progress_time = 0.0
         self.requested_histories = {}
         self.requested_hashes = set()
         self.h2addr = {}
+        self.status_cache = AddressStatusCache()
         self.lock = Lock()
         self._tick_ct = 0
         self.initialize()
@@ -63,6 +214,14 @@ class Synchronizer(ThreadJob):
     def diagnostic_name(self):
         return f"{__class__.__name__}/{self.wallet.diagnostic_name()}"
 
+    @staticmethod
+    def get_max_tx_requests(config):
+        n = config and config.get('synchronizer_max_tx_requests', DEFAULT_MAX_TX_REQUESTS)
+        try:
+            return max(1, int(n))
+        except (TypeError, ValueError):
+            return DEFAULT_MAX_TX_REQUESTS
+
     def parse_response(self, response):
         error = True
         try:
@@ -88,6 +247,9 @@ class Synchronizer(ThreadJob):
         self.network.cancel_requests(self.on_address_history)
         self.network.cancel_requests(self.tx_response)
         self.network.remove_jobs([self])
+        self.tx_queue.clear()
+        self.tx_in_flight.clear()
+        self.status_cache.clear()
 
     def release(self):
         ''' Called from main thread, enqueues a 'release' to happen in the
@@ -106,13 +268,10 @@ class Synchronizer(ThreadJob):
         self.network.subscribe_to_scripthashes(hashes, self.on_address_status)
         self.requested_hashes |= set(hashes)
 
-    def get_status(self, h):
-        if not h:
-            return None
-        status = ''
-        for tx_hash, height in h:
-            status += tx_hash + ':%d:' % height
-        return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+    def get_status(self, h, scripthash=None):
+        ''' Returns the status of history h. If scripthash is given, the
+        status is cached and reused for that scripthash. '''
+        return self.status_cache.get_status(h, scripthash)
 
     def on_address_status(self, response):
         if self.cleaned_up:
@@ -127,7 +286,7 @@ class Synchronizer(ThreadJob):
         if not addr:
             return  # Bad server response?
         history = self.wallet.get_address_history(addr)
-        if self.get_status(history) != result:
+        if self.get_status(history, scripthash) != result:
             if self.requested_histories.get(scripthash) is None:
                 self.requested_histories[scripthash] = result
                 self.network.request_scripthash_history(scripthash,
@@ -161,7 +320,7 @@ class Synchronizer(ThreadJob):
             self.print_error("error: server history has non-unique txids: {}"
                              .format(addr))
         # Check that the status corresponds to what was announced
-        elif self.get_status(hist) != server_status:
+        elif self.get_status(hist, scripthash) != server_status:
             self.print_error("error: status mismatch: {}".format(addr))
         else:
             # Store received history
@@ -178,6 +337,10 @@ class Synchronizer(ThreadJob):
         # on bad server reply or reorg.
         # see Electrum commit 7b8114f865f644c5611c3bb849c4f4fc6ce9e376 fix#5122
         tx_height = self.requested_tx.pop(tx_hash, 0)
+        self.tx_in_flight.discard(tx_hash)
+        self.tx_done += 1
+        self._progress_dirty = True
+        self.send_queued_tx_requests()
         if error:
             # was some response error. note we popped the tx already
             # we assume a blockchain reorg happened and tx disappeared.
@@ -201,6 +364,7 @@ class Synchronizer(ThreadJob):
         del chk_txid
         # /Paranoia
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+        self.promote_pruned_inputs(tx)
         self.print_error("received tx %s height: %d bytes: %d" %
                          (tx_hash, tx_height, len(tx.raw)))
         # callbacks
@@ -209,30 +373,87 @@ class Synchronizer(ThreadJob):
             self.network.trigger_callback('wallet_updated', self.wallet)
 
 
+    def promote_pruned_inputs(self, tx):
+        '''Move up the queue the transactions funding inputs of tx that the
+        wallet had to record in pruned_txo.'''
+        if not self.tx_queue:
+            return
+        pruned_txo = self.wallet.pruned_txo
+        for txin in tx.inputs():
+            prevout_hash = txin.get('prevout_hash')
+            if prevout_hash in self.tx_queue and '{}:{}'.format(prevout_hash, txin['prevout_n']) in pruned_txo:
+                self.tx_queue.promote(prevout_hash, PRIORITY_PRUNED)
+
     def request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
-        requests = []
+        if self.queue_missing_txs(hist):
+            self.send_queued_tx_requests()
+
+    def queue_missing_txs(self, hist, pruned=frozenset()):
+        '''Queue the transactions of hist the wallet doesn't have. pruned
+        are the tx hashes needed to resolve pruned_txo entries. Returns True
+        if anything was added.'''
+        added = False
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
+                if tx_hash in self.tx_queue:
+                    # the height may have changed
+                    self.requested_tx[tx_hash] = tx_height
+                    self.tx_queue.push(tx_hash, tx_height)
                 continue
             if tx_hash in self.wallet.transactions:
                 continue
-            requests.append(('blockchain.transaction.get', [tx_hash]))
             self.requested_tx[tx_hash] = tx_height
+            self.tx_queue.push(tx_hash, tx_height,
+                               PRIORITY_PRUNED if tx_hash in pruned else None)
+            self.tx_total += 1
+            added = True
+        if added:
+            self._progress_dirty = True
+        return added
+
+    def send_queued_tx_requests(self):
+        '''Send queued transaction requests, keeping at most
+        max_tx_requests in flight.'''
+        requests = []
+        while self.tx_queue and len(self.tx_in_flight) < self.max_tx_requests:
+            tx_hash, tx_height = self.tx_queue.pop()
+            if tx_hash not in self.requested_tx:
+                continue
+            self.tx_in_flight.add(tx_hash)
+            requests.append(('blockchain.transaction.get', [tx_hash]))
         self.network.send(requests, self.tx_response)
 
+    def report_progress(self, force=False):
+        if not self._progress_dirty:
+            return
+        now = time.time()
+        done = not self.requested_tx
+        if not done and not force and now - self._progress_time < PROGRESS_INTERVAL:
+            return
+        self._progress_dirty = False
+        self._progress_time = now
+        self.network.trigger_callback('sync_progress', self.wallet,
+                                      min(self.tx_done, self.tx_total), self.tx_total)
+        if done:
+            # start counting afresh for the next batch
+            self.tx_done = self.tx_total = 0
+
 
     def initialize(self):
         '''Check the initial state of the wallet.  Subscribe to all its
         addresses, and request any transactions in its address history
         we don't have.
         '''
+        # Transactions funding outputs spent by transactions we have
+        pruned = {ser.rsplit(':', 1)[0] for ser in self.wallet.pruned_txo}
         # FIXME: encapsulation
         for history in self.wallet._history.values():
-            self.request_missing_txs(history)
+            self.queue_missing_txs(history, pruned)
+        self.send_queued_tx_requests()
 
         if self.requested_tx:
-            self.print_error("missing tx", self.requested_tx)
+            self.print_error("missing tx", len(self.requested_tx))
         self.subscribe_to_addresses(self.wallet.get_addresses())
 
     def run(self):
@@ -257,7 +478,10 @@ class Synchronizer(ThreadJob):
             if addresses:
                 self.subscribe_to_addresses(addresses)
 
-            # 3. Detect if situation has changed
+            # 3. Report download progress
+            self.report_progress()
+
+            # 4. Detect if situation has changed
             up_to_date = self.is_up_to_date()
             if up_to_date != self.wallet.is_up_to_date():
                 self.wallet.set_up_to_date(up_to_date)
@@ -3,24 +3,46 @@ import unittest
 from .test_address import TestAddressFromString
 from .test_asert import Test_ASERTDaa
 from .test_bitcoin import suite as test_bitcoin_suite
-from .test_blockchain import TestBlockchain
+from .test_blockchain import TestBlockchain, TestBlockchainHeaderStore
+from .test_caches import TestExpiringCache
 from .test_cashacct import TestCashAccounts
 from .test_cashaddrenc import TestCashAddrAddress
-from .test_commands import TestCommands
+from .test_commands import TestCommands, TestPagedCommands
 from .test_consolidate import suite as test_consolidate_suite
 from .test_dnssec import TestDnsSec
+from .test_header_sync import TestHeaderSyncScheduler
 from .test_import_electroncash_data import TestImportECData
+from .test_imports import TestLazyImports
 from .test_interface import TestInterface
+from .test_jsonrpc import (
+    TestBoundedQueue,
+    TestConcurrentServer,
+    TestLatencyHistogram,
+    TestWalletSelection,
+)
+from .test_memdiag import TestMemDiag, TestWalletSizes
 from .test_mnemonic import suite as test_mnemonic_suite
 from .test_paymentrequests import Test_PaymentRequests
+from .test_plugins import TestDeferredPlugins, TestPluginMetadata
+from .test_request_multiplexer import TestRequestMultiplexer
 from .test_schnorr import suite as test_schnorr_suite
+from .test_server_health import TestServerHealth
 from .test_simple_config import suite as test_simple_config_suite
 from .test_slp import SLPTests
 from .test_storage_upgrade import TestStorageUpgrade
+from .test_synchronizer import (
+    TestAddressStatusCache,
+    TestSynchronizerTxQueue,
+    TestTxDownloadQueue,
+)
+from .test_tracing import TestTracing
 from .test_transaction import suite as test_transaction_suite
 from .test_util import suite as test_util_suite
+from .test_verifier import TestMerkleNodeCache
 from .test_wallet import suite as test_wallet_suite
 from .test_wallet_vertical import TestWalletKeystoreAddressIntegrity
+from .test_webhooks import TestAddressNotifier, TestWebhookDispatcher
+from .test_websockets import TestRequestRegistry, TestWsClientThread
 
 
 def suite():
@@ -30,23 +52,47 @@ def suite():
     test_suite.addTest(loadTests(Test_ASERTDaa))
     test_suite.addTest(test_bitcoin_suite())
     test_suite.addTest(loadTests(TestBlockchain))
+    test_suite.addTest(loadTests(TestBlockchainHeaderStore))
+    test_suite.addTest(loadTests(TestExpiringCache))
     test_suite.addTest(loadTests(TestCashAccounts))
     test_suite.addTest(loadTests(TestCashAddrAddress))
     test_suite.addTest(loadTests(TestCommands))
+    test_suite.addTest(loadTests(TestPagedCommands))
     test_suite.addTest(test_consolidate_suite())
     test_suite.addTest(loadTests(TestDnsSec))
+    test_suite.addTest(loadTests(TestHeaderSyncScheduler))
     test_suite.addTest(loadTests(TestImportECData))
+    test_suite.addTest(loadTests(TestLazyImports))
     test_suite.addTest(loadTests(TestInterface))
+    test_suite.addTest(loadTests(TestBoundedQueue))
+    test_suite.addTest(loadTests(TestConcurrentServer))
+    test_suite.addTest(loadTests(TestLatencyHistogram))
+    test_suite.addTest(loadTests(TestWalletSelection))
+    test_suite.addTest(loadTests(TestMemDiag))
+    test_suite.addTest(loadTests(TestWalletSizes))
     test_suite.addTest(test_mnemonic_suite())
     test_suite.addTest(loadTests(Test_PaymentRequests))
+    test_suite.addTest(loadTests(TestPluginMetadata))
+    test_suite.addTest(loadTests(TestDeferredPlugins))
+    test_suite.addTest(loadTests(TestRequestMultiplexer))
     test_suite.addTest(test_schnorr_suite())
+    test_suite.addTest(loadTests(TestServerHealth))
     test_suite.addTest(test_simple_config_suite())
     test_suite.addTest(loadTests(SLPTests))
     test_suite.addTest(loadTests(TestStorageUpgrade))
+    test_suite.addTest(loadTests(TestAddressStatusCache))
+    test_suite.addTest(loadTests(TestSynchronizerTxQueue))
+    test_suite.addTest(loadTests(TestTxDownloadQueue))
+    test_suite.addTest(loadTests(TestTracing))
     test_suite.addTest(test_transaction_suite())
     test_suite.addTest(test_util_suite())
+    test_suite.addTest(loadTests(TestMerkleNodeCache))
     test_suite.addTest(test_wallet_suite())
     test_suite.addTest(loadTests(TestWalletKeystoreAddressIntegrity))
+    test_suite.addTest(loadTests(TestAddressNotifier))
+    test_suite.addTest(loadTests(TestWebhookDispatcher))
+    test_suite.addTest(loadTests(TestRequestRegistry))
+    test_suite.addTest(loadTests(TestWsClientThread))
     return test_suite
 
 
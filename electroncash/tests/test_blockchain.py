@@ -1,6 +1,11 @@
+import os
+import random
+import shutil
+import tempfile
 import unittest
 
 from .. import blockchain as bc
+from .. import networks
 
 
 class MyBlockchain(bc.Blockchain):
@@ -75,6 +80,122 @@ class TestBlockchain(unittest.TestCase):
         hdr = {"block_height": block["block_height"] + 1}
         self.assertEqual(chain.get_bits(hdr, chunk), 0x1801B553)
 
+    def test_chunk_bits_match_get_bits(self):
+        # A chunk that spans the ASERT activation: the first headers use the
+        # CW-144 DAA, the rest ASERT.
+        rng = random.Random(42)
+        activation = networks.net.asert_daa.MTP_ACTIVATION_TIME
+        anchor = networks.net.asert_daa.anchor
+        start_height = anchor.height - 700
+        header = {
+            "version": 4,
+            "prev_block_hash": "00" * 32,
+            "merkle_root": "00" * 32,
+            "timestamp": activation - 400 * 600,
+            "bits": anchor.bits,
+            "nonce": 0,
+            "block_height": start_height,
+        }
+        headers = {start_height: header}
+        for n in range(2400):
+            header = get_block(header, rng.randint(1, 1200), anchor.bits)
+            headers[header["block_height"]] = header
+
+        class HistoryBlockchain(MyBlockchain):
+            def read_header(self, height, chunk=None):
+                if chunk is not None and chunk.contains_height(height):
+                    return chunk.get_header_at_height(height)
+                return headers.get(height)
+
+        chunk_base = start_height + 300
+        chunk_bytes = b"".join(
+            bytes.fromhex(bc.serialize_header(headers[h]))
+            for h in range(chunk_base, chunk_base + 2016)
+        )
+        chunk = bc.HeaderChunk(chunk_base, chunk_bytes)
+        chain = HistoryBlockchain()
+        expected = [chain.get_bits(h, chunk) for h in chunk.headers]
+        self.assertEqual(list(chain.get_chunk_bits(chunk)), expected)
+        # Sanity check that both algorithms were exercised
+        self.assertLess(chain.get_median_time_past(chunk_base), activation)
+        self.assertGreater(
+            chain.get_median_time_past(chunk_base + 2015, chunk), activation
+        )
+
+
+class FakeConfig:
+    def __init__(self, path):
+        self.path = path
+
+
+class TestBlockchainHeaderStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        z = "00" * 32
+        genesis = {
+            "version": 1,
+            "prev_block_hash": z,
+            "merkle_root": z,
+            "timestamp": 1231006505,
+            "bits": bc.MAX_BITS,
+            "nonce": 0,
+            "block_height": 0,
+        }
+        self.headers = [genesis]
+        for n in range(1, 50):
+            self.headers.append(get_block(self.headers[-1], 600, bc.MAX_BITS))
+        data = b"".join(bytes.fromhex(bc.serialize_header(h)) for h in self.headers)
+        with open(os.path.join(self.path, "blockchain_headers"), "wb") as f:
+            f.write(data)
+        self.chain = bc.Blockchain(FakeConfig(self.path), 0, None)
+
+    def tearDown(self):
+        self.chain.close_mmap()
+        shutil.rmtree(self.path)
+
+    def test_read_header(self):
+        self.assertEqual(self.chain.height(), 49)
+        for h in self.headers:
+            self.assertEqual(self.chain.read_header(h["block_height"]), h)
+        self.assertIsNone(self.chain.read_header(50))
+        # served from the cache the second time
+        self.assertEqual(self.chain.read_header(10), self.headers[10])
+
+    def test_returned_header_is_a_copy(self):
+        header = self.chain.read_header(5)
+        header["nonce"] = 12345
+        self.assertEqual(self.chain.read_header(5)["nonce"], 0)
+
+    def test_get_hash(self):
+        self.assertEqual(self.chain.get_hash(20), bc.hash_header(self.headers[20]))
+        self.assertEqual(self.chain.get_hash(-1), bc.NULL_HASH_HEX)
+
+    def test_write_invalidates_cache(self):
+        old_hash = self.chain.get_hash(40)
+        self.assertEqual(
+            self.chain.read_header(40)["timestamp"], self.headers[40]["timestamp"]
+        )
+        replacement = get_block(self.headers[39], 1200, bc.MAX_BITS)
+        self.chain.write(
+            bytes.fromhex(bc.serialize_header(replacement)), 40 * bc.HEADER_SIZE
+        )
+        self.assertEqual(self.chain.height(), 40)
+        self.assertEqual(self.chain.read_header(40), replacement)
+        self.assertNotEqual(self.chain.get_hash(40), old_hash)
+        self.assertIsNone(self.chain.read_header(41))
+        # untouched headers are still right
+        self.assertEqual(self.chain.read_header(39), self.headers[39])
+
+    def test_null_header(self):
+        with open(self.chain.path(), "rb+") as f:
+            f.seek(0, 2)
+            f.write(bc.NULL_HEADER)
+        self.chain.close_mmap()
+        with self.chain.lock:
+            self.chain.update_size()
+        self.assertEqual(self.chain.height(), 50)
+        self.assertIsNone(self.chain.read_header(50))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from ..caches import ExpiringCache, all_caches_stats
+
+
+class TestExpiringCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        c = ExpiringCache(maxlen=3, name="test lru")
+        for k in "abc":
+            c.put(k, k.upper())
+        self.assertEqual(c.get("a"), "A")
+        c.put("d", "D")
+        # b was the least recently used
+        self.assertIsNone(c.get("b"))
+        self.assertEqual([c.get(k) for k in "acd"], ["A", "C", "D"])
+        stats = c.stats()
+        self.assertEqual(stats["items"], 3)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual((stats["hits"], stats["misses"]), (4, 1))
+        self.assertEqual(stats["hit_rate"], 0.8)
+
+    def test_byte_budget(self):
+        c = ExpiringCache(maxlen=1000, max_bytes=1000, name="test bytes", sizeof=len)
+        c.put(1, "x" * 400)
+        c.put(2, "x" * 400)
+        c.put(3, "x" * 400)
+        self.assertEqual(len(c), 2)
+        self.assertIsNone(c.get(1))
+        self.assertLessEqual(c.size_bytes(), 1000)
+        # replacing an item accounts for the old size
+        c.put(3, "x")
+        self.assertEqual(len(c), 2)
+        self.assertLess(c.size_bytes(), 500)
+        # an item over budget is not kept
+        c.put(4, "x" * 2000)
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.size_bytes(), 0)
+        self.assertEqual(c.stats()["evictions"], 4)
+
+    def test_expire(self):
+        c = ExpiringCache(name="test expire", timeout=10)
+        for i in range(5):
+            c.put(i, i)
+        for entry in list(c.d.values())[:3]:
+            entry[0] = -5
+        self.assertEqual(c.expire(0), 3)
+        self.assertEqual(sorted(c.d), [3, 4])
+        self.assertEqual(c.stats()["expirations"], 3)
+        c.clear()
+        self.assertEqual((len(c), c.size_bytes()), (0, 0))
+
+    def test_all_caches_stats(self):
+        c = ExpiringCache(name="test listed")
+        c.put("k", "v" * 10 ** 6)
+        stats = [s for s in all_caches_stats() if s["name"] == "test listed"]
+        self.assertEqual(len(stats), 1)
+        self.assertGreater(stats[0]["bytes"], 10 ** 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,10 @@
+import threading
 import unittest
 from decimal import Decimal as PyDecimal
 
+from ..address import Address
 from ..commands import Commands
+from ..util import ListingPager
 
 
 class TestCommands(unittest.TestCase):
@@ -56,5 +59,94 @@ class TestCommands(unittest.TestCase):
         )
 
 
+class FakeWallet:
+    def __init__(self):
+        self.addresses = [
+            Address.from_pubkey(bytes([2]) + bytes([i]) * 32) for i in range(1, 11)
+        ]
+        self.labels = {}
+        self.spent = set()
+        self.lock = threading.RLock()
+        self.listing_pager = ListingPager()
+
+    def get_addresses(self):
+        return list(self.addresses)
+
+    def is_change(self, addr):
+        return self.addresses.index(addr) % 2 == 1
+
+    def get_filtered_addresses(self, *, change=False, **kwargs):
+        return [a for a in self.addresses if self.is_change(a) or not change]
+
+    @property
+    def txo(self):
+        return {
+            f"{i:064x}": {self.addresses[i]: [(i % 2, 1000 * i, False)]}
+            for i in range(10)
+        }
+
+    def get_addr_utxo(self, address):
+        i = self.addresses.index(address)
+        if i in self.spent:
+            return {}
+        utxo = {
+            "prevout_hash": f"{i:064x}",
+            "prevout_n": i % 2,
+            "value": 1000 * i,
+            "address": address,
+            "slp_token": None,
+        }
+        return {f"{i:064x}:{i % 2}": utxo}
+
+    def get_utxos(self, exclude_frozen=False):
+        return [u for a in self.addresses for u in self.get_addr_utxo(a).values()]
+
+
+class TestPagedCommands(unittest.TestCase):
+    def setUp(self):
+        self.wallet = FakeWallet()
+        self.cmds = Commands(None, self.wallet, None)
+
+    def test_listaddresses(self):
+        all_addresses = [a.to_full_ui_string() for a in self.wallet.addresses]
+        self.assertEqual(self.cmds.listaddresses(), all_addresses)
+        self.assertEqual(self.cmds.listaddresses(offset=2, limit=3), all_addresses[2:5])
+        page = self.cmds.listaddresses(change=True, limit=2)
+        self.assertEqual(page, all_addresses[1:4:2])
+        page = self.cmds.listaddresses(change=True, cursor=page[-1], limit=2)
+        self.assertEqual(page, all_addresses[5:8:2])
+        with self.assertRaises(ValueError):
+            self.cmds.listaddresses(cursor="nope")
+        # an address that is not in the wallet
+        other = Address.from_pubkey(bytes([3]) * 33).to_full_ui_string()
+        with self.assertRaises(ValueError):
+            self.cmds.listaddresses(cursor=other)
+
+    def test_listunspent(self):
+        self.assertEqual(len(self.cmds.listunspent()), 10)
+        page = self.cmds.listunspent(limit=4)
+        self.assertEqual([u["value"] for u in page], ["0", "10", "20", "30"])
+        cursor = f"{page[-1]['prevout_hash']}:{page[-1]['prevout_n']}"
+        page = self.cmds.listunspent(cursor=cursor, limit=4)
+        self.assertEqual([u["value"] for u in page], ["40", "50", "60", "70"])
+        self.assertEqual(
+            page[0]["address"], self.wallet.addresses[4].to_full_ui_string()
+        )
+        self.assertEqual(self.cmds.listunspent(cursor=cursor, limit=4), page)
+        # coins spent before the next page are skipped, also the one of the
+        # cursor, which is still in the snapshot
+        self.wallet.spent.update((5, 7))
+        page = self.cmds.listunspent(cursor=cursor, limit=4)
+        self.assertEqual([u["value"] for u in page], ["40", "60", "80", "90"])
+        cursor = f"{page[1]['prevout_hash']}:{page[1]['prevout_n']}"
+        self.assertEqual(len(self.cmds.listunspent(cursor=cursor)), 2)
+        last = f"{9:064x}:1"
+        self.assertEqual(self.cmds.listunspent(cursor=last), [])
+        # a new listing without the coin of the cursor
+        self.assertEqual(self.cmds.listunspent(limit=1)[0]["value"], "0")
+        with self.assertRaises(ValueError):
+            self.cmds.listunspent(cursor=f"{7:064x}:1")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,155 @@
+import unittest
+
+from .. import blockchain
+from ..header_sync import HeaderSyncScheduler
+from ..interface import Interface
+from ..server_health import ServerHealth
+
+
+class FakeInterface:
+    def __init__(self, server, tip, mode=Interface.MODE_DEFAULT):
+        self.server = server
+        self.tip = tip
+        self.mode = mode
+
+    def set_mode(self, mode):
+        self.mode = mode
+
+    def print_error(self, *args):
+        pass
+
+
+class FakeChain:
+    def __init__(self, height):
+        self._height = height
+        self.catch_up = None
+        self.bad_servers = set()
+        self.connected = []
+
+    def height(self):
+        return self._height
+
+    def connect_chunk(self, base_height, chunk_data):
+        if base_height != self._height + 1:
+            return blockchain.CHUNK_BAD
+        if chunk_data.startswith(b"bad"):
+            return blockchain.CHUNK_BAD
+        self._height += len(chunk_data) // blockchain.HEADER_SIZE
+        self.connected.append(base_height)
+        return blockchain.CHUNK_ACCEPTED
+
+
+class FakeNetwork:
+    def __init__(self, interfaces, depth=4):
+        self.config = {"header_sync_depth": depth}
+        self.interfaces = interfaces
+        self.server_health = ServerHealth()
+        self.requests = []
+        self.downed = []
+
+    def get_interfaces(self, *, interfaces=False):
+        return list(self.interfaces)
+
+    def request_headers(self, interface, base_height, count, silent=False):
+        self.requests.append((interface.server, base_height, count))
+        return True
+
+    def connection_down(self, server):
+        self.downed.append(server)
+
+    def switch_lagging_interface(self):
+        pass
+
+
+def chunk(count, bad=False):
+    data = b"\x01" * (count * blockchain.HEADER_SIZE)
+    return (b"bad" + data[3:]) if bad else data
+
+
+class TestHeaderSyncScheduler(unittest.TestCase):
+    def setUp(self):
+        self.leader = FakeInterface("leader:1:s", 10000, Interface.MODE_CATCH_UP)
+        self.helper = FakeInterface("helper:1:s", 10000)
+        self.network = FakeNetwork([self.leader, self.helper])
+        self.chain = FakeChain(99)
+        self.sched = HeaderSyncScheduler(self.network)
+
+    def test_disabled_with_depth_one(self):
+        self.network.config["header_sync_depth"] = 1
+        sched = HeaderSyncScheduler(self.network)
+        self.assertFalse(sched.start(self.leader, self.chain, 100))
+        self.assertEqual(self.network.requests, [])
+
+    def test_requests_are_pipelined_across_interfaces(self):
+        self.assertTrue(self.sched.start(self.leader, self.chain, 100))
+        self.assertEqual(len(self.network.requests), 4)
+        servers = {r[0] for r in self.network.requests}
+        self.assertEqual(servers, {self.leader.server, self.helper.server})
+        bases = [r[1] for r in self.network.requests]
+        self.assertEqual(bases, [100, 2116, 4132, 6148])
+
+    def test_out_of_order_completion(self):
+        self.sched.start(self.leader, self.chain, 100)
+        by_base = {r[1]: r for r in self.network.requests}
+        iface = {i.server: i for i in self.network.interfaces}
+        # The second chunk lands first and must be buffered
+        server = by_base[2116][0]
+        self.assertTrue(self.sched.is_scheduled(iface[server], 2116))
+        self.sched.on_chunk(iface[server], 2116, chunk(2016))
+        self.assertEqual(self.chain.height(), 99)
+        server = by_base[100][0]
+        self.sched.on_chunk(iface[server], 100, chunk(2016))
+        self.assertEqual(self.chain.connected, [100, 2116])
+        self.assertEqual(self.chain.height(), 4131)
+
+    def test_finishes_at_tip(self):
+        self.leader.tip = 2000
+        self.sched.start(self.leader, self.chain, 100)
+        self.assertEqual(self.network.requests, [(self.leader.server, 100, 1901)])
+        self.sched.on_chunk(self.leader, 100, chunk(1901))
+        self.assertFalse(self.sched.is_active())
+        self.assertEqual(self.leader.mode, Interface.MODE_DEFAULT)
+
+    def test_short_chunk_from_leader(self):
+        self.leader.tip = 2000
+        self.sched.start(self.leader, self.chain, 100)
+        # the leader's tip moved backwards: the rest is requested up to its tip
+        self.leader.tip = 1500
+        self.sched.on_chunk(self.leader, 100, chunk(1000))
+        self.assertEqual(self.network.requests[-1], (self.leader.server, 1100, 401))
+        # an empty answer from the leader is not retried
+        self.sched.on_chunk(self.leader, 1100, chunk(0))
+        self.assertFalse(self.sched.is_active())
+        self.assertEqual(len(self.network.requests), 2)
+
+    def test_bad_helper_chunk_is_refetched_from_leader(self):
+        self.leader.tip = 4131
+        self.sched.start(self.leader, self.chain, 100)
+        by_base = {r[1]: r[0] for r in self.network.requests}
+        self.assertEqual(by_base[2116], self.helper.server)
+        self.sched.on_chunk(self.leader, 100, chunk(2016))
+        self.sched.on_chunk(self.helper, 2116, chunk(2016, bad=True))
+        self.assertEqual(self.network.requests[-1], (self.leader.server, 2116, 2016))
+        self.assertEqual(self.network.downed, [])
+        self.sched.on_chunk(self.leader, 2116, chunk(2016))
+        self.assertEqual(self.chain.height(), 4131)
+        self.assertFalse(self.sched.is_active())
+
+    def test_helper_disconnect_reschedules(self):
+        self.sched.start(self.leader, self.chain, 100)
+        helper_bases = [
+            r[1] for r in self.network.requests if r[0] == self.helper.server
+        ]
+        self.network.interfaces.remove(self.helper)
+        self.sched.on_connection_down(self.helper.server)
+        resent = [r[1] for r in self.network.requests[4:]]
+        self.assertEqual(sorted(resent), sorted(helper_bases))
+
+    def test_leader_disconnect_aborts(self):
+        self.sched.start(self.leader, self.chain, 100)
+        self.sched.on_connection_down(self.leader.server)
+        self.assertFalse(self.sched.is_active())
+
+
+if __name__ == "__main__":
+    unittest.main()
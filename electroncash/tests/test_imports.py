@@ -0,0 +1,107 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# Seconds allowed for importing the modules needed by the command line client.
+# Generous, to not fail on slow machines: it is a few times what it takes on a
+# laptop, and several times less than importing the whole package used to.
+IMPORT_TIME_BUDGET = 1.0
+
+# Modules that the command line client must not import before it knows that
+# it needs them: they load the wallet, network, protobuf or dns stacks, or
+# the plugins.
+HEAVY_MODULES = (
+    "electroncash.wallet",
+    "electroncash.network",
+    "electroncash.transaction",
+    "electroncash.paymentrequest",
+    "electroncash.paymentrequest_pb2",
+    "electroncash.cashacct",
+    "electroncash.slp",
+    "electroncash.dnssec",
+    "electroncash_plugins",
+    "PyQt5",
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def import_in_subprocess(statement):
+    """Runs statement in a new interpreter and returns the time it took, and
+    the names of the modules loaded by it."""
+    code = (
+        "import json, sys, time\n"
+        "before = set(sys.modules)\n"
+        "t0 = time.perf_counter()\n"
+        "{}\n"
+        "elapsed = time.perf_counter() - t0\n"
+        "print(json.dumps([elapsed, sorted(set(sys.modules) - before)]))\n"
+    ).format(statement)
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        timeout=60,
+        check=True,
+    )
+    elapsed, modules = json.loads(out.stdout.strip().splitlines()[-1])
+    return elapsed, modules
+
+
+class TestLazyImports(unittest.TestCase):
+    def assertNoHeavyModules(self, modules):
+        heavy = [
+            m
+            for m in modules
+            if m in HEAVY_MODULES or m.startswith(tuple(h + "." for h in HEAVY_MODULES))
+        ]
+        self.assertEqual(heavy, [])
+
+    def test_package(self):
+        elapsed, modules = import_in_subprocess("import electroncash")
+        self.assertNoHeavyModules(modules)
+        self.assertNotIn("electroncash.util", modules)
+
+    def test_cli_startup(self):
+        # What the electrum-abc script imports before parsing the command
+        # line, and what the client of a running daemon needs.
+        elapsed, modules = import_in_subprocess(
+            "import electroncash.commands, electroncash.daemon, electroncash.migrate_data"
+        )
+        self.assertNoHeavyModules(modules)
+        self.assertLess(elapsed, IMPORT_TIME_BUDGET)
+
+    def test_caches_first(self):
+        # util and caches import each other, which used to only work when
+        # importing the package imported util first
+        import_in_subprocess(
+            "import electroncash.caches\n"
+            "from electroncash.util import format_satoshis\n"
+            "assert format_satoshis(12345) == '123.45'"
+        )
+
+    def test_lazy_attributes(self):
+        import electroncash
+        from electroncash import wallet
+
+        self.assertIs(electroncash.Wallet, wallet.Wallet)
+        self.assertIn("Commands", dir(electroncash))
+        with self.assertRaises(AttributeError):
+            electroncash.NotAThing
+
+    def test_cashacct_registration(self):
+        # transaction.py registers the cash account scripts, as importing the
+        # package used to
+        _, modules = import_in_subprocess(
+            "import electroncash.transaction\n"
+            "from electroncash.address import ScriptOutput\n"
+            "assert any(c.__module__ == 'electroncash.cashacct' for c in ScriptOutput.protocol_classes)"
+        )
+        self.assertIn("electroncash.cashacct", modules)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,188 @@
+import json
+import os
+import socket
+import threading
+import time
+import unittest
+import urllib.request
+from types import SimpleNamespace
+
+import jsonrpclib
+
+from ..daemon import Daemon
+from ..jsonrpc import LatencyHistogram, VerifyingJSONRPCServer
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_histogram(self):
+        h = LatencyHistogram(buckets=(0.01, 0.1, 1.0))
+        self.assertIsNone(h.quantile(0.5))
+        for d in (0.005, 0.01, 0.05, 0.5, 0.5, 3.0):
+            h.add(d)
+        h.add(0.02, error=True)
+        self.assertEqual(h.counts, [2, 2, 2, 1])
+        self.assertEqual(h.quantile(0.5), 0.1)
+        self.assertEqual(h.quantile(1.0), 3.0)
+        d = h.to_dict()
+        self.assertEqual(d["count"], 7)
+        self.assertEqual(d["errors"], 1)
+        self.assertEqual(d["buckets"], {"0.01": 2, "0.1": 2, "1.0": 2, "+Inf": 1})
+
+
+class TestConcurrentServer(unittest.TestCase):
+    def setUp(self):
+        self.server = VerifyingJSONRPCServer(
+            ("127.0.0.1", 0),
+            logRequests=False,
+            rpc_user="user",
+            rpc_password="",
+            workers=4,
+        )
+        self.server.timeout = 0.1
+        self.release = threading.Event()
+        self.server.register_function(lambda: self.release.wait(10) and "slow", "slow")
+        self.server.register_function(lambda: "fast", "fast")
+        self.barrier = threading.Barrier(3, timeout=10)
+        self.server.register_function(
+            lambda x: self.barrier.wait() is not None and x, "meet"
+        )
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        host, port = self.server.socket.getsockname()
+        self.url = f"http://{host}:{port}"
+
+    def serve(self):
+        while self.running:
+            self.server.handle_request()
+
+    def tearDown(self):
+        self.release.set()
+        self.running = False
+        self.thread.join()
+        self.server.server_close()
+
+    def test_slow_call_does_not_block_others(self):
+        results = []
+        slow = threading.Thread(
+            target=lambda: results.append(jsonrpclib.Server(self.url).slow())
+        )
+        slow.start()
+        time.sleep(0.2)
+        t0 = time.monotonic()
+        self.assertEqual(jsonrpclib.Server(self.url).fast(), "fast")
+        self.assertLess(time.monotonic() - t0, 5)
+        self.assertEqual(results, [])
+        self.release.set()
+        slow.join()
+        self.assertEqual(results, ["slow"])
+        stats = self.server.method_stats.to_dict()
+        self.assertEqual(stats["fast"]["count"], 1)
+        self.assertEqual(stats["slow"]["count"], 1)
+        self.assertGreater(stats["slow"]["max"], stats["fast"]["max"])
+
+    def test_keep_alive(self):
+        client = jsonrpclib.Server(self.url)
+        for _ in range(3):
+            self.assertEqual(client.fast(), "fast")
+        self.assertEqual(self.server.method_stats.to_dict()["fast"]["count"], 3)
+
+    def post(self, payload):
+        request = urllib.request.Request(
+            self.url, json.dumps(payload).encode(), {"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=20) as f:
+            return json.loads(f.read())
+
+    def test_batch_runs_concurrently(self):
+        # Each 'meet' call blocks until all three are running at once
+        batch = [
+            {"jsonrpc": "2.0", "id": i, "method": "meet", "params": [i]}
+            for i in range(3)
+        ]
+        batch.append({"jsonrpc": "2.0", "method": "fast"})  # notification
+        batch.append({"jsonrpc": "2.0", "id": "x", "method": "nope"})
+        batch.append(42)
+        responses = self.post(batch)
+        self.assertEqual([r["result"] for r in responses[:3]], [0, 1, 2])
+        self.assertEqual([r["id"] for r in responses[:3]], [0, 1, 2])
+        self.assertEqual(responses[3]["error"]["code"], -32601)
+        self.assertEqual(responses[4]["error"]["code"], -32600)
+        self.assertEqual(len(responses), 5)
+
+
+class TestBoundedQueue(unittest.TestCase):
+    def test_busy_server(self):
+        server = VerifyingJSONRPCServer(
+            ("127.0.0.1", 0),
+            logRequests=False,
+            rpc_user="user",
+            rpc_password="",
+            workers=1,
+            max_queued=1,
+        )
+        server.timeout = 0.1
+        release = threading.Event()
+        server.register_function(lambda: release.wait(10) and "slow", "slow")
+        stop = threading.Event()
+
+        def serve():
+            while not stop.is_set():
+                server.handle_request()
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        host, port = server.socket.getsockname()
+        url = f"http://{host}:{port}"
+        results = []
+
+        def call():
+            results.append(jsonrpclib.Server(url).slow())
+
+        try:
+            # one connection is served, one waits for the worker
+            clients = [threading.Thread(target=call) for _ in range(2)]
+            for client in clients:
+                client.start()
+            for _ in range(100):
+                if server.pending == 2:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(server.pending, 2)
+            # the next one is answered right away
+            with socket.create_connection(server.socket.getsockname(), timeout=10) as s:
+                self.assertTrue(
+                    s.makefile("rb").readline().startswith(b"HTTP/1.1 503 ")
+                )
+            release.set()
+            for client in clients:
+                client.join()
+            self.assertEqual(results, ["slow", "slow"])
+        finally:
+            release.set()
+            stop.set()
+            thread.join()
+            server.server_close()
+
+
+class TestWalletSelection(unittest.TestCase):
+    def test_find_wallet(self):
+        paths = [
+            os.path.abspath(os.path.join(d, name))
+            for d, name in (("a", "shop1"), ("a", "shop2"), ("b", "shop2"))
+        ]
+        wallets = {path: object() for path in paths}
+        daemon = SimpleNamespace(wallets=wallets)
+        self.assertIs(Daemon.find_wallet(daemon, paths[0]), wallets[paths[0]])
+        self.assertIs(Daemon.find_wallet(daemon, "shop1"), wallets[paths[0]])
+        self.assertIs(Daemon.find_wallet(daemon, paths[2]), wallets[paths[2]])
+        with self.assertRaisesRegex(ValueError, "ambiguous"):
+            Daemon.find_wallet(daemon, "shop2")
+        with self.assertRaisesRegex(ValueError, "not loaded"):
+            Daemon.find_wallet(daemon, "shop3")
+        with self.assertRaises(ValueError):
+            Daemon.find_wallet(daemon, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
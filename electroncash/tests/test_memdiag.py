@@ -0,0 +1,102 @@
+import threading
+import unittest
+
+from .. import memdiag
+from ..caches import get_object_size
+from ..wallet import restore_wallet_from_text
+from .test_wallet import WalletTestCase
+
+
+class Leak:
+    pass
+
+
+class TestMemDiag(unittest.TestCase):
+    def tearDown(self):
+        memdiag.stop_tracing()
+
+    def test_snapshots_and_diff(self):
+        self.assertFalse(memdiag.is_tracing())
+        memdiag.take_snapshot("before")
+        self.assertTrue(memdiag.is_tracing())
+        data = [bytes(1000) for _ in range(2000)]
+        summary = memdiag.take_snapshot("after")
+        self.assertEqual(summary["name"], "after")
+        self.assertEqual(memdiag.snapshot_names(), ["before", "after"])
+
+        d = memdiag.diff("before", "after", limit=5)
+        self.assertGreater(d["size_diff"], 2000 * 1000)
+        self.assertIn(__file__, d["top"][0]["where"])
+        self.assertGreaterEqual(d["top"][0]["count_diff"], 2000)
+        # the last snapshot by default
+        self.assertEqual(memdiag.top(limit=3)["name"], "after")
+        del data
+
+        with self.assertRaises(KeyError):
+            memdiag.diff("nope")
+        memdiag.stop_tracing()
+        self.assertFalse(memdiag.is_tracing())
+        self.assertEqual(memdiag.snapshot_names(), [])
+
+    def test_max_snapshots(self):
+        for i in range(memdiag.MAX_SNAPSHOTS + 2):
+            memdiag.take_snapshot()
+        names = memdiag.snapshot_names()
+        self.assertEqual(len(names), memdiag.MAX_SNAPSHOTS)
+        self.assertNotIn("snapshot-1", names)
+
+    def test_object_counts(self):
+        memdiag.object_counts()
+        leaks = [Leak() for _ in range(1000)]
+        counts = memdiag.object_counts(limit=1000)
+        name = Leak.__module__ + ".Leak"
+        deltas = {d["type"]: d["delta"] for d in counts["deltas"]}
+        self.assertEqual(deltas[name], 1000)
+        self.assertEqual(memdiag.count_objects([Leak])["Leak"], 1000)
+        del leaks
+
+    def test_get_object_size(self):
+        self.assertGreater(get_object_size({1, 2, 3}), get_object_size(set()))
+        self.assertGreater(get_object_size({"a": [b"x" * 100]}), 100)
+
+
+class TestWalletSizes(WalletTestCase):
+    def test_wallet_sizes(self):
+        xpub = "xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d"
+        w = restore_wallet_from_text(xpub, path=self.wallet_path, config=self.config)[
+            "wallet"
+        ]
+        addr = w.get_receiving_addresses()[0]
+        n_history = len(w._history)
+        for i in range(10):
+            tx_hash = f"{i:064x}"
+            w._history.setdefault(addr, []).append((tx_hash, 100 + i))
+            w.txo[tx_hash] = {addr: [(0, 1000, False)]}
+
+        sizes = memdiag.wallet_sizes(w)
+        self.assertEqual(sizes["txo"]["items"], 10)
+        self.assertEqual(sizes["history"]["items"], max(n_history, 1))
+        self.assertEqual(sizes["addresses"]["items"], len(w.get_addresses()))
+        self.assertIn("slp_validity", sizes)
+        self.assertIn("cashacct_v_tx", sizes)
+        self.assertGreater(sizes["txo"]["bytes"], sizes["pruned_txo"]["bytes"])
+        self.assertEqual(sizes["storage"]["items"], len(w.storage.data))
+
+        # the storage is measured under its own lock, not only the wallet one
+        done = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (memdiag.wallet_sizes(w), done.set()), daemon=True
+        )
+        with w.storage.lock:
+            thread.start()
+            self.assertFalse(done.wait(0.2))
+        thread.join(5)
+        self.assertTrue(done.is_set())
+
+        report = memdiag.report([w])
+        self.assertEqual(
+            report["wallets"][w.diagnostic_name()], memdiag.wallet_sizes(w)
+        )
+        self.assertIn("caches", report)
+        self.assertFalse(report["tracemalloc"]["tracing"])
+        w.stop_threads()
@@ -0,0 +1,112 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from ..plugins import Plugins, read_plugin_metadata
+from ..simple_config import SimpleConfig
+
+
+class TestPluginMetadata(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.init_path = os.path.join(self.tmpdir, "__init__.py")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, source):
+        with open(self.init_path, "w", encoding="utf-8") as f:
+            f.write(source)
+        return read_plugin_metadata(self.init_path)
+
+    def test_literals(self):
+        metadata = self.read(
+            '"""A plugin."""\n'
+            "from electroncash.i18n import _\n"
+            "fullname = _('My Plugin')\n"
+            "description = [_('First.'), ' ', _('Second.') + ' ' + _('Third.')]\n"
+            "requires = [('amodem', 'http://example.com/')]\n"
+            "registers_keystore = ('hardware', 'mine', _('My wallet'))\n"
+            "available_for = ['qt', 'cmdline']\n"
+            "default_on = True\n"
+        )
+        self.assertEqual(
+            metadata,
+            {
+                "fullname": "My Plugin",
+                "description": ["First.", " ", "Second. Third."],
+                "requires": [("amodem", "http://example.com/")],
+                "registers_keystore": ("hardware", "mine", "My wallet"),
+                "available_for": ["qt", "cmdline"],
+                "default_on": True,
+            },
+        )
+
+    def test_not_static(self):
+        source = "fullname = f'{PROJECT_NAME} plugin'\n"  # noqa: FS003
+        self.assertIsNone(self.read(source))
+        self.assertIsNone(self.read("fullname = get_name()\n"))
+        self.assertIsNone(self.read("if True:\n    fullname = 'x'\n"))
+        self.assertIsNone(self.read("fullname = \n"))
+
+    def test_internal_plugins(self):
+        # The metadata of the internal plugins is the same as when importing them
+        import electroncash_plugins
+
+        root = os.path.dirname(electroncash_plugins.__file__)
+        for name in ("fusion", "trezor", "virtualkeyboard", "audio_modem"):
+            metadata = read_plugin_metadata(os.path.join(root, name, "__init__.py"))
+            module = __import__("electroncash_plugins." + name, fromlist=["_"])
+            for key, value in metadata.items():
+                self.assertEqual(value, getattr(module, key), (name, key))
+
+
+class TestDeferredPlugins(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = SimpleConfig({"data_path": self.tmpdir})
+        self.plugins = None
+
+    def tearDown(self):
+        if self.plugins:
+            for plugin in list(self.plugins.internal_plugins.values()):
+                plugin.close()
+            self.plugins.stop()
+            self.plugins.join()
+        shutil.rmtree(self.tmpdir)
+
+    def test_daemon_command_loads_plugin(self):
+        if "electroncash_plugins.fusion.plugin" in sys.modules:
+            self.skipTest("fusion was already imported")
+        self.plugins = Plugins(self.config, "cmdline")
+        # fusion is on by default, but only needed by its daemon commands
+        self.assertTrue(self.config.get("use_fusion"))
+        self.assertIn("fusion", self.plugins.internal_plugin_metadata)
+        self.assertIsNone(self.plugins.get_internal_plugin("fusion"))
+        self.assertNotIn("electroncash_plugins.fusion.plugin", sys.modules)
+        self.assertEqual(
+            self.plugins.deferred_daemon_commands["fusion_server_status"],
+            ("fusion", False),
+        )
+
+        command = self.plugins.get_daemon_command("fusion_server_status")
+        self.assertIsNotNone(command)
+        self.assertIsNotNone(self.plugins.get_internal_plugin("fusion"))
+        self.assertEqual(self.plugins.deferred_daemon_commands, {})
+        self.assertIs(
+            self.plugins.get_daemon_command("fusion_server_stop").__self__,
+            command.__self__,
+        )
+        self.assertIsNone(self.plugins.get_daemon_command("nope"))
+
+    def test_hardware_plugins_deferred(self):
+        self.config.set_key("use_trezor", True)
+        self.plugins = Plugins(self.config, "cmdline")
+        self.assertIn("trezor", self.plugins.hw_wallets)
+        self.assertIsNone(self.plugins.get_internal_plugin("trezor"))
+
+
+if __name__ == "__main__":
+    unittest.main()
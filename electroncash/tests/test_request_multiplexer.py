@@ -0,0 +1,98 @@
+import unittest
+
+from ..request_multiplexer import RequestMultiplexer
+
+GET_TX = "blockchain.transaction.get"
+GET_HISTORY = "blockchain.scripthash.get_history"
+GET_MERKLE = "blockchain.transaction.get_merkle"
+
+
+class Recorder:
+    def __init__(self):
+        self.responses = []
+
+    def __call__(self, response):
+        self.responses.append(response)
+
+
+class TestRequestMultiplexer(unittest.TestCase):
+    def setUp(self):
+        self.mux = RequestMultiplexer()
+
+    def test_not_shareable(self):
+        self.assertFalse(self.mux.is_shareable("blockchain.transaction.broadcast"))
+        self.assertEqual(self.mux.on_response("server.ping", [], {"result": None}), [])
+
+    def test_in_flight_requests_are_shared(self):
+        a, b, c = Recorder(), Recorder(), Recorder()
+        self.assertFalse(self.mux.submit(GET_HISTORY, ["sh"], a))
+        self.assertTrue(self.mux.submit(GET_HISTORY, ["sh"], b))
+        self.assertTrue(self.mux.submit(GET_HISTORY, ["sh"], c))
+        # a different scripthash is a different request
+        self.assertFalse(self.mux.submit(GET_HISTORY, ["other"], a))
+        response = {"id": 1, "result": [], "method": GET_HISTORY, "params": ["sh"]}
+        shared = self.mux.on_response(GET_HISTORY, ["sh"], response)
+        self.assertEqual([cb for cb, _ in shared], [b, c])
+        for _, r in shared:
+            self.assertEqual(r, response)
+            self.assertIsNot(r, response)
+        # histories are not cached
+        self.assertFalse(self.mux.submit(GET_HISTORY, ["sh"], a))
+
+    def test_results_are_cached(self):
+        a, b = Recorder(), Recorder()
+        self.assertFalse(self.mux.submit(GET_TX, ["txid"], a))
+        self.mux.on_response(GET_TX, ["txid"], {"result": "00", "params": ["txid"]})
+        self.assertTrue(self.mux.submit(GET_TX, ["txid"], b))
+        ready = self.mux.pop_ready()
+        self.assertEqual(len(ready), 1)
+        self.assertIs(ready[0][0], b)
+        self.assertEqual(ready[0][1]["result"], "00")
+        self.assertEqual(ready[0][1]["method"], GET_TX)
+        self.assertEqual(self.mux.pop_ready(), [])
+        # errors are not cached
+        self.assertFalse(self.mux.submit(GET_TX, ["bad"], a))
+        self.mux.on_response(GET_TX, ["bad"], {"error": "no such tx"})
+        self.assertFalse(self.mux.submit(GET_TX, ["bad"], a))
+        stats = self.mux.stats()
+        self.assertEqual(stats["cache_hits"], 1)
+        self.assertEqual(stats["cached"][GET_TX], 1)
+
+    def test_forget_merkle_proofs(self):
+        a = Recorder()
+        for params in (["txid", 100], ["txid2", 100]):
+            self.mux.submit(GET_MERKLE, params, a)
+            self.mux.on_response(GET_MERKLE, params, {"result": {"pos": 1}})
+        self.assertTrue(self.mux.submit(GET_MERKLE, ["txid", 100], a))
+        # a proof that failed to verify is asked again
+        self.mux.forget(GET_MERKLE, ["txid", 100])
+        self.assertFalse(self.mux.submit(GET_MERKLE, ["txid", 100], a))
+        self.assertTrue(self.mux.submit(GET_MERKLE, ["txid2", 100], a))
+        # all the proofs are asked again after a reorg
+        self.mux.clear_cache(GET_MERKLE)
+        self.assertFalse(self.mux.submit(GET_MERKLE, ["txid2", 100], a))
+        # not cached, nothing to forget
+        self.mux.forget(GET_HISTORY, ["sh"])
+        self.mux.clear_cache(GET_HISTORY)
+
+    def test_cancel_hands_request_over(self):
+        a, b = Recorder(), Recorder()
+        self.mux.submit(GET_HISTORY, ["sh"], a)
+        self.mux.submit(GET_HISTORY, ["sh"], b)
+        self.assertIs(self.mux.take_waiter(GET_HISTORY, ["sh"]), b)
+        self.assertEqual(self.mux.on_response(GET_HISTORY, ["sh"], {"result": []}), [])
+        # nobody else waiting: the request is forgotten
+        self.mux.submit(GET_HISTORY, ["sh"], a)
+        self.assertIsNone(self.mux.take_waiter(GET_HISTORY, ["sh"]))
+        self.assertFalse(self.mux.submit(GET_HISTORY, ["sh"], a))
+
+    def test_cancel_waiter(self):
+        a, b = Recorder(), Recorder()
+        self.mux.submit(GET_HISTORY, ["sh"], a)
+        self.mux.submit(GET_HISTORY, ["sh"], b)
+        self.assertEqual(self.mux.cancel(b), 1)
+        self.assertEqual(self.mux.on_response(GET_HISTORY, ["sh"], {"result": []}), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from ..server_health import DEFAULT_LATENCY, ServerHealth, ServerStats
+
+
+class TestServerHealth(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "recent-servers-health")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_unknown_server(self):
+        health = ServerHealth()
+        self.assertEqual(health.score("a:1:s"), DEFAULT_LATENCY)
+        self.assertIsNone(health.snapshot("a:1:s"))
+
+    def test_score_prefers_fast_and_reliable(self):
+        fast, slow, flaky = ServerStats(), ServerStats(), ServerStats()
+        for _ in range(5):
+            fast.record_ping(0.05)
+            slow.record_ping(0.5)
+            flaky.record_ping(0.05)
+            fast.record_response(0.05)
+            flaky.record_response(0.05, error=True)
+        flaky.record_timeout()
+        self.assertLess(fast.score(), slow.score())
+        self.assertLess(fast.score(), flaky.score())
+
+    def test_throughput(self):
+        stats = ServerStats()
+        stats.record_response(0.1, 100)
+        self.assertIsNone(stats.throughput)
+        stats.record_response(1.0, 160_000)
+        self.assertEqual(stats.throughput, 160_000)
+        self.assertEqual(stats.bytes_received, 160_100)
+
+    def test_counters_decay(self):
+        stats = ServerStats()
+        for _ in range(1000):
+            stats.record_connect_failure()
+        self.assertLessEqual(stats.connect_failures, 201)
+        self.assertEqual(stats.failure_ratio(), 1.0)
+
+    def test_persistence(self):
+        health = ServerHealth(self.path)
+        health.connect_started_now("a:1:s")
+        health.connect_finished("a:1:s", True)
+        health.connect_finished("b:1:s", False)
+        health.get("a:1:s").record_ping(0.2)
+        health.save()
+
+        loaded = ServerHealth(self.path)
+        a = loaded.snapshot("a:1:s")
+        self.assertEqual(a["connects"], 1)
+        self.assertAlmostEqual(a["ping_rtt"], 0.2)
+        self.assertEqual(loaded.snapshot("b:1:s")["connect_failures"], 1)
+
+    def test_corrupt_file_is_ignored(self):
+        with open(self.path, "w") as f:
+            f.write("[not a dict")
+        self.assertEqual(ServerHealth(self.path).stats, {})
+
+    def test_pick(self):
+        health = ServerHealth()
+        health.get("fast:1:s").record_ping(0.05)
+        health.get("slow:1:s").record_ping(2.0)
+        rng = random.Random(1)
+        servers = ["fast:1:s", "slow:1:s", "new:1:s"]
+        for _ in range(20):
+            self.assertEqual(health.pick_best(servers, rng), "fast:1:s")
+        picks = [health.pick_weighted(servers, rng) for _ in range(1000)]
+        self.assertGreater(picks.count("fast:1:s"), picks.count("new:1:s"))
+        self.assertGreater(picks.count("new:1:s"), picks.count("slow:1:s"))
+        self.assertIsNone(health.pick_best([], rng))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,9 +3,12 @@ import os
 import shutil
 import sys
 import tempfile
+import time
 import unittest
 from io import StringIO
+from unittest import mock
 
+from .. import simple_config
 from ..simple_config import SimpleConfig, read_user_config
 
 
@@ -118,6 +121,68 @@ class Test_SimpleConfig(unittest.TestCase):
         result.pop("config_version", None)
         self.assertEqual({"something": "a"}, result)
 
+    def _count_writes(self):
+        writes = []
+        original = simple_config._write_user_config
+
+        def write(text, path):
+            original(text, path)
+            writes.append(text)
+
+        patcher = mock.patch.object(simple_config, "_write_user_config", write)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return writes
+
+    def _read_config_file(self):
+        with open(os.path.join(self.electrum_dir, "config"), "r") as f:
+            return ast.literal_eval(f.read())
+
+    def test_set_key_writes_are_coalesced(self):
+        writes = self._count_writes()
+        config = SimpleConfig(self.options)
+        config.flush_delay = 0.05
+        for i in range(100):
+            config.set_key(f"key{i}", i)
+        self.assertEqual(writes, [])
+        self.assertTrue(config.dirty)
+        for _ in range(100):
+            if writes:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(writes), 1)
+        self.assertFalse(config.dirty)
+        self.assertEqual(self._read_config_file()["key99"], 99)
+        self.assertEqual(os.listdir(self.electrum_dir), ["config"])
+
+    def test_flush(self):
+        writes = self._count_writes()
+        config = SimpleConfig(self.options)
+        config.flush_delay = 60
+        config.set_key("a", 1)
+        config.set_key("b", 2, save=False)
+        config.flush()
+        self.assertIsNone(config.flush_timer)
+        self.assertEqual(self._read_config_file()["a"], 1)
+        self.assertEqual(self._read_config_file()["b"], 2)
+        # Nothing changed since
+        config.flush()
+        self.assertEqual(len(writes), 1)
+        # save_user_config() writes right away
+        config.set_key("a", None, save=False)
+        config.save_user_config()
+        self.assertNotIn("a", self._read_config_file())
+        self.assertEqual(len(writes), 2)
+
+    def test_flush_at_exit(self):
+        config = SimpleConfig(self.options)
+        config.flush_delay = 60
+        config.set_key("a", 1)
+        self.assertIn(config, simple_config._unflushed_configs)
+        simple_config._flush_all()
+        self.assertNotIn(config, simple_config._unflushed_configs)
+        self.assertEqual(self._read_config_file()["a"], 1)
+
 
 class TestUserConfig(unittest.TestCase):
     def setUp(self):
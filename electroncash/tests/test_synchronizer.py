@@ -0,0 +1,158 @@
+import hashlib
+import os
+import unittest
+
+from ..synchronizer import (
+    PRIORITY_PRUNED,
+    AddressStatusCache,
+    Synchronizer,
+    TxDownloadQueue,
+)
+from ..util import bh2u
+
+
+def reference_status(h):
+    if not h:
+        return None
+    status = ""
+    for tx_hash, height in h:
+        status += f"{tx_hash}:{height}:"
+    return bh2u(hashlib.sha256(status.encode("ascii")).digest())
+
+
+def random_txid():
+    return bh2u(os.urandom(32))
+
+
+class TestAddressStatusCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = AddressStatusCache()
+        self.hist = [(random_txid(), height) for height in range(100, 200)]
+
+    def check(self, h, scripthash="sh"):
+        self.assertEqual(self.cache.get_status(h, scripthash), reference_status(h))
+
+    def test_empty(self):
+        self.assertIsNone(self.cache.get_status([], "sh"))
+        self.assertIsNone(self.cache.get_status(None))
+
+    def test_uncached(self):
+        self.check(self.hist, None)
+        self.assertEqual(self.cache.entries, {})
+
+    def test_cached_and_incremental(self):
+        h = list(self.hist)
+        self.check(h)
+        self.check(h)
+        # mempool entries
+        h = h + [(random_txid(), 0), (random_txid(), -1)]
+        self.check(h)
+        # the mempool entries get confirmed, and a new one shows up
+        h = h[:-2] + [(h[-2][0], 200), (h[-1][0], 200), (random_txid(), 0)]
+        self.check(h)
+        # appended in place, as done by Abstract_Wallet.add_tx_to_history
+        h.append((random_txid(), 0))
+        self.check(h)
+        self.assertEqual(len(self.cache.entries), 1)
+
+    def test_reorg(self):
+        h = list(self.hist)
+        self.check(h)
+        h = h[:50] + [(tx_hash, height + 1) for tx_hash, height in h[50:]]
+        self.check(h)
+        # a history that does not share the prefix at all
+        self.check([(random_txid(), 5)])
+
+    def test_list_entries(self):
+        # histories loaded from the wallet file contain lists
+        h = [list(item) for item in self.hist]
+        self.check(h)
+        self.check(list(self.hist))
+
+
+class TestTxDownloadQueue(unittest.TestCase):
+    def test_order(self):
+        queue = TxDownloadQueue(lambda: 1000)
+        queue.push("old", 10)
+        queue.push("older", 5)
+        queue.push("mempool", 0)
+        queue.push("recent", 998)
+        queue.push("unconfirmed_parent", -1)
+        queue.push("pruned", 3, PRIORITY_PRUNED)
+        order = [queue.pop()[0] for _ in range(len(queue))]
+        self.assertEqual(
+            order, ["mempool", "unconfirmed_parent", "recent", "pruned", "old", "older"]
+        )
+        self.assertRaises(IndexError, queue.pop)
+
+    def test_promote(self):
+        queue = TxDownloadQueue(lambda: 1000)
+        queue.push("a", 20)
+        queue.push("b", 10)
+        queue.promote("b", PRIORITY_PRUNED)
+        queue.promote("not queued", PRIORITY_PRUNED)
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.pop(), ("b", 10))
+        self.assertEqual(queue.pop(), ("a", 20))
+        self.assertEqual(len(queue), 0)
+
+
+class FakeNetwork:
+    def __init__(self):
+        self.config = {"synchronizer_max_tx_requests": 3}
+        self.sent = []
+        self.callbacks = []
+
+    def get_local_height(self):
+        return 1000
+
+    def send(self, messages, callback):
+        self.sent.extend(params[0] for method, params in messages)
+
+    def subscribe_to_scripthashes(self, hashes, callback):
+        pass
+
+    def trigger_callback(self, event, *args):
+        self.callbacks.append((event,) + args)
+
+
+class FakeWallet:
+    def __init__(self, history):
+        self._history = history
+        self.transactions = {}
+        self.pruned_txo = {"pruned_parent:0": "spender"}
+
+    def get_addresses(self):
+        return []
+
+    def diagnostic_name(self):
+        return "fake"
+
+
+class TestSynchronizerTxQueue(unittest.TestCase):
+    def test_bounded_and_prioritized(self):
+        history = {
+            "addr1": [("a", 100), ("pruned_parent", 101), ("b", 999)],
+            "addr2": [("c", 200), ("d", 0), ("e", 300)],
+        }
+        network = FakeNetwork()
+        sync = Synchronizer(FakeWallet(history), network)
+        self.assertEqual(network.sent, ["d", "b", "pruned_parent"])
+        self.assertEqual(len(sync.requested_tx), 6)
+        self.assertFalse(sync.is_up_to_date())
+        # Answering a request lets the next one go
+        sync.tx_response({"params": ["d"], "error": "gone"})
+        self.assertEqual(network.sent[-1], "e")
+        self.assertEqual(len(sync.tx_in_flight), 3)
+        sync.report_progress(force=True)
+        self.assertEqual(network.callbacks[-1], ("sync_progress", sync.wallet, 1, 6))
+        for tx_hash in ["b", "pruned_parent", "e", "c", "a"]:
+            sync.tx_response({"params": [tx_hash], "error": "gone"})
+        self.assertEqual(network.sent[-2:], ["c", "a"])
+        self.assertTrue(sync.is_up_to_date())
+        sync.report_progress()
+        self.assertEqual(network.callbacks[-1], ("sync_progress", sync.wallet, 6, 6))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+import urllib.request
+
+from .. import tracing
+from ..metrics_server import MetricsServer
+from ..util import profiler
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        tracing.reset()
+
+    def tearDown(self):
+        tracing.set_enabled(False)
+        tracing.reset()
+
+    def test_disabled(self):
+        @tracing.traced("f")
+        def f(x):
+            return x + 1
+
+        self.assertEqual(f(1), 2)
+        with tracing.span("s"):
+            pass
+        tracing.count("c")
+        self.assertEqual(
+            tracing.snapshot(), {"enabled": False, "spans": {}, "counters": {}}
+        )
+
+    def test_spans_and_counters(self):
+        tracing.set_enabled(True)
+
+        @tracing.traced("f")
+        def f(fail):
+            if fail:
+                raise ValueError
+            return 1
+
+        @profiler
+        def g():
+            return 2
+
+        f(False)
+        with self.assertRaises(ValueError):
+            f(True)
+        self.assertEqual(f.__name__, "f")
+        self.assertEqual(g(), 2)
+        with tracing.span("s"):
+            pass
+        tracing.count("c")
+        tracing.count("c", 2)
+        snapshot = tracing.snapshot()
+        self.assertEqual(snapshot["counters"], {"c": 3})
+        self.assertEqual(snapshot["spans"]["f"]["count"], 2)
+        self.assertEqual(snapshot["spans"]["f"]["errors"], 1)
+        self.assertEqual(snapshot["spans"]["s"]["count"], 1)
+        self.assertEqual(
+            snapshot["spans"]["TestTracing.test_spans_and_counters.<locals>.g"][
+                "count"
+            ],
+            1,
+        )
+
+    def test_prometheus(self):
+        tracing.set_enabled(True)
+        tracing.observe('rpc."x"', 0.003)
+        tracing.observe('rpc."x"', 50.0, error=True)
+        tracing.count("network.requests", 5)
+        text = tracing.prometheus_text()
+        expected = (
+            'electrumabc_span_seconds_bucket{span="rpc.\\"x\\"",le="0.0025"} 0',  # noqa: FS003
+            'electrumabc_span_seconds_bucket{span="rpc.\\"x\\"",le="0.005"} 1',  # noqa: FS003
+            'electrumabc_span_seconds_bucket{span="rpc.\\"x\\"",le="+Inf"} 2',  # noqa: FS003
+            'electrumabc_span_seconds_count{span="rpc.\\"x\\""} 2',  # noqa: FS003
+            'electrumabc_span_errors_total{span="rpc.\\"x\\""} 1',  # noqa: FS003
+            'electrumabc_events_total{name="network.requests"} 5',  # noqa: FS003
+        )
+        for line in expected:
+            self.assertIn(line, text)
+
+        server = MetricsServer("127.0.0.1", 0)
+        server.start()
+        try:
+            host, port = server.server_address[:2]
+            with urllib.request.urlopen(
+                f"http://{host}:{port}/metrics", timeout=10
+            ) as f:
+                self.assertIn(b"electrumabc_events_total", f.read())
+        finally:
+            server.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
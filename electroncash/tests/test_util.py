@@ -11,6 +11,7 @@ import locale
 import unittest
 
 from ..util import (
+    ListingPager,
     _fmt_sats_cache,
     clear_cached_dp,
     format_satoshis,
@@ -44,7 +45,7 @@ class _TestFormatSatoshis(unittest.TestCase):
                 cls.dp = "."
                 cls.ts = ","
         finally:
-            _fmt_sats_cache.d.clear()
+            _fmt_sats_cache.clear()
             clear_cached_dp()
 
     @classmethod
@@ -157,6 +158,48 @@ class TestFormatSatoshisLocalezh_CN(_TestFormatSatoshis):
 
 
 class TestUtil(unittest.TestCase):
+    def test_listing_pager(self):
+        pager = ListingPager()
+        items = {i: {"id": i} for i in range(10)}
+        computed = []
+
+        def make_keys():
+            computed.append(len(items))
+            return list(items)
+
+        def page(**kwargs):
+            return [x["id"] for x in pager.page("l", make_keys, items.get, **kwargs)]
+
+        self.assertEqual(page(), list(range(10)))
+        self.assertEqual(page(offset=8), [8, 9])
+        self.assertEqual(page(limit=3), [0, 1, 2])
+        self.assertEqual(page(offset=2, limit=3), [2, 3, 4])
+        self.assertEqual(len(computed), 4)
+        # the next pages take the keys of the first page, and the items gone
+        # since are skipped before the offset and limit
+        del items[5]
+        items[4]["id"] = 40
+        self.assertEqual(page(cursor=3, limit=3), [40, 6, 7])
+        self.assertEqual(page(cursor=4, limit=3), [6, 7, 8])
+        self.assertEqual(page(cursor=4, offset=1, limit=3), [7, 8, 9])
+        self.assertEqual(page(cursor=9), [])
+        self.assertEqual(len(computed), 4)
+        self.assertEqual(page(limit=0), [])
+        # a cursor that is not in the listing: it is computed again
+        self.assertEqual(page(cursor=3, limit=2), [40, 6])
+        self.assertRaises(ValueError, page, cursor=5, limit=2)
+        self.assertEqual(len(computed), 6)
+        self.assertRaises(ValueError, page, offset=-1)
+        self.assertRaises(ValueError, page, limit=-1)
+
+    def test_listing_pager_records(self):
+        pager = ListingPager()
+        records = [(i, i * 10) for i in range(5)]
+        page = pager.page(
+            "l", lambda: records, lambda r: r[1], cursor=2, key=lambda r: r[0]
+        )
+        self.assertEqual(page, [30, 40])
+
     def _do_test_parse_URI(self, uri, expected):
         result = parse_URI(uri)
         self.assertEqual(expected, result)
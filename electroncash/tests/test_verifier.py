@@ -0,0 +1,89 @@
+import os
+import unittest
+
+from ..bitcoin import Hash, hash_encode
+from ..verifier import SPV, MerkleNodeCache
+
+
+def merkle_tree(leaves):
+    """Return the list of levels of the merkle tree built over leaves
+    (bytes, internal byte order), from the leaves up to the root."""
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) & 1:
+            level = level + [level[-1]]
+        levels.append([Hash(level[i] + level[i + 1]) for i in range(0, len(level), 2)])
+    return levels
+
+
+def merkle_branch(levels, pos):
+    branch = []
+    for level in levels[:-1]:
+        if len(level) & 1:
+            level = level + [level[-1]]
+        branch.append(hash_encode(level[pos ^ 1]))
+        pos >>= 1
+    return branch
+
+
+class TestMerkleNodeCache(unittest.TestCase):
+    def setUp(self):
+        self.leaves = [os.urandom(32) for _ in range(37)]
+        self.levels = merkle_tree(self.leaves)
+        self.root = hash_encode(self.levels[-1][0])
+
+    def check(self, cache, pos, branch=None):
+        if branch is None:
+            branch = merkle_branch(self.levels, pos)
+        return cache.verify(branch, hash_encode(self.leaves[pos]), pos, self.root)
+
+    def test_all_positions(self):
+        cache = MerkleNodeCache()
+        for pos in range(len(self.leaves)):
+            branch = merkle_branch(self.levels, pos)
+            self.assertEqual(
+                SPV.hash_merkle_root(branch, hash_encode(self.leaves[pos]), pos),
+                self.root,
+            )
+            self.assertEqual(self.check(cache, pos), (True, self.root))
+        # and again, this time mostly served from the cache
+        for pos in range(len(self.leaves)):
+            self.assertEqual(self.check(cache, pos), (True, self.root))
+
+    def test_bad_branch(self):
+        cache = MerkleNodeCache()
+        self.assertTrue(self.check(cache, 3)[0])
+        branch = merkle_branch(self.levels, 4)
+        branch[0] = hash_encode(os.urandom(32))
+        ok, computed = self.check(cache, 4, branch)
+        self.assertFalse(ok)
+        self.assertNotEqual(computed, self.root)
+        # wrong position
+        ok, _ = cache.verify(
+            merkle_branch(self.levels, 5), hash_encode(self.leaves[5]), 6, self.root
+        )
+        self.assertFalse(ok)
+
+    def test_unknown_tx_with_cached_block(self):
+        cache = MerkleNodeCache()
+        self.assertTrue(self.check(cache, 0)[0])
+        branch = merkle_branch(self.levels, 1)
+        ok, _ = cache.verify(branch, hash_encode(os.urandom(32)), 1, self.root)
+        self.assertFalse(ok)
+
+    def test_max_blocks(self):
+        cache = MerkleNodeCache(max_blocks=2)
+        for _ in range(3):
+            leaves = [os.urandom(32) for _ in range(4)]
+            levels = merkle_tree(leaves)
+            root = hash_encode(levels[-1][0])
+            ok, _ = cache.verify(
+                merkle_branch(levels, 2), hash_encode(leaves[2]), 2, root
+            )
+            self.assertTrue(ok)
+        self.assertEqual(len(cache.blocks), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,12 +3,17 @@ import os
 import shutil
 import sys
 import tempfile
+import threading
+import time
 import unittest
+from collections import OrderedDict
 from io import StringIO
 
 from ..address import Address
+from ..daemon import Daemon
 from ..simple_config import SimpleConfig
-from ..storage import FINAL_SEED_VERSION, WalletStorage
+from ..storage import FINAL_SEED_VERSION, STO_EV_USER_PW, SaveScheduler, WalletStorage
+from ..util import InvalidPassword
 from ..wallet import (
     Abstract_Wallet,
     Standard_Wallet,
@@ -72,6 +77,156 @@ class TestWalletStorage(WalletTestCase):
         self.assertEqual(some_dict, json.loads(contents))
 
 
+class TestSaveScheduler(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage = WalletStorage(self.wallet_path)
+        self.storage.write()
+        self.saved = []
+        self.scheduler = SaveScheduler(self.storage, {"count": self.save_count})
+        self.scheduler.max_delay = 0.2
+        self.count = 0
+
+    def tearDown(self):
+        self.scheduler.stop()
+        super().tearDown()
+
+    def save_count(self):
+        self.saved.append(self.count)
+        self.storage.put("count", self.count)
+
+    def read_file(self, path=None):
+        with open(path or self.wallet_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_marks_are_coalesced(self):
+        for self.count in range(1, 6):
+            self.scheduler.mark_dirty("count")
+        # nothing is saved before max_delay
+        self.assertEqual(self.saved, [])
+        self.assertNotIn("count", self.read_file())
+        deadline = time.monotonic() + 5
+        while "count" not in self.read_file() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.saved, [5])
+        self.assertEqual(self.read_file()["count"], 5)
+        self.assertFalse(self.storage.modified)
+        self.assertIsNone(self.scheduler.dirty_since)
+
+    def test_flush(self):
+        self.scheduler.max_delay = 60
+        self.count = 1
+        self.scheduler.mark_dirty("count")
+        self.storage.put("label", "x")
+        self.scheduler.flush()
+        self.assertEqual(self.saved, [1])
+        self.assertEqual(self.read_file()["count"], 1)
+        self.assertEqual(self.read_file()["label"], "x")
+        # nothing left to save
+        self.scheduler.flush()
+        self.assertEqual(self.saved, [1])
+        # flush can save data that was not marked before
+        self.count = 2
+        self.scheduler.flush("count")
+        self.assertEqual(self.read_file()["count"], 2)
+        with self.assertRaises(ValueError):
+            self.scheduler.mark_dirty("nope")
+
+    def test_stop(self):
+        self.scheduler.max_delay = 60
+        self.scheduler.mark_dirty("count")
+        thread = self.scheduler.thread
+        self.scheduler.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(self.scheduler.thread)
+        self.assertEqual(self.read_file()["count"], 0)
+        # it starts again
+        self.scheduler.mark_dirty()
+        self.assertTrue(self.scheduler.thread.is_alive())
+
+    def test_failed_save_is_retried(self):
+        self.scheduler.max_delay = 60
+
+        def fail():
+            raise OSError("disk full")
+
+        self.scheduler.savers["count"] = fail
+        with self.assertRaises(OSError):
+            self.scheduler.flush("count")
+        self.assertEqual(self.scheduler.pending, {"count"})
+        self.scheduler.savers["count"] = self.save_count
+        self.scheduler.flush()
+        self.assertEqual(self.read_file()["count"], 0)
+
+    def test_flush_waits_for_writer(self):
+        writing, release = threading.Event(), threading.Event()
+        write = self.storage._write
+
+        def slow_write(s):
+            writing.set()
+            release.wait(10)
+            write(s)
+
+        self.storage._write = slow_write
+        self.storage.put("label", "x")
+        writer = threading.Thread(target=self.storage.write)
+        writer.start()
+        self.assertTrue(writing.wait(10))
+        # the data is serialized, but not written yet
+        self.assertFalse(self.storage.modified)
+        done = []
+        flusher = threading.Thread(target=lambda: done.append(self.scheduler.flush()))
+        flusher.start()
+        time.sleep(0.2)
+        self.assertEqual(done, [])
+        release.set()
+        flusher.join(10)
+        self.assertEqual(done, [None])
+        self.assertEqual(self.read_file()["label"], "x")
+        writer.join()
+
+    def test_flush_after_failed_write(self):
+        write = self.storage._write
+
+        def failed_write(s):
+            self.storage._write = write
+            raise OSError("disk full")
+
+        self.storage._write = failed_write
+        self.storage.put("label", "x")
+        with self.assertRaises(OSError):
+            self.storage.write()
+        self.scheduler.flush()
+        self.assertEqual(self.read_file()["label"], "x")
+
+    def test_wallet_up_to_date(self):
+        path = os.path.join(self.user_dir, "otherwallet")
+        text = "xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d"
+        w = restore_wallet_from_text(text, path=path, config=self.config)["wallet"]
+        w.save_scheduler.max_delay = 60
+        addr = w.get_receiving_addresses()[0]
+        tx_hash = "0" * 63 + "1"
+        w._history[addr] = [(tx_hash, 100)]
+        w.set_up_to_date(True)
+        # the history is saved later, from the writer thread
+        self.assertIsNone(w.storage.get("addr_history"))
+        self.assertEqual(w.save_scheduler.pending, {"addresses", "transactions"})
+        w.save_scheduler.flush()
+        self.assertEqual(
+            self.read_file(path)["addr_history"][addr.to_storage_string()],
+            [[tx_hash, 100]],
+        )
+        w.stop_threads()
+        self.assertIsNone(w.save_scheduler.thread)
+
+    def test_write_from_daemon_thread(self):
+        self.storage.put("label", "x")
+        thread = threading.Thread(target=self.storage.write, daemon=True)
+        thread.start()
+        thread.join()
+        self.assertEqual(self.read_file()["label"], "x")
+
+
 class TestCreateRestoreWallet(WalletTestCase):
     def test_create_new_wallet(self):
         passphrase = "mypassphrase"
@@ -155,12 +310,181 @@ class TestCreateRestoreWallet(WalletTestCase):
         )
         self.assertEqual(1, len(wallet.get_receiving_addresses()))
 
+    def test_spv_proof_store(self):
+        text = "qr2q6aadv6nxmqwjt8qmax76yqp09mlqzq5jsz5fe9"
+        wallet = restore_wallet_from_text(
+            text, path=self.wallet_path, config=self.config
+        )["wallet"]
+        txid = "ab" * 32
+        branch = ["01" * 32, "02" * 32, "03" * 32]
+        self.assertIsNone(wallet.get_spv_proof(txid))
+        wallet.add_spv_proof(txid, 700000, 5, branch)
+        self.assertEqual(wallet.get_spv_proof(txid), (700000, 5, branch))
+        # malformed branches are not stored
+        wallet.add_spv_proof("cd" * 32, 700000, 5, ["zz"])
+        self.assertIsNone(wallet.get_spv_proof("cd" * 32))
+        wallet.save_verified_tx()
+        self.assertEqual(
+            wallet.storage.get("spv_proofs"), {txid: [700000, 5, "".join(branch)]}
+        )
+
+
+class TestAddressFilters(WalletTestCase):
+    def setUp(self):
+        super().setUp()
+        text = "xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d"
+        self.wallet = restore_wallet_from_text(
+            text, path=self.wallet_path, config=self.config
+        )["wallet"]
+        self.balances = {}
+        self.wallet.get_addr_balance = lambda addr: self.balances.get(addr, (0, 0, 0))
+
+    def set_state(self, addr, history, balance=0):
+        self.wallet._history[addr] = [("00" * 32, 100)] if history else []
+        self.balances[addr] = (balance, 0, 0)
+        self.wallet._addr_state.invalidate(addr)
+
+    def check_filters(self):
+        w = self.wallet
+        flags = ("receiving", "change", "frozen", "unused", "funded")
+        for mask in range(1 << len(flags)):
+            kwargs = {flag: bool(mask & (1 << i)) for i, flag in enumerate(flags)}
+            expected = [
+                addr
+                for addr in w.get_addresses()
+                if not (kwargs["frozen"] and not w.is_frozen(addr))
+                and not (kwargs["receiving"] and w.is_change(addr))
+                and not (kwargs["change"] and not w.is_change(addr))
+                and not (kwargs["unused"] and w.is_used(addr))
+                and not (kwargs["funded"] and w.is_empty(addr))
+            ]
+            self.assertEqual(w.get_filtered_addresses(**kwargs), expected, kwargs)
+
+    def test_filters(self):
+        recv = self.wallet.get_receiving_addresses()
+        change = self.wallet.get_change_addresses()
+        self.check_filters()
+        self.set_state(recv[3], history=True, balance=5)
+        self.set_state(recv[1], history=True)
+        self.set_state(change[2], history=True, balance=7)
+        self.set_state(change[0], history=True)
+        self.wallet.set_frozen_state([recv[1], change[2], recv[7]], True)
+        self.check_filters()
+        self.assertEqual(
+            self.wallet.get_filtered_addresses(funded=True), [recv[3], change[2]]
+        )
+        # spending, receiving, and history changes are picked up
+        self.set_state(recv[3], history=True, balance=0)
+        self.set_state(recv[5], history=True, balance=1)
+        self.set_state(change[0], history=False)
+        self.check_filters()
+        self.assertEqual(
+            self.wallet.get_filtered_addresses(funded=True), [recv[5], change[2]]
+        )
+        self.wallet._addr_state.invalidate_all()
+        self.check_filters()
+
+    def test_new_addresses(self):
+        w = self.wallet
+        self.check_filters()
+        recv = w.create_new_address(False)
+        change = w.create_new_address(True)
+        self.set_state(change, history=True)
+        self.check_filters()
+        self.assertEqual(
+            w.get_filtered_addresses(receiving=True, unused=True)[-1], recv
+        )
+        self.assertNotIn(change, w.get_filtered_addresses(unused=True))
+        w.invalidate_address_set_cache()
+        self.check_filters()
+
+    def test_imported_addresses(self):
+        addresses = [
+            Address.from_pubkey(bytes([2, i]) * 16 + b"\x02") for i in range(6)
+        ]
+        self.wallet = restore_wallet_from_text(
+            " ".join(a.to_ui_string() for a in addresses[:3]),
+            path=self.wallet_path + "2",
+            config=self.config,
+        )["wallet"]
+        self.wallet.get_addr_balance = lambda addr: self.balances.get(addr, (0, 0, 0))
+        self.set_state(addresses[0], history=True)
+        self.check_filters()
+        # imported addresses are inserted in the sorted address list
+        for addr in addresses[3:]:
+            self.wallet.import_address(addr)
+            self.set_state(addr, history=True, balance=1)
+            self.check_filters()
+
+
+class TestWarmWallets(WalletTestCase):
+    xpub = "xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d"
+
+    def setUp(self):
+        super().setUp()
+        restore_wallet_from_text(self.xpub, path=self.wallet_path, config=self.config)
+        # only the parts of the daemon used to load and stop wallets
+        self.daemon = Daemon.__new__(Daemon)
+        self.daemon.network = None
+        self.daemon.wallets = {}
+        self.daemon.wallet_locks = {}
+        self.daemon.wallet_locks_lock = threading.Lock()
+        self.daemon.warm_wallets = OrderedDict()
+        self.daemon.warm_wallets_lock = threading.Lock()
+        self.daemon.max_warm_wallets = 2
+
+    def test_reopen(self):
+        d = self.daemon
+        wallet = d.load_wallet(self.wallet_path, None)
+        self.assertIsNotNone(wallet)
+        d.stop_wallet(self.wallet_path)
+        self.assertEqual(list(d.warm_wallets), [self.wallet_path])
+        # the file did not change: the wallet is not loaded again
+        self.assertIs(d.load_wallet(self.wallet_path, None), wallet)
+        self.assertEqual(d.warm_wallets, {})
+        d.stop_wallet(self.wallet_path)
+        # the file changed
+        with open(self.wallet_path, "a", encoding="utf-8") as f:
+            f.write("\n")
+        wallet2 = d.load_wallet(self.wallet_path, None)
+        self.assertIsNot(wallet2, wallet)
+        d.stop_wallet(self.wallet_path)
+        d.delete_wallet(self.wallet_path)
+        self.assertEqual(d.warm_wallets, {})
+
+    def test_bounded(self):
+        d = self.daemon
+        paths = [self.wallet_path]
+        for name in ("w2", "w3"):
+            path = os.path.join(self.user_dir, name)
+            restore_wallet_from_text(self.xpub, path=path, config=self.config)
+            paths.append(path)
+        for path in paths:
+            d.load_wallet(path, None)
+            d.stop_wallet(path)
+        self.assertEqual(list(d.warm_wallets), paths[1:])
+
+    def test_encrypted(self):
+        d = self.daemon
+        storage = WalletStorage(self.wallet_path)
+        storage.set_password("secret", STO_EV_USER_PW)
+        storage.write()
+        wallet = d.load_wallet(self.wallet_path, "secret")
+        d.stop_wallet(self.wallet_path)
+        self.assertIsNone(d.load_wallet(self.wallet_path, None))
+        with self.assertRaises(InvalidPassword):
+            d.load_wallet(self.wallet_path, "wrong")
+        self.assertIs(d.load_wallet(self.wallet_path, "secret"), wallet)
+
 
 def suite():
     test_suite = unittest.TestSuite()
     loadTests = unittest.defaultTestLoader.loadTestsFromTestCase
+    test_suite.addTest(loadTests(TestAddressFilters))
     test_suite.addTest(loadTests(TestCreateRestoreWallet))
+    test_suite.addTest(loadTests(TestSaveScheduler))
     test_suite.addTest(loadTests(TestWalletStorage))
+    test_suite.addTest(loadTests(TestWarmWallets))
     return test_suite
 
 
@@ -0,0 +1,203 @@
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from ..address import Address
+from ..webhooks import AddressNotifier, WebhookDispatcher
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+
+class TestWebhookDispatcher(unittest.TestCase):
+    def make_dispatcher(self, send, **kwargs):
+        dispatcher = WebhookDispatcher(send=send, **kwargs)
+        self.addCleanup(dispatcher.stop, 5)
+        return dispatcher
+
+    def test_bounded_queue(self):
+        dispatcher = self.make_dispatcher(lambda *args: None, max_pending=2)
+        self.assertTrue(dispatcher.post("http://a/", {}))
+        self.assertTrue(dispatcher.post("http://a/", {}))
+        self.assertFalse(dispatcher.post("http://a/", {}))
+        dispatcher.start()
+        wait_for(lambda: dispatcher.stats()["delivered"] == 2)
+        stats = dispatcher.stats()
+        self.assertEqual(stats["dropped"], 1)
+        self.assertEqual(stats["pending"], 0)
+        self.assertEqual(stats["endpoints"]["http://a"]["latency"]["count"], 2)
+
+    def test_slow_endpoint_does_not_block_others(self):
+        release = threading.Event()
+        in_flight = {"slow": 0, "max_slow": 0}
+        lock = threading.Lock()
+        fast = []
+
+        def send(session, url, body):
+            if "slow" in url:
+                with lock:
+                    in_flight["slow"] += 1
+                    in_flight["max_slow"] = max(
+                        in_flight["max_slow"], in_flight["slow"]
+                    )
+                release.wait(10)
+                with lock:
+                    in_flight["slow"] -= 1
+            else:
+                fast.append(json.loads(body.decode()))
+
+        dispatcher = self.make_dispatcher(send, workers=4, per_endpoint=2)
+        dispatcher.start()
+        for i in range(10):
+            dispatcher.post("http://slow.example:8080/hook", {"n": i})
+        for i in range(5):
+            dispatcher.post("http://fast.example/hook", {"n": i})
+        wait_for(lambda: len(fast) == 5)
+        self.assertEqual(sorted(d["n"] for d in fast), list(range(5)))
+        stats = dispatcher.stats()["endpoints"]["http://slow.example:8080"]
+        self.assertEqual(stats["in_flight"], 2)
+        self.assertEqual(stats["backlog"], 8)
+        release.set()
+        wait_for(lambda: dispatcher.stats()["delivered"] == 15)
+        self.assertEqual(in_flight["max_slow"], 2)
+
+    def test_retry(self):
+        attempts = []
+
+        def send(session, url, body):
+            attempts.append(time.monotonic())
+            if len(attempts) < 3:
+                raise OSError("connection refused")
+
+        dispatcher = self.make_dispatcher(send, backoff=0.05)
+        dispatcher.start()
+        dispatcher.post("http://a/", {})
+        wait_for(lambda: dispatcher.stats()["delivered"] == 1)
+        self.assertEqual(len(attempts), 3)
+        self.assertGreaterEqual(attempts[2] - attempts[1], 0.09)
+        stats = dispatcher.stats()
+        self.assertEqual(stats["retried"], 2)
+        self.assertEqual(stats["failed"], 0)
+
+    def test_give_up(self):
+        def send(session, url, body):
+            raise OSError("connection refused")
+
+        dispatcher = self.make_dispatcher(send, backoff=0.001, max_attempts=3)
+        dispatcher.start()
+        dispatcher.post("http://a/", {})
+        wait_for(lambda: dispatcher.stats()["failed"] == 1)
+        stats = dispatcher.stats()
+        self.assertEqual(stats["retried"], 2)
+        self.assertEqual(stats["pending"], 0)
+
+
+class FakeConfig:
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key, default=None):
+        return default
+
+
+class FakeNetwork:
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.subscribed = []
+
+    def subscribe_to_scripthashes(self, hashes, callback):
+        self.subscribed.extend(hashes)
+
+    def unsubscribe_from_scripthashes(self, hashes, callback):
+        for h in hashes:
+            self.subscribed.remove(h)
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.posted = []
+
+    def start(self):
+        pass
+
+    def post(self, url, data):
+        self.posted.append((url, data))
+        return True
+
+
+class TestAddressNotifier(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = FakeConfig(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_watches(self):
+        address = Address.from_pubkey(bytes([2]) + bytes([1]) * 32).to_full_ui_string()
+        h = Address.from_string(address).to_scripthash_hex()
+        network = FakeNetwork(self.config)
+        notifier = AddressNotifier(self.config, network, FakeDispatcher())
+        notifier.add(address, "http://a/")
+        notifier.add(address, "http://b/")
+        self.assertEqual(network.subscribed, [h])
+        notifier.on_status({"params": [h], "result": "status"})
+        self.assertEqual(
+            sorted(notifier.dispatcher.posted),
+            [
+                ("http://a/", {"address": address, "status": "status"}),
+                ("http://b/", {"address": address, "status": "status"}),
+            ],
+        )
+
+        # watches survive a restart
+        network2 = FakeNetwork(self.config)
+        notifier2 = AddressNotifier(self.config, network2, FakeDispatcher())
+        notifier2.load()
+        self.assertEqual(network2.subscribed, [h])
+        self.assertEqual(
+            notifier2.watches,
+            {Address.from_string(address): {"http://a/", "http://b/"}},
+        )
+
+        self.assertTrue(notifier2.remove(address))
+        self.assertFalse(notifier2.remove(address))
+        self.assertEqual(network2.subscribed, [])
+        notifier2.on_status({"params": [h], "result": "status2"})
+        self.assertEqual(notifier2.dispatcher.posted, [])
+        notifier3 = AddressNotifier(
+            self.config, FakeNetwork(self.config), FakeDispatcher()
+        )
+        notifier3.load()
+        self.assertEqual(notifier3.watches, {})
+
+    def test_address_forms(self):
+        addr = Address.from_pubkey(bytes([2]) + bytes([1]) * 32)
+        h = addr.to_scripthash_hex()
+        network = FakeNetwork(self.config)
+        notifier = AddressNotifier(self.config, network, FakeDispatcher())
+        notifier.add(addr.to_full_ui_string(), "http://a/")
+        notifier.add(addr.to_cashaddr(), "http://b/")
+        notifier.add(addr.to_string(Address.FMT_LEGACY), "http://c/")
+        self.assertEqual(network.subscribed, [h])
+        self.assertEqual(
+            notifier.watches, {addr: {"http://a/", "http://b/", "http://c/"}}
+        )
+        notifier.on_status({"params": [h], "result": "status"})
+        self.assertEqual(len(notifier.dispatcher.posted), 3)
+        self.assertTrue(notifier.remove(addr.to_string(Address.FMT_LEGACY)))
+        self.assertEqual(network.subscribed, [])
+        self.assertEqual(notifier.watches, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,180 @@
+import json
+import os
+import queue
+import shutil
+import tempfile
+import time
+import unittest
+
+from ..address import Address
+from ..websockets import RequestRegistry, WsClientThread
+
+SUBSCRIBE = "blockchain.scripthash.subscribe"
+GET_BALANCE = "blockchain.scripthash.get_balance"
+
+
+def make_address(i):
+    return Address.from_pubkey(bytes([2]) + i.to_bytes(32, "big"))
+
+
+def write_request(rdir, request_id, address, amount):
+    path = os.path.join(rdir, "req", request_id[0], request_id[1], request_id)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, request_id + ".json"), "w", encoding="utf-8") as f:
+        json.dump({"address": address.to_full_ui_string(), "amount": amount}, f)
+    return os.path.join(path, request_id + ".json")
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.closed = False
+        self.messages = []
+
+    def sendMessage(self, message):
+        self.messages.append(message)
+
+
+class FakeNetwork:
+    def __init__(self):
+        self.sent = []
+        self.unsubscribed = []
+
+    def subscribe_to_scripthashes(self, hashes, callback):
+        self.sent.extend((SUBSCRIBE, h) for h in hashes)
+
+    def unsubscribe_from_scripthashes(self, hashes, callback):
+        self.unsubscribed.extend(hashes)
+
+    def send(self, messages, callback):
+        self.sent.extend((method, params[0]) for method, params in messages)
+
+
+class FakeWallet:
+    def __init__(self, balances):
+        self.balances = balances
+
+    def is_mine(self, addr):
+        return addr in self.balances
+
+    def get_addr_balance(self, addr):
+        return self.balances[addr], 0, 0
+
+
+class WebSocketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.rdir)
+
+
+class TestRequestRegistry(WebSocketTestCase):
+    def test_registry(self):
+        registry = RequestRegistry(self.rdir)
+        a, b = make_address(1), make_address(2)
+        path = write_request(self.rdir, "abc123", a, 1000)
+        self.assertEqual(registry.get("abc123"), (a, 1000))
+        self.assertIsNone(registry.get("nothere"))
+        self.assertIsNone(registry.get("../../etc/passwd"))
+        # served from memory
+        os.unlink(path)
+        self.assertEqual(registry.get("abc123"), (a, 1000))
+        registry.refresh()
+        self.assertIsNone(registry.get("abc123"))
+        # modified files are reloaded by refresh
+        path = write_request(self.rdir, "def456", a, 1)
+        registry.refresh()
+        self.assertEqual(registry.get("def456"), (a, 1))
+        write_request(self.rdir, "def456", b, 2)
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        registry.refresh()
+        self.assertEqual(registry.get("def456"), (b, 2))
+
+
+class TestWsClientThread(WebSocketTestCase):
+    def make_client_thread(self, wallets=None):
+        self.network = FakeNetwork()
+        self.events = queue.Queue()
+        return WsClientThread(
+            {"requests_dir": self.rdir}, self.network, wallets, self.events
+        )
+
+    def respond(self, t, method, addr, result):
+        h = addr.to_scripthash_hex()
+        t.on_response({"method": method, "params": [h], "result": result})
+
+    def test_load(self):
+        """Thousands of clients waiting on hundreds of requests."""
+        n_requests, clients_per_request = 500, 8
+        addresses = [make_address(i) for i in range(n_requests)]
+        for i, addr in enumerate(addresses):
+            write_request(self.rdir, f"req{i:04d}", addr, 1000)
+        t = self.make_client_thread()
+        t.registry.refresh()
+        sockets = []
+        t0 = time.monotonic()
+        for i in range(n_requests):
+            for _ in range(clients_per_request):
+                ws = FakeWebSocket()
+                sockets.append((i, ws))
+                t.process(("subscribe", ws, f"req{i:04d}"))
+        # one subscription per address
+        self.assertEqual(len(self.network.sent), n_requests)
+        # a quarter of the clients go away
+        for i, ws in sockets[::4]:
+            ws.closed = True
+            t.process(("close", ws))
+        # every address gets a status, half of them get paid
+        for i, addr in enumerate(addresses):
+            self.respond(t, SUBSCRIBE, addr, f"status{i}" if i % 2 else None)
+        self.assertEqual(len(self.network.sent), n_requests + n_requests // 2)
+        for i, addr in enumerate(addresses):
+            if i % 2:
+                self.respond(
+                    t, GET_BALANCE, addr, {"confirmed": 600, "unconfirmed": 400}
+                )
+        elapsed = time.monotonic() - t0
+        for i, ws in sockets:
+            expected = ["paid"] if i % 2 and not ws.closed else []
+            self.assertEqual(ws.messages, expected)
+        # paid and closed clients are all forgotten
+        self.assertEqual(len(t.subscriptions), n_requests // 2)
+        self.assertEqual(
+            sum(map(len, t.subscriptions.values())),
+            (n_requests // 2) * clients_per_request * 3 // 4,
+        )
+        self.assertEqual(
+            len(t.ws_addresses), (n_requests // 2) * clients_per_request * 3 // 4
+        )
+        self.assertLess(elapsed, 10)
+        # the paid addresses are unsubscribed from
+        self.assertEqual(
+            sorted(self.network.unsubscribed),
+            sorted(addr.to_scripthash_hex() for addr in addresses[1::2]),
+        )
+        # a repeated status does not trigger another balance request
+        n_sent = len(self.network.sent)
+        self.respond(t, SUBSCRIBE, addresses[0], None)
+        self.assertEqual(len(self.network.sent), n_sent)
+
+    def test_wallet_balance(self):
+        addr = make_address(1)
+        write_request(self.rdir, "abc123", addr, 1000)
+        wallet = FakeWallet({addr: 0})
+        t = self.make_client_thread({"w": wallet})
+        ws = FakeWebSocket()
+        t.process(("subscribe", ws, "abc123"))
+        self.respond(t, SUBSCRIBE, addr, "status")
+        # no round trip: the balance comes from the wallet
+        self.assertEqual(self.network.sent, [(SUBSCRIBE, addr.to_scripthash_hex())])
+        self.assertEqual(ws.messages, [])
+        wallet.balances[addr] = 1000
+        t.on_payment_received("payment_received", wallet, addr, None)
+        t.process(self.events.get_nowait())
+        self.assertEqual(ws.messages, ["paid"])
+        self.assertEqual(t.subscriptions, {})
+        self.assertEqual(self.network.unsubscribed, [addr.to_scripthash_hex()])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,235 @@
+# Electrum ABC - lightweight eCash client
+# Copyright (C) 2020 The Electrum ABC developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""In-process metrics: named spans and counters.
+
+A span measures the duration of a block of code (see span() and traced()),
+and the durations of each span are aggregated in a LatencyHistogram.
+Counters count events (see count()). Everything is kept in memory, and can
+be read with snapshot() (the "daemon metrics" command), or scraped in the
+Prometheus text format from a MetricsServer (see metrics_server.py, and
+the 'metrics_port' config key).
+
+Tracing is off unless enabled with set_enabled(), or with the 'tracing'
+config key of the daemon. When it is off, a traced function only costs an
+extra call and the check of a global flag.
+"""
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the latency histogram buckets. The last bucket
+# counts everything slower.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRICS_PREFIX = "electrumabc"
+
+
+class LatencyHistogram:
+    ''' Counts call durations in fixed buckets (see LATENCY_BUCKETS). Not
+    thread-safe by itself. '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def add(self, duration, error=False):
+        self.counts[bisect_left(self.buckets, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        if error:
+            self.errors += 1
+
+    def quantile(self, q):
+        ''' Upper bound of the bucket holding the q-quantile, or None. '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        buckets = {str(bound): n for bound, n in zip(self.buckets, self.counts) if n}
+        if self.counts[-1]:
+            buckets['+Inf'] = self.counts[-1]
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': buckets,
+        }
+
+
+_enabled = False
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+
+
+def is_enabled():
+    return _enabled
+
+
+def set_enabled(b):
+    global _enabled
+    _enabled = bool(b)
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def observe(name, duration, error=False):
+    ''' Records a duration, in seconds, for the span name. '''
+    if not _enabled:
+        return
+    with _lock:
+        h = _spans.get(name)
+        if h is None:
+            h = _spans[name] = LatencyHistogram()
+        h.add(duration, error)
+
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+class _Span:
+    __slots__ = ('name', 't0')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        observe(self.name, time.perf_counter() - self.t0, exc_type is not None)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def span(name):
+    ''' Context manager measuring the duration of its block as the span
+    name. Exceptions count as errors. '''
+    if not _enabled:
+        return _null_span
+    return _Span(name)
+
+
+def traced(name=None):
+    ''' Decorator measuring each call of the decorated function as the span
+    name (by default, the qualified name of the function). '''
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            error = True
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                observe(span_name, time.perf_counter() - t0, error)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    with _lock:
+        return {
+            'enabled': _enabled,
+            'spans': {name: h.to_dict() for name, h in sorted(_spans.items())},
+            'counters': dict(sorted(_counters.items())),
+        }
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text():
+    ''' The metrics in the Prometheus text exposition format. '''
+    lines = []
+    with _lock:
+        spans = [(name, list(h.counts), h.buckets, h.count, h.total, h.errors)
+                 for name, h in sorted(_spans.items())]
+        counters = sorted(_counters.items())
+    metric = METRICS_PREFIX + '_span_seconds'
+    lines.append('# HELP {} Duration of the traced spans.'.format(metric))
+    lines.append('# TYPE {} histogram'.format(metric))
+    for name, counts, buckets, n, total, errors in spans:
+        label = 'span="{}"'.format(_label(name))
+        cumulative = 0
+        for bound, c in zip(buckets, counts):
+            cumulative += c
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, label, bound, cumulative))
+        lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(metric, label, n))
+        lines.append('{}_sum{{{}}} {}'.format(metric, label, total))
+        lines.append('{}_count{{{}}} {}'.format(metric, label, n))
+    metric = METRICS_PREFIX + '_span_errors_total'
+    lines.append('# HELP {} Traced spans that raised an exception.'.format(metric))
+    lines.append('# TYPE {} counter'.format(metric))
+    for name, counts, buckets, n, total, errors in spans:
+        lines.append('{}{{span="{}"}} {}'.format(metric, _label(name), errors))
+    metric = METRICS_PREFIX + '_events_total'
+    lines.append('# HELP {} Counted events.'.format(metric))
+    lines.append('# TYPE {} counter'.format(metric))
+    for name, n in counters:
+        lines.append('{}{{name="{}"}} {}'.format(metric, _label(name), n))
+    return '\n'.join(lines) + '\n'
+
@@ -39,6 +39,7 @@ from .address import (PublicKey, Address, Script, ScriptOutput, hash160,
                       UnknownAddress, OpCodes as opcodes,
                       P2PKH_prefix, P2PKH_suffix, P2SH_prefix, P2SH_suffix)
 from . import schnorr
+from . import tracing
 from .util import bh2u, bfh, to_bytes
 
 #
@@ -940,6 +941,7 @@ class Transaction:
         return sig
 
 
+    @tracing.traced('transaction.sign')
     def sign(self, keypairs, *, use_cache=False):
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
@@ -1016,15 +1018,12 @@ class Transaction:
     # been thoughtfully calibrated to provide a decent tradeoff between
     # memory consumption and UX.
     #
-    # In even aggressive/pathological cases this cache won't ever exceed
-    # 100MB even when full. [see ExpiringCache.size_bytes() to test it].
-    # This is acceptable considering this is Python + Qt and it eats memory
-    # anyway.. and also this is 2019 ;). Note that all tx's in this cache
-    # are in the non-deserialized state (hex encoded bytes only) as a memory
-    # savings optimization.  Please maintain that invariant if you modify this
-    # code, otherwise the cache may grow to 10x memory consumption if you
-    # put deserialized tx's in here.
-    _fetched_tx_cache = ExpiringCache(maxlen=1000, name="TransactionFetchCache")
+    # The cache holds the raw hex of the transactions, and is bounded both in
+    # number of transactions and in bytes, since transactions can be anywhere
+    # from a couple hundred bytes to 100kB or more. Please keep only raw hex
+    # in there: deserialized tx's use up 10x more memory.
+    _fetched_tx_cache = ExpiringCache(maxlen=10000, max_bytes=32 * 1024 * 1024,
+                                      name="TransactionFetchCache")
 
     def fetch_input_data(self, wallet, done_callback=None, done_args=tuple(),
                          prog_callback=None, *, force=False, use_network=True):
@@ -1311,13 +1310,9 @@ class Transaction:
         ''' Attempts to retrieve txid from the tx cache that this class
         keeps in-memory.  Returns None on failure. The returned tx is
         not deserialized, and is a copy of the one in the cache. '''
-        tx = cls._fetched_tx_cache.get(txid)
-        if tx is not None and tx.raw:
-            # make sure to return a copy of the transaction from the cache
-            # so that if caller does .deserialize(), *his* instance will
-            # use up 10x memory consumption, and not the cached instance which
-            # should just be an undeserialized raw tx.
-            return Transaction(tx.raw)
+        raw = cls._fetched_tx_cache.get(txid)
+        if raw:
+            return Transaction(raw)
         return None
 
     @classmethod
@@ -1326,7 +1321,7 @@ class Transaction:
         if not tx or not tx.raw:
             raise ValueError('Please pass a tx which has a valid .raw attribute!')
         txid = txid or cls._txid(tx.raw)  # optionally, caller can pass-in txid to save CPU time for hashing
-        cls._fetched_tx_cache.put(txid, Transaction(tx.raw))
+        cls._fetched_tx_cache.put(txid, tx.raw)
 
 
 def tx_from_str(txt):
@@ -1388,3 +1383,8 @@ class OPReturn:
         return (bitcoin.TYPE_SCRIPT, ScriptOutput.protocol_factory(op_return_script),
                 amount)
 # /OPReturn
+
+# Imported last, as it imports this module: has a side-effect, registers the
+# cash account scripts with the ScriptOutput protocol system, so that they are
+# parsed as such in the outputs of the transactions.
+from . import cashacct  # noqa: E402,F401 pylint: disable=C0413,W0611
@@ -23,6 +23,7 @@
 # SOFTWARE.
 
 import binascii
+import functools
 import hmac
 import inspect
 import itertools
@@ -43,6 +44,7 @@ from decimal import Decimal as PyDecimal  # Qt 5.12 also exports Decimal
 from functools import lru_cache
 from traceback import format_exception
 
+from . import tracing
 from .constants import POSIX_DATA_DIR, PROJECT_NAME_NO_SPACES
 
 
@@ -146,23 +148,23 @@ class ThreadJob(ABC, PrintError):
         """Called periodically from the thread"""
 
 class DebugMem(ThreadJob):
-    '''A handy class for debugging GC memory leaks'''
+    '''A handy class for debugging GC memory leaks. Prints the number of
+    instances of classes, and its change since the previous scan. See also
+    memdiag.py.'''
     def __init__(self, classes, interval=30):
         self.next_time = 0
         self.classes = classes
         self.interval = interval
+        self.last_counts = {}
 
     def mem_stats(self):
-        import gc
+        from .memdiag import count_objects
         self.print_error("Start memscan")
-        gc.collect()
-        objmap = defaultdict(list)
-        for obj in gc.get_objects():
-            for class_ in self.classes:
-                if isinstance(obj, class_):
-                    objmap[class_].append(obj)
-        for class_, objs in objmap.items():
-            self.print_error("%s: %d" % (class_.__name__, len(objs)))
+        counts = count_objects(self.classes)
+        for class_ in self.classes:
+            n = counts.get(class_.__name__, 0)
+            self.print_error("%s: %d (%+d)" % (class_.__name__, n, n - self.last_counts.get(class_.__name__, 0)))
+        self.last_counts = counts
         self.print_error("Finish memscan")
 
     def run(self):
@@ -337,6 +339,81 @@ def json_decode(x):
     except:
         return x
 
+class _Listing:
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = None  # key -> position in keys, built on first use
+
+
+class ListingPager:
+    ''' Pages through listings with offset, limit and cursor, where the
+    cursor is the key of the last item of the previous page.
+
+    Only the keys of a listing are kept, for a while, not its items: the
+    next pages take the keys after the cursor from this snapshot of the
+    first page, so that the cursor is looked up in an index instead of
+    computing and walking the listing again for each page, and get the
+    items of these keys as they are now. So the keys and their order are
+    those of the snapshot, while an item gone since (e.g. a spent coin) is
+    skipped, and one that came after is only in a listing without cursor.
+
+    A cursor that is not in the listing, e.g. because the snapshot expired
+    and the item is gone from the new one, raises ValueError: an empty page
+    means the end of the listing. '''
+
+    def __init__(self, *, maxlen=4, timeout=300.0):
+        self.listings = ExpiringCache(maxlen=maxlen, name='paged listings', timeout=timeout)
+
+    def page(self, name, make_keys, get_item, offset=0, limit=None, cursor=None,
+             *, key=None):
+        ''' Returns a page of the listing name as a list. make_keys()
+        computes the keys of the listing, for the first page and when the
+        snapshot expired, and get_item(key) returns the item of a key, or
+        None when it is gone. offset and limit count the items left.
+
+        The keys can also be small records of what the items cannot be made
+        again from, with key(record) as the cursor. '''
+        offset = int(offset or 0)
+        if offset < 0 or (limit is not None and int(limit) < 0):
+            raise ValueError('offset and limit must not be negative')
+        start = 0
+        if cursor is None:
+            listing = None
+        else:
+            listing = self.listings.get(name)
+            pos = self._find(listing, key, cursor)
+        if listing is None or (cursor is not None and pos is None):
+            listing = _Listing(list(make_keys()))
+            self.listings.put(name, listing)
+        if cursor is not None:
+            pos = self._find(listing, key, cursor)
+            if pos is None:
+                raise ValueError(f'unknown cursor {cursor!r}')
+            start = pos + 1
+        out = []
+        for k in itertools.islice(listing.keys, start, None):
+            if limit is not None and len(out) >= int(limit):
+                break
+            item = get_item(k)
+            if item is None:
+                continue
+            if offset:
+                offset -= 1
+                continue
+            out.append(item)
+        return out
+
+    @staticmethod
+    def _find(listing, key, cursor):
+        if listing is None:
+            return None
+        if listing.index is None:
+            keys = listing.keys if key is None else map(key, listing.keys)
+            listing.index = {k: i for i, k in enumerate(keys)}
+        return listing.index.get(cursor)
+
 
 # taken from Django Source Code
 def constant_time_compare(val1, val2):
@@ -344,15 +421,27 @@ def constant_time_compare(val1, val2):
     return hmac.compare_digest(to_bytes(val1, 'utf8'), to_bytes(val2, 'utf8'))
 
 
-# decorator that prints execution time
 def profiler(func):
-    def do_profile(args, kw_args):
-        t0 = time.time()
-        o = func(*args, **kw_args)
-        t = time.time() - t0
-        print_error("[profiler]", func.__qualname__, "%.4f"%t)
-        return o
-    return lambda *args, **kw_args: do_profile(args, kw_args)
+    ''' Decorator recording the execution time of func as a tracing span
+    named after it (see tracing.py), and printing it when verbose. '''
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def do_profile(*args, **kw_args):
+        if not (is_verbose or tracing.is_enabled()):
+            return func(*args, **kw_args)
+        t0 = time.perf_counter()
+        error = True
+        try:
+            o = func(*args, **kw_args)
+            error = False
+            return o
+        finally:
+            t = time.perf_counter() - t0
+            tracing.observe(name, t, error)
+            if not error:
+                print_error("[profiler]", name, "%.4f"%t)
+    return do_profile
 
 
 def ensure_sparse_file(filename):
@@ -763,6 +852,8 @@ class JSONSocketPipe(PrintError):
         self.max_message_bytes = max_message_bytes
         self.recv_buf = bytearray()
         self.send_buf = bytearray()
+        # Size in bytes of the last message returned by get()
+        self.last_message_size = 0
 
     def idle_time(self):
         return time.time() - self.recv_time
@@ -791,8 +882,10 @@ class JSONSocketPipe(PrintError):
         some known reason, raises .Closed; other errors will raise other exceptions.
         '''
         while True:
+            buf_len = len(self.recv_buf)
             response, self.recv_buf = parse_json(self.recv_buf)
             if response is not None:
+                self.last_message_size = buf_len - len(self.recv_buf)
                 return response
 
             try:
@@ -22,6 +22,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from .util import ThreadJob
 from .bitcoin import Hash, hash_decode, hash_encode
 from . import networks
@@ -83,6 +84,57 @@ class SPVDelegate(ABC):
     def diagnostic_name(self):
         ''' Make sure delegate classes have this method (PrintError interface). '''
 
+    def get_spv_proof(self, tx_hash : str):
+        ''' Optional. Return a previously stored merkle proof for tx_hash as a
+        (height : int, pos : int, branch : list of hex strings) tuple, or None.
+        The verifier checks stored proofs against the local headers before
+        asking the server for a new one. '''
+        return None
+
+    def add_spv_proof(self, tx_hash : str, height : int, pos : int, branch : list) -> None:
+        ''' Optional. Called with the merkle proof of a tx right after it was
+        verified, so that it may be persisted and returned later by
+        get_spv_proof. '''
+
+
+class MerkleNodeCache:
+    ''' Remembers the merkle tree nodes seen on the branches that were already
+    verified against a block's merkle root. When verifying another tx of the
+    same block we only need to hash our way up to the first node that is
+    already known to be part of that tree. '''
+
+    def __init__(self, max_blocks=64):
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()  # merkle root hex -> {(level, index): node}
+
+    def verify(self, branch, tx_hash, pos, merkle_root):
+        ''' Returns a (verified : bool, computed_root : str) tuple. The
+        computed root is only meaningful if verification failed. '''
+        nodes = self.blocks.get(merkle_root)
+        if nodes is not None:
+            self.blocks.move_to_end(merkle_root)
+        h = hash_decode(tx_hash)
+        index = pos
+        seen = []
+        for level, item in enumerate(branch):
+            if nodes is not None and nodes.get((level, index)) == h:
+                # The rest of the way up is already verified.
+                return True, merkle_root
+            sibling = hash_decode(item)
+            seen.append(((level, index), h))
+            seen.append(((level, index ^ 1), sibling))
+            h = Hash(sibling + h) if (index & 1) else Hash(h + sibling)
+            index >>= 1
+        computed_root = hash_encode(h)
+        if computed_root != merkle_root:
+            return False, computed_root
+        if nodes is None:
+            nodes = self.blocks[merkle_root] = {}
+            if len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        nodes.update(seen)
+        return True, merkle_root
+
 class SPV(ThreadJob):
     """ Simple Payment Verification """
 
@@ -93,6 +145,7 @@ class SPV(ThreadJob):
         self.blockchain = network.blockchain()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self.merkle_cache = MerkleNodeCache()
         self.qbusy = False
         self.cleaned_up = False
         self._need_release = False
@@ -137,6 +190,7 @@ class SPV(ThreadJob):
 
         local_height = self.network.get_local_height()
         unverified = self.wallet.get_unverified_txs()
+        n_local = 0
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
@@ -156,6 +210,10 @@ class SPV(ThreadJob):
                     if self.network.request_chunk(interface, index):
                         interface.print_error("verifier requesting chunk {} for height {}".format(index, tx_height))
                 continue
+            # try a proof we stored earlier, e.g. before a reorg or a rebuild
+            if self.verify_stored_proof(tx_hash, tx_height, header):
+                n_local += 1
+                continue
             # enqueue request
             msg_id = self.network.get_merkle_for_transaction(tx_hash, tx_height,
                                                              self.verify_merkle)
@@ -166,10 +224,36 @@ class SPV(ThreadJob):
             self.print_error('requested merkle', tx_hash)
             self.requested_merkle.add(tx_hash)
 
+        if n_local:
+            self.print_error("verified {} txs from stored proofs".format(n_local))
+            if self.is_up_to_date() and self.wallet.is_up_to_date() and not self.qbusy:
+                self.wallet.save_verified_tx(write=True)
+                self.network.trigger_callback('wallet_updated', self.wallet)
+
         if self.network.blockchain() != self.blockchain:
             self.blockchain = self.network.blockchain()
             self.undo_verifications()
 
+    def verify_stored_proof(self, tx_hash, tx_height, header):
+        ''' Verify tx_hash against header using the proof stored by the
+        wallet, if any. Returns True on success. '''
+        proof = self.wallet.get_spv_proof(tx_hash)
+        if not proof:
+            return False
+        height, pos, branch = proof
+        if height != tx_height:
+            return False
+        try:
+            ok, _ = self.merkle_cache.verify(branch, tx_hash, pos, header.get('merkle_root'))
+        except Exception as e:
+            self.print_error(f"bad stored proof for {tx_hash}: {repr(e)}")
+            return False
+        if not ok:
+            return False
+        self.merkle_roots[tx_hash] = header.get('merkle_root')
+        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos), header)
+        return True
+
     failure_reasons = (
         'inner_node_tx', 'missing_header', 'merkle_mismatch', 'error_response',
         'misc_failure', 'tx_not_found'
@@ -201,14 +285,12 @@ class SPV(ThreadJob):
             self.print_error("verify_merkle:", str(e))
             return
 
-        try:
-            # Verify the hash of the server-provided merkle branch to a
-            # transaction matches the merkle root of its block
-            tx_height = merkle['block_height']
-            pos = merkle['pos']
-            merkle_root = self.hash_merkle_root(merkle['merkle'], tx_hash, pos)
-        except Exception as e:
-            self.print_error(f"exception while verifying tx {tx_hash}: {repr(e)}")
+        tx_height = merkle['block_height']
+        pos = merkle['pos']
+        branch = merkle['merkle']
+        if not isinstance(tx_height, int) or not isinstance(pos, int) or not isinstance(branch, list):
+            self.print_error(f"bad merkle data for tx {tx_hash}: {merkle}")
+            self.forget_proof(params)
             self.wallet.verification_failed(tx_hash, self.failure_reasons[4])
             return
 
@@ -220,16 +302,28 @@ class SPV(ThreadJob):
             self.print_error(
                 "merkle verification failed for {} (missing header {})"
                 .format(tx_hash, tx_height))
+            self.forget_proof(params)
             self.wallet.verification_failed(tx_hash, self.failure_reasons[1])
             return
-        if header.get('merkle_root') != merkle_root:
+        try:
+            # Verify the hash of the server-provided merkle branch to a
+            # transaction matches the merkle root of its block
+            ok, merkle_root = self.merkle_cache.verify(branch, tx_hash, pos, header.get('merkle_root'))
+        except Exception as e:
+            self.print_error(f"exception while verifying tx {tx_hash}: {repr(e)}")
+            self.forget_proof(params)
+            self.wallet.verification_failed(tx_hash, self.failure_reasons[4])
+            return
+        if not ok:
             self.print_error(
                 "merkle verification failed for {} (merkle root mismatch {} != {})"
                 .format(tx_hash, header.get('merkle_root'), merkle_root))
+            self.forget_proof(params)
             self.wallet.verification_failed(tx_hash, self.failure_reasons[2])
             return
         # we passed all the tests
         self.merkle_roots[tx_hash] = merkle_root
+        self.wallet.add_spv_proof(tx_hash, tx_height, pos, branch)
         # note: we could pop in the beginning, but then we would request
         # this proof again in case of verification failure from the same server
         self.requested_merkle.discard(tx_hash)
@@ -267,7 +361,15 @@ class SPV(ThreadJob):
             # Check git history if you're really curious. :)
         return hash_encode(h)
 
+    def forget_proof(self, params):
+        ''' Forgets the proof the network cached for this request, so that
+        it is not served again when the tx is re-requested. '''
+        self.network.multiplexer.forget('blockchain.transaction.get_merkle', params)
+
     def undo_verifications(self):
+        # The cached proofs may be from blocks that are not in the chain
+        # anymore, e.g. for txs mined again at the same height
+        self.network.multiplexer.clear_cache('blockchain.transaction.get_merkle')
         height = self.blockchain.get_base_height()
         tx_hashes = self.wallet.undo_verifications(self.blockchain, height)
         for tx_hash in tx_hashes:
@@ -47,7 +47,7 @@ from .i18n import ngettext
 from .util import (NotEnoughFunds, ExcessiveFee, PrintError,
                    UserCancelled, InvalidPassword, profiler,
                    format_satoshis, format_time, finalization_print_error,
-                   to_string, bh2u, TimeoutException)
+                   to_string, bh2u, TimeoutException, ListingPager)
 
 from .address import Address, Script, ScriptOutput, PublicKey
 from .version import PACKAGE_VERSION
@@ -56,6 +56,7 @@ from . import mnemo
 from . import keystore
 from .storage import (
     multisig_type,
+    SaveScheduler,
     WalletStorage,
     STO_EV_PLAINTEXT,
     STO_EV_USER_PW,
@@ -78,6 +79,7 @@ from .paymentrequest import InvoiceStore, PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXP
 from .contacts import Contacts
 from . import cashacct
 from . import slp
+from . import tracing
 
 from .i18n import _
 
@@ -159,6 +161,95 @@ def sweep(privkeys, network, config, recipient, fee=None, imax=100, sign_schnorr
     return tx
 
 
+class AddressStateIndex:
+    ''' Sets of the wallet addresses that have a history, of those that
+    have a non-zero balance, and of those that are used or not, with the
+    positions of the receiving and change addresses, so that address lists
+    can be filtered without looking at every address of the wallet.
+
+    The wallet calls invalidate() wherever the history of an address
+    changes (where it invalidates its balance cache), and the index only
+    looks at those addresses again the next time it is queried. New
+    addresses are picked up from the end of the address lists, and
+    reset_positions() is called when addresses are removed. '''
+
+    def __init__(self, wallet):
+        self.wallet = wallet
+        self.dirty = set()
+        self.all_dirty = True
+        self.with_history = set()
+        self.funded = set()
+        # with_history - funded, see wallet.is_used()
+        self.used = set()
+        self.reset_positions()
+
+    def invalidate(self, address):
+        self.dirty.add(address)
+
+    def invalidate_all(self):
+        self.all_dirty = True
+
+    def refresh(self):
+        wallet = self.wallet
+        with wallet.lock:
+            if self.all_dirty:
+                self.all_dirty = False
+                self.dirty.clear()
+                self.with_history.clear()
+                self.funded.clear()
+                self.used.clear()
+                self.reset_positions()
+                addresses = list(wallet._history)
+            else:
+                addresses, self.dirty = self.dirty, set()
+            for addr in addresses:
+                if wallet._history.get(addr):
+                    self.with_history.add(addr)
+                    if any(wallet.get_addr_balance(addr)):
+                        self.funded.add(addr)
+                        self.used.discard(addr)
+                    else:
+                        self.funded.discard(addr)
+                        self.used.add(addr)
+                        self.unused.discard(addr)
+                        continue
+                else:
+                    self.with_history.discard(addr)
+                    self.funded.discard(addr)
+                    self.used.discard(addr)
+                if addr in self.receiving or addr in self.change:
+                    self.unused.add(addr)
+            self._refresh_positions()
+
+    def _refresh_positions(self):
+        ra, ca = self.wallet.get_receiving_addresses(), self.wallet.get_change_addresses()
+        for addrs, positions in ((ra, self.receiving), (ca, self.change)):
+            n = len(positions)
+            if len(addrs) < n or (n and positions.get(addrs[n - 1]) != n - 1):
+                # addresses were removed or inserted (imported wallets)
+                self.reset_positions()
+                return self._refresh_positions()
+        for addrs, positions in ((ra, self.receiving), (ca, self.change)):
+            for i in range(len(positions), len(addrs)):
+                addr = addrs[i]
+                positions[addr] = i
+                if addr not in self.used:
+                    self.unused.add(addr)
+
+    def sort_key(self):
+        ''' Returns a function giving the position of an address in
+        wallet.get_addresses(). '''
+        recv_pos, change_pos = self.receiving, self.change
+        n = len(recv_pos)
+        return lambda addr: recv_pos[addr] if addr in recv_pos else n + change_pos[addr]
+
+    def reset_positions(self):
+        # address -> position in the receiving and change address lists
+        self.receiving, self.change = {}, {}
+        # the wallet addresses that are not in self.used
+        self.unused = set()
+
+
 class Abstract_Wallet(PrintError, SPVDelegate):
     """
     Wallet classes are created to handle various address generation methods.
@@ -167,9 +258,17 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     max_change_outputs = 3
 
+    @tracing.traced('wallet.load')
     def __init__(self, storage):
         self.electrum_version = PACKAGE_VERSION
         self.storage = storage
+        # Puts the data marked dirty in the storage and writes it, from its
+        # own thread. See the callers of mark_dirty.
+        self.save_scheduler = SaveScheduler(storage, {
+            'addresses': self.save_addresses,
+            'transactions': self.save_transactions,
+            'verified_tx': self.save_verified_tx,
+        })
         self.thread = None  # this is used by the qt main_window to store a QThread. We just make sure it's always defined as an attribute here.
         self.network = None
         # verifier (SPV) and synchronizer are started in start_threads
@@ -198,6 +297,12 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         # this dict, but simply add/remove items to/from it in 1-liners (which
         # Python's GIL makes thread-safe implicitly).
         self._addr_bal_cache = {}
+        # Addresses having a history and addresses having a balance. See
+        # get_filtered_addresses.
+        self._addr_state = AddressStateIndex(self)
+        # Listings paged through by the history, listunspent and
+        # listaddresses commands
+        self.listing_pager = ListingPager()
 
         # We keep a set of the wallet and receiving addresses so that is_mine()
         # checks are O(logN) rather than O(N). This creates/resets that cache.
@@ -254,6 +359,12 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
         self.verified_tx = storage.get('verified_tx3', {})
 
+        # Merkle proofs of verified transactions, so that they can be verified
+        # again locally after a reorg or a history rebuild. Each value is a
+        # [height, block_pos, branch] list, where branch is the concatenation
+        # of the hex encoded merkle branch hashes.  Access with self.lock.
+        self.spv_proofs = storage.get('spv_proofs', {})
+
         # save wallet type the first time
         if self.storage.get('wallet_type') is None:
             self.storage.put('wallet_type', self.wallet_type)
@@ -396,9 +507,17 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 self.transactions.pop(tx_hash)
                 self.cashacct.remove_transaction_hook(tx_hash)
                 self.slp.rm_tx(tx_hash)
+        # drop proofs of tx's that are gone
+        for tx_hash in [h for h in self.spv_proofs if h not in self.transactions]:
+            self.spv_proofs.pop(tx_hash)
 
     @profiler
     def save_transactions(self, write=False):
+        ''' Puts the transactions in the storage. With write, they are put
+        and written later by the save scheduler, from its thread. '''
+        if write:
+            self.save_scheduler.mark_dirty('transactions')
+            return
         with self.lock:
             tx = {}
             for k,v in self.transactions.items():
@@ -419,15 +538,17 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             history = self.from_Address_dict(self._history)
             self.storage.put('addr_history', history)
             self.slp.save()
-            if write:
-                self.storage.write()
 
     def save_verified_tx(self, write=False):
+        ''' Puts the verified transactions in the storage. With write, they
+        are put and written later by the save scheduler, from its thread. '''
+        if write:
+            self.save_scheduler.mark_dirty('verified_tx')
+            return
         with self.lock:
             self.storage.put('verified_tx3', self.verified_tx)
+            self.storage.put('spv_proofs', self.spv_proofs)
             self.cashacct.save()
-            if write:
-                self.storage.write()
 
     def save_change_reservations(self):
         with self.lock:
@@ -446,6 +567,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             self.slp.clear()
             self.save_transactions()
             self._addr_bal_cache = {}
+            self._addr_state.invalidate_all()
             self._history = {}
             self.tx_addr_hist = defaultdict(set)
             self.cashacct.on_clear_history()
@@ -509,13 +631,12 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         with self.lock:
             self.up_to_date = up_to_date
             if up_to_date:
-                self.save_addresses()
-                self.save_transactions()
                 # if the verifier is also up to date, persist that too;
                 # otherwise it will persist its results when it finishes
                 if self.verifier and self.verifier.is_up_to_date():
-                    self.save_verified_tx()
-                self.storage.write()
+                    self.save_scheduler.mark_dirty('addresses', 'transactions', 'verified_tx')
+                else:
+                    self.save_scheduler.mark_dirty('addresses', 'transactions')
 
     def is_up_to_date(self):
         with self.lock: return self.up_to_date
@@ -565,6 +686,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         address sets only grow and never shrink and thus the length check
         of is_mine below is sufficient."""
         self._recv_address_set_cached, self._change_address_set_cached = frozenset(), frozenset()
+        self._addr_state.reset_positions()
 
     def is_mine(self, address):
         """Note this method assumes that the entire address set is
@@ -645,6 +767,20 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             self.cashacct.add_verified_tx_hook(tx_hash, info, header)
         self.network.trigger_callback('verified2', self, tx_hash, height, conf, timestamp)
 
+    def get_spv_proof(self, tx_hash):
+        with self.lock:
+            proof = self.spv_proofs.get(tx_hash)
+        if not proof:
+            return None
+        height, pos, branch = proof
+        return height, pos, [branch[i:i+64] for i in range(0, len(branch), 64)]
+
+    def add_spv_proof(self, tx_hash, height, pos, branch):
+        if not all(isinstance(item, str) and len(item) == 64 for item in branch):
+            return
+        with self.lock:
+            self.spv_proofs[tx_hash] = [height, pos, ''.join(branch)]
+
     def verification_failed(self, tx_hash, reason):
         ''' TODO: Notify gui of this if it keeps happening, try a different
         server, rate-limited retries, etc '''
@@ -675,6 +811,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                         txs.add(tx_hash)
             if txs: self.cashacct.undo_verifications_hook(txs)
         if txs:
+            self._addr_state.invalidate_all()
             self._addr_bal_cache = {}  # this is probably not necessary -- as the receive_history_callback will invalidate bad cache items -- but just to be paranoid we clear the whole balance cache on reorg anyway as a safety measure
         return txs
 
@@ -1230,6 +1367,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         finally:
             self.print_error(f"{me.name}: thread exiting")
 
+    @tracing.traced('wallet.add_transaction')
     def add_transaction(self, tx_hash, tx):
         if not tx.inputs():
             # bad tx came in off the wire -- all 0's or something, see #987
@@ -1299,6 +1437,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                         # this function later.
                         put_pruned_txo(ser, tx_hash)
                     self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                    self._addr_state.invalidate(addr)
                     del dd, prevout_hash, prevout_n, ser
                 elif addr is None:
                     # Unknown/unparsed address.. may be a strange p2sh scriptSig
@@ -1310,6 +1449,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                     if addr2 is not None and self.is_mine(addr2):
                         add_to_self_txi(tx_hash, addr2, ser, v)
                         self._addr_bal_cache.pop(addr2, None)  # invalidate cache entry
+                        self._addr_state.invalidate(addr2)
                     else:
                         # Not found in self.txo. It may still be one of ours
                         # however since tx's can come in out of order due to
@@ -1362,6 +1502,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                     l.append((n, v, is_coinbase))
                     del l
                     self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                    self._addr_state.invalidate(addr)
                 # give v to txi that spends me
                 next_tx = pop_pruned_txo(ser)
                 if next_tx is not None and mine:
@@ -1406,6 +1547,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                         prev_hash, prev_n = ser.split(':')
                         if prev_hash == tx_hash:
                             self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                            self._addr_state.invalidate(addr)
                             l.remove(item)
                             self.pruned_txo[ser] = next_tx
                             self.pruned_txo_values.add(next_tx)
@@ -1418,6 +1560,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             d = self.txo.get(tx_hash, {})
             for addr in d:
                 self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                self._addr_state.invalidate(addr)
 
             try: self.txi.pop(tx_hash)
             except KeyError: self.print_error("tx was not in input history", tx_hash)
@@ -1442,26 +1585,35 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     def receive_history_callback(self, addr, hist, tx_fees):
         with self.lock:
-            old_hist = self.get_address_history(addr)
-            for tx_hash, height in old_hist:
-                if (tx_hash, height) not in hist:
-                    s = self.tx_addr_hist.get(tx_hash)
-                    if s:
-                        s.discard(addr)
-                    if not s:
-                        # if no address references this tx anymore, kill it
-                        # from txi/txo dicts.
-                        if s is not None:
-                            # We won't keep empty sets around.
-                            self.tx_addr_hist.pop(tx_hash)
-                        # note this call doesn't actually remove the tx from
-                        # storage, it merely removes it from the self.txi
-                        # and self.txo dicts
-                        self.remove_transaction(tx_hash)
+            # Entries loaded from storage are lists, those from the network
+            # are tuples
+            old_set = set(map(tuple, self.get_address_history(addr)))
+            new_set = set(map(tuple, hist))
+            for tx_hash, height in old_set - new_set:
+                s = self.tx_addr_hist.get(tx_hash)
+                if s:
+                    s.discard(addr)
+                if not s:
+                    # if no address references this tx anymore, kill it
+                    # from txi/txo dicts.
+                    if s is not None:
+                        # We won't keep empty sets around.
+                        self.tx_addr_hist.pop(tx_hash)
+                    # note this call doesn't actually remove the tx from
+                    # storage, it merely removes it from the self.txi
+                    # and self.txo dicts
+                    self.remove_transaction(tx_hash)
             self._addr_bal_cache.pop(addr, None)  # unconditionally invalidate cache entry
+            self._addr_state.invalidate(addr)
             self._history[addr] = hist
 
             for tx_hash, tx_height in hist:
+                if (tx_hash, tx_height) in old_set:
+                    # Unchanged entry. It only needs to be re-added if a
+                    # reorg undid its verification.
+                    if tx_hash not in self.verified_tx and tx_hash not in self.unverified_tx:
+                        self.add_unverified_tx(tx_hash, tx_height)
+                    continue
                 # add it in case it was previously unconfirmed
                 self.add_unverified_tx(tx_hash, tx_height)
                 # add reference in tx_addr_hist
@@ -1484,7 +1636,9 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 if not any(True for x in cur_hist if x[0] == txid):
                     cur_hist.append((txid, 0))
                     self._history[addr] = cur_hist
+                    self._addr_state.invalidate(addr)
 
+    @tracing.traced('wallet.get_history')
     def get_history(self, domain=None, *, reverse=False):
         # get domain
         if domain is None:
@@ -1527,7 +1681,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
     def export_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None,
                        show_addresses=False, decimal_point=8,
                        *, fee_calc_timeout=10.0, download_inputs=False,
-                       progress_callback=None):
+                       progress_callback=None, offset=0, limit=None, cursor=None):
         ''' Export history. Used by RPC & GUI.
 
         Arg notes:
@@ -1549,6 +1703,10 @@ class Abstract_Wallet(PrintError, SPVDelegate):
           code. Node the progress callback is not guaranteed to be called in the
           context of the main thread, therefore GUI code should use appropriate
           signals/slots to update the GUI with progress info.
+        - `offset`, `limit` and `cursor` select a page of the history, see
+          util.ListingPager. `cursor` is a txid. Only the items of the page
+          are formatted, and the history is only computed for the first page,
+          so large histories can be exported page by page.
 
         Note on side effects: This function may update self.tx_fees. Rationale:
         it will spend some time trying very hard to calculate accurate fees by
@@ -1623,22 +1781,47 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             return format_satoshis(v, decimal_point=decimal_point,
                                    is_diff=is_diff)
 
-        # grab history
-        h = self.get_history(domain, reverse=True)
         out = []
 
-        n, l = 0, max(1, float(len(h)))
-        for tx_hash, height, conf, timestamp, value, balance in h:
-            if progress_callback:
-                progress_callback(n/l)
-            n += 1
-            timestamp_safe = timestamp
-            if timestamp is None:
-                timestamp_safe = time.time()  # set it to "now" so below code doesn't explode.
-            if from_timestamp and timestamp_safe < from_timestamp:
-                continue
-            if to_timestamp and timestamp_safe >= to_timestamp:
-                continue
+        def in_time_range():
+            # grab history
+            h = self.get_history(domain, reverse=True)
+            n, l = 0, max(1, float(len(h)))
+            for tx_hash, height, conf, timestamp, value, balance in h:
+                if progress_callback:
+                    progress_callback(n/l)
+                n += 1
+                timestamp_safe = timestamp
+                if timestamp is None:
+                    timestamp_safe = time.time()  # set it to "now" so below code doesn't explode.
+                if from_timestamp and timestamp_safe < from_timestamp:
+                    continue
+                if to_timestamp and timestamp_safe >= to_timestamp:
+                    continue
+                yield tx_hash, height, conf, timestamp, timestamp_safe, value, balance
+
+        if offset or limit is not None or cursor is not None:
+            # The snapshot keeps the value and running balance with each
+            # txid, as the balance cannot be computed for one transaction.
+            listing = ('history', domain and tuple(domain), from_timestamp, to_timestamp)
+
+            def make_entries():
+                for tx_hash, *_, value, balance in in_time_range():
+                    yield tx_hash, value, balance
+
+            def get_item(entry):
+                tx_hash, value, balance = entry
+                if tx_hash not in self.transactions:
+                    return None  # dropped out of wallet history since
+                height, conf, timestamp = self.get_tx_height(tx_hash)
+                timestamp_safe = time.time() if timestamp is None else timestamp
+                return tx_hash, height, conf, timestamp, timestamp_safe, value, balance
+
+            page = self.listing_pager.page(listing, make_entries, get_item,
+                                           offset, limit, cursor, key=lambda entry: entry[0])
+        else:
+            page = in_time_range()
+        for tx_hash, height, conf, timestamp, timestamp_safe, value, balance in page:
             try:
                 fee = try_calc_fee(tx_hash)
             except MissingTx as e:
@@ -2074,6 +2257,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             finalization_print_error(self.synchronizer)
             network.add_jobs([self.verifier, self.synchronizer])
             self.cashacct.start(self.network)  # start cashacct network-dependent subsystem, nework.add_jobs, etc
+            self.save_scheduler.max_delay = float(network.config.get('wallet_save_delay', SaveScheduler.max_delay))
         else:
             self.verifier = None
             self.synchronizer = None
@@ -2096,12 +2280,12 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             # Now no references to the syncronizer or verifier
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
-        self.save_addresses()
-        self.save_transactions()
-        self.save_verified_tx()  # implicit cashacct.save
         self.storage.put('frozen_coins', list(self.frozen_coins))
         self.save_change_reservations()
-        self.storage.write()
+        # Saves the addresses, transactions and verified transactions
+        # (implicit cashacct.save), writes the wallet and stops the writer
+        # thread
+        self.save_scheduler.stop('addresses', 'transactions', 'verified_tx')
 
     def start_pruned_txo_cleaner_thread(self):
         self.pruned_txo_cleaner_thread = threading.Thread(target=self._clean_pruned_txo_thread, daemon=True, name='clean_pruned_txo_thread')
@@ -2158,6 +2342,43 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         assert isinstance(address, Address)
         return not any(self.get_addr_balance(address))
 
+    def get_filtered_addresses(self, *, receiving=False, change=False, frozen=False,
+                               unused=False, funded=False):
+        ''' Returns the wallet addresses matching all the given filters, in
+        the order of get_addresses(). `unused` excludes the addresses for
+        which is_used() is True, `funded` those for which is_empty() is
+        True. The smallest of the sets of the address state index selected
+        by the filters is filtered by the others, so that the cost depends
+        on the size of the result rather than on the size of the wallet. '''
+        if receiving and change:
+            return []
+        state = self._addr_state
+        state.refresh()
+        sets = []
+        if receiving:
+            sets.append(state.receiving)
+        if change:
+            sets.append(state.change)
+        if frozen:
+            sets.append(self.frozen_addresses)
+        if unused:
+            sets.append(state.unused)
+        if funded:
+            sets.append(state.funded)
+        if not sets:
+            return list(self.get_addresses())
+        sets.sort(key=len)
+        candidates, others = sets[0], sets[1:]
+        if candidates is state.receiving or candidates is state.change:
+            # already in the wallet order
+            addresses = self.get_receiving_addresses() if receiving else self.get_change_addresses()
+            return [addr for addr in addresses if all(addr in s for s in others)]
+        mine = state.receiving, state.change
+        out = [addr for addr in list(candidates)
+               if any(addr in s for s in mine) and all(addr in s for s in others)]
+        out.sort(key=state.sort_key())
+        return out
+
     def address_is_old(self, address, age_limit=2):
         age = -1
         local_height = self.get_local_height()
@@ -2543,6 +2764,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
     def add_address(self, address):
         assert isinstance(address, Address)
         self._addr_bal_cache.pop(address, None)  # paranoia, not really necessary -- just want to maintain the invariant that when we modify address history below we invalidate cache.
+        self._addr_state.invalidate(address)
         self.invalidate_address_set_cache()
         if address not in self._history:
             self._history[address] = []
@@ -2780,11 +3002,13 @@ class ImportedWalletBase(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self._history.pop(address, None)
+            self._addr_state.invalidate(address)
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
                 self.tx_fees.pop(tx_hash, None)
                 self.verified_tx.pop(tx_hash, None)
+                self.spv_proofs.pop(tx_hash, None)
                 self.unverified_tx.pop(tx_hash, None)
                 self.transactions.pop(tx_hash, None)
                 self._addr_bal_cache.pop(address, None)  # not strictly necessary, above calls also have this side-effect. but here to be safe. :)
@@ -2797,6 +3021,7 @@ class ImportedWalletBase(Simple_Wallet):
                 # FIXME: what about pruned_txo?
 
             self.storage.put('verified_tx3', self.verified_tx)
+            self.storage.put('spv_proofs', self.spv_proofs)
 
         self.save_transactions()
 
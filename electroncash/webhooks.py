@@ -0,0 +1,367 @@
+# Electrum ABC - lightweight eCash client
+# Copyright (C) 2020 The Electrum ABC developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""HTTP notifications for the notify command.
+
+The network thread must never wait on a webhook endpoint, so status
+notifications are only queued by the AddressNotifier, and POSTed by the
+WebhookDispatcher from its own pool of threads. Each thread keeps a
+requests.Session, so connections to an endpoint are reused. A slow or
+failing endpoint only holds a limited number of threads, and failed
+deliveries are retried with an exponential backoff.
+"""
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+
+from .address import Address
+from .tracing import LatencyHistogram
+from .util import PrintError
+
+# Config keys and defaults
+DEFAULT_WORKERS = 4  # 'notify_workers'
+DEFAULT_MAX_PENDING = 10_000  # 'notify_max_pending'
+DEFAULT_PER_ENDPOINT = 2  # 'notify_per_endpoint'
+DEFAULT_MAX_ATTEMPTS = 6  # 'notify_max_attempts'
+
+HTTP_TIMEOUT = 5.0
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+
+WATCHES_FILE = "notify-watches"
+
+
+def endpoint_of(url):
+    parts = urlsplit(url)
+    return "{}://{}".format(parts.scheme, parts.netloc)
+
+
+class Delivery:
+    __slots__ = ("url", "endpoint", "body", "attempts", "created")
+
+    def __init__(self, url, body):
+        self.url = url
+        self.endpoint = endpoint_of(url)
+        self.body = body
+        self.attempts = 0
+        self.created = time.monotonic()
+
+
+class EndpointState:
+    __slots__ = ("in_flight", "backlog", "delivered", "failed", "latency")
+
+    def __init__(self):
+        self.in_flight = 0
+        # deliveries waiting for one of the in-flight ones to finish
+        self.backlog = deque()
+        self.delivered = 0
+        self.failed = 0
+        self.latency = LatencyHistogram()
+
+
+class WebhookDispatcher(PrintError):
+    """POSTs JSON documents to URLs from a pool of worker threads.
+
+    post() never blocks: it returns False, and the notification is dropped,
+    when max_pending deliveries are already waiting. At most per_endpoint
+    requests are in flight to a given scheme://host:port. A delivery is
+    retried up to max_attempts times, after 1, 2, 4... times backoff
+    seconds."""
+
+    def __init__(self, *, workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING,
+                 per_endpoint=DEFAULT_PER_ENDPOINT, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff=BACKOFF_BASE, timeout=HTTP_TIMEOUT, send=None):
+        self.n_workers = max(1, workers)
+        self.max_pending = max_pending
+        self.per_endpoint = max(1, per_endpoint)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.timeout = timeout
+        # send(session, url, body): raises on failure. Replaced in tests.
+        self.send = send or self._send
+        self.cond = threading.Condition()
+        self.ready = deque()
+        # (due time, seq, delivery)
+        self.retries = []
+        self.seq = itertools.count()
+        self.endpoints = {}
+        self.pending = 0
+        self.threads = []
+        self.running = False
+        self.local = threading.local()
+        # counters
+        self.n_queued = 0
+        self.n_delivered = 0
+        self.n_failed = 0
+        self.n_retried = 0
+        self.n_dropped = 0
+
+    def diagnostic_name(self):
+        return "WebhookDispatcher"
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        for i in range(self.n_workers):
+            t = threading.Thread(target=self.worker, name="Webhook-{}".format(i), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self, timeout=None):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join(timeout)
+        self.threads = []
+
+    def post(self, url, data):
+        body = json.dumps(data).encode("utf-8")
+        with self.cond:
+            if self.pending >= self.max_pending:
+                self.n_dropped += 1
+                return False
+            self.pending += 1
+            self.n_queued += 1
+            self.ready.append(Delivery(url, body))
+            self.cond.notify()
+        return True
+
+    def _next(self):
+        """Called with self.cond held. Returns a delivery to send, or None."""
+        now = time.monotonic()
+        while self.retries and self.retries[0][0] <= now:
+            self.ready.append(heapq.heappop(self.retries)[2])
+        while self.ready:
+            d = self.ready.popleft()
+            ep = self.endpoints.get(d.endpoint)
+            if ep is None:
+                ep = self.endpoints[d.endpoint] = EndpointState()
+            if ep.in_flight >= self.per_endpoint:
+                ep.backlog.append(d)
+                continue
+            ep.in_flight += 1
+            return d
+        return None
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.running:
+                        return
+                    d = self._next()
+                    if d is not None:
+                        break
+                    wait = self.retries[0][0] - time.monotonic() if self.retries else 1.0
+                    self.cond.wait(min(max(wait, 0.01), 1.0))
+            t0 = time.monotonic()
+            try:
+                self.send(self.session(), d.url, d.body)
+                ok = True
+            except Exception as e:
+                self.print_error("POST to", d.endpoint, "failed:", repr(e))
+                ok = False
+            self.finished(d, ok, time.monotonic() - t0)
+
+    def finished(self, d, ok, duration):
+        with self.cond:
+            ep = self.endpoints[d.endpoint]
+            ep.in_flight -= 1
+            ep.latency.add(duration, error=not ok)
+            if ep.backlog:
+                self.ready.appendleft(ep.backlog.popleft())
+            d.attempts += 1
+            if ok:
+                ep.delivered += 1
+                self.n_delivered += 1
+                self.pending -= 1
+            elif d.attempts < self.max_attempts and self.running:
+                self.n_retried += 1
+                delay = min(self.backoff * 2 ** (d.attempts - 1), BACKOFF_MAX)
+                heapq.heappush(self.retries, (time.monotonic() + delay, next(self.seq), d))
+            else:
+                ep.failed += 1
+                self.n_failed += 1
+                self.pending -= 1
+            self.cond.notify_all()
+
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.per_endpoint)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        return session
+
+    def _send(self, session, url, body):
+        r = session.post(url, data=body, timeout=self.timeout,
+                         headers={"content-type": "application/json"})
+        r.raise_for_status()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "queued": self.n_queued,
+                "delivered": self.n_delivered,
+                "failed": self.n_failed,
+                "retried": self.n_retried,
+                "dropped": self.n_dropped,
+                "pending": self.pending,
+                "waiting_retry": len(self.retries),
+                "endpoints": {
+                    name: {
+                        "in_flight": ep.in_flight,
+                        "backlog": len(ep.backlog),
+                        "delivered": ep.delivered,
+                        "failed": ep.failed,
+                        "latency": ep.latency.to_dict(),
+                    }
+                    for name, ep in sorted(self.endpoints.items())
+                },
+            }
+
+
+class AddressNotifier(PrintError):
+    """The addresses watched with the notify command, and the URLs to
+    notify for each of them.
+
+    Watches are saved to the notify-watches file of the data directory,
+    and subscribed to again when the daemon starts."""
+
+    def __init__(self, config, network, dispatcher=None):
+        self.config = config
+        self.network = network
+        self.path = os.path.join(config.path, WATCHES_FILE) if config.path else None
+        self.lock = threading.Lock()
+        # Address -> set of URLs
+        self.watches = {}
+        # scripthash -> Address
+        self.sh2addr = {}
+        self.dispatcher = dispatcher or WebhookDispatcher(
+            workers=config.get("notify_workers", DEFAULT_WORKERS),
+            max_pending=config.get("notify_max_pending", DEFAULT_MAX_PENDING),
+            per_endpoint=config.get("notify_per_endpoint", DEFAULT_PER_ENDPOINT),
+            max_attempts=config.get("notify_max_attempts", DEFAULT_MAX_ATTEMPTS),
+        )
+
+    def diagnostic_name(self):
+        return "AddressNotifier"
+
+    @classmethod
+    def get(cls, network):
+        """Returns the notifier of network, creating it if needed."""
+        with network.lock:
+            notifier = getattr(network, "address_notifier", None)
+            if notifier is None:
+                notifier = network.address_notifier = cls(network.config, network)
+        return notifier
+
+    @classmethod
+    def restore(cls, network):
+        """Resubscribes the watches saved by a previous run, if any."""
+        notifier = cls.get(network)
+        notifier.load()
+        return notifier
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict):
+            return
+        for address, urls in data.items():
+            if isinstance(urls, list):
+                for url in urls:
+                    self.add(address, url, save=False)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            s = json.dumps({a.to_full_ui_string(): sorted(urls)
+                            for a, urls in self.watches.items()},
+                           indent=4, sort_keys=True)
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(s)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            self.print_error("failed to save:", repr(e))
+
+    def add(self, address, url, save=True):
+        addr = Address.from_string(address)
+        h = addr.to_scripthash_hex()
+        with self.lock:
+            if h not in self.sh2addr:
+                self.sh2addr[h] = addr
+                self.network.subscribe_to_scripthashes([h], self.on_status)
+            self.watches.setdefault(addr, set()).add(url)
+        self.dispatcher.start()
+        if save:
+            self.save()
+
+    def remove(self, address):
+        """Stops watching address. Returns False if it was not watched."""
+        addr = Address.from_string(address)
+        h = addr.to_scripthash_hex()
+        with self.lock:
+            if self.watches.pop(addr, None) is None:
+                return False
+            self.sh2addr.pop(h, None)
+            self.network.unsubscribe_from_scripthashes([h], self.on_status)
+        self.save()
+        return True
+
+    def on_status(self, response):
+        # Called from the network thread: only queue the notifications
+        params = response.get("params")
+        if response.get("error") or not params:
+            return
+        with self.lock:
+            addr = self.sh2addr.get(params[0])
+            urls = list(self.watches.get(addr, ()))
+        if not urls:
+            return
+        address = addr.to_full_ui_string()
+        data = {"address": address, "status": response.get("result")}
+        for url in urls:
+            if not self.dispatcher.post(url, data):
+                self.print_error("queue full, dropped notification for", address)
+
+    def stop(self):
+        self.dispatcher.stop(timeout=HTTP_TIMEOUT)
@@ -23,118 +23,302 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import json
+import os
 import queue
-import threading, os, json
+import re
+import threading
+import time
 from collections import defaultdict
+
 try:
     from SimpleWebSocketServer import WebSocket, SimpleSSLWebSocketServer
 except ImportError:
-    import sys
-    sys.exit("install SimpleWebSocketServer")
+    # Only needed to actually serve websockets, see WebSocketServer.run
+    class WebSocket:
+        pass
+    SimpleSSLWebSocketServer = None
 
 from . import util
 from .address import Address
 
+# Interval, in seconds, between two rescans of requests_dir, to pick up
+# modified and deleted payment requests
+REGISTRY_REFRESH_INTERVAL = 60.0
+
+# Payment request ids are used as file names
+REQUEST_ID_RE = re.compile(r'^[0-9A-Za-z_:-]{2,128}$')
+
+# Events for WsClientThread, from the websocket server and network threads
 request_queue = queue.Queue()
 
+
 class ElectrumWebSocket(WebSocket, util.PrintError):
 
     def handleMessage(self):
-        assert self.data[:3] == 'id:'
+        if not self.data.startswith('id:'):
+            self.print_error("unexpected message", self.data[:80])
+            return
         self.print_error("message received", self.data)
-        request_id = self.data[3:]
-        request_queue.put((self, request_id))
+        request_queue.put(('subscribe', self, self.data[3:]))
 
     def handleConnected(self):
         self.print_error("connected", self.address)
 
     def handleClose(self):
         self.print_error("closed", self.address)
+        request_queue.put(('close', self))
+
+
+class RequestRegistry(util.PrintError):
+    ''' In-memory index of the payment requests published in requests_dir:
+    request id -> (address, amount).
+
+    Requests are looked up in memory; a request missing from the index is
+    loaded from its file, so that new requests are found right away, and
+    refresh() rescans the directory for modified and deleted ones. '''
+
+    def __init__(self, rdir):
+        self.rdir = rdir
+        # request id -> (mtime, Address, amount)
+        self.requests = {}
+        self.last_refresh = 0.0
+
+    def diagnostic_name(self):
+        return 'RequestRegistry'
+
+    def path(self, request_id):
+        return os.path.join(self.rdir, 'req', request_id[0], request_id[1],
+                            request_id, request_id + '.json')
 
+    def get(self, request_id):
+        ''' Returns (address, amount) for request_id, or None. '''
+        if not self.rdir or not REQUEST_ID_RE.match(request_id):
+            return None
+        entry = self.requests.get(request_id)
+        if entry is None:
+            entry = self.load(request_id)
+        return entry and entry[1:]
+
+    def load(self, request_id, mtime=None):
+        path = self.path(request_id)
+        try:
+            if mtime is None:
+                mtime = os.stat(path).st_mtime
+            with open(path, encoding='utf-8') as f:
+                d = json.load(f)
+            entry = mtime, Address.from_string(d['address']), d.get('amount') or 0
+        except FileNotFoundError:
+            self.requests.pop(request_id, None)
+            return None
+        except Exception as e:
+            self.print_error("cannot load request", request_id, repr(e))
+            self.requests.pop(request_id, None)
+            return None
+        self.requests[request_id] = entry
+        return entry
+
+    def refresh(self):
+        ''' Rescans requests_dir, reloading the files that changed. '''
+        self.last_refresh = time.time()
+        if not self.rdir:
+            return
+        seen = set()
+        for path in self.scan():
+            request_id = os.path.basename(path)[:-len('.json')]
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            seen.add(request_id)
+            entry = self.requests.get(request_id)
+            if entry is None or entry[0] != mtime:
+                self.load(request_id, mtime)
+        for request_id in set(self.requests) - seen:
+            del self.requests[request_id]
+
+    def scan(self):
+        # req/<id[0]>/<id[1]>/<id>/<id>.json
+        def subdirs(path):
+            try:
+                with os.scandir(path) as it:
+                    return [e.path for e in it if e.is_dir()]
+            except OSError:
+                return []
+        for d0 in subdirs(os.path.join(self.rdir, 'req')):
+            for d1 in subdirs(d0):
+                for d2 in subdirs(d1):
+                    path = os.path.join(d2, os.path.basename(d2) + '.json')
+                    if os.path.exists(path):
+                        yield path
 
 
 class WsClientThread(util.DaemonThread):
+    ''' Tells websocket clients when the payment request they are waiting
+    for is paid.
+
+    Clients are indexed by address and by socket, and forgotten when their
+    socket closes or once they have been notified. The balance of addresses
+    belonging to a loaded wallet is computed by the wallet; the server is
+    only asked for the balance of other addresses, and only when their
+    status changes. '''
 
-    def __init__(self, config, network):
+    def __init__(self, config, network, wallets=None, events=None):
         super().__init__()
         self.network = network
         self.config = config
-        self.response_queue = queue.Queue()
-        self.subscriptions = defaultdict(list)
-        self.sh2addr = dict()
-
-    def make_request(self, request_id):
-        # read json file
-        rdir = self.config.get('requests_dir')
-        n = os.path.join(rdir, 'req', request_id[0], request_id[1], request_id, request_id + '.json')
-        with open(n, encoding='utf-8') as f:
-            s = f.read()
-        d = json.loads(s)
-        addr = d.get('address')
-        amount = d.get('amount')
-        return addr, amount
-
-    def reading_thread(self):
-        while self.is_running():
-            try:
-                ws, request_id = request_queue.get()
-            except queue.Empty:
-                continue
-            try:
-                addr, amount = self.make_request(request_id)
-            except:
-                continue
-            try:
-                addr = Address.from_string(addr)
-            except Exception as e:
-                self.print_error("Error parsing address", addr, repr(e))
-                continue
-            l = self.subscriptions[addr]  # defaultdict will create empty list if not already there.
-            l.append((ws, amount))
+        # The daemon's dict of loaded wallets
+        self.wallets = wallets if wallets is not None else {}
+        self.events = events if events is not None else request_queue
+        self.registry = RequestRegistry(config.get('requests_dir'))
+        # Address -> {websocket: amount}
+        self.subscriptions = {}
+        # websocket -> addresses it waits on
+        self.ws_addresses = defaultdict(set)
+        self.sh2addr = {}
+        # scripthash -> last status seen, for the subscribed scripthashes
+        self.statuses = {}
+        # scripthash -> balance, if known
+        self.balances = {}
+        self.n_paid = 0
+
+    def response_callback(self, response):
+        self.events.put(('response', response))
+
+    def on_payment_received(self, event, wallet, addr, status):
+        if addr in self.subscriptions:
+            self.events.put(('payment', wallet, addr))
+
+    def subscribe(self, ws, request_id):
+        r = self.registry.get(request_id)
+        if r is None:
+            self.print_error("unknown request", request_id)
+            return
+        addr, amount = r
+        self.subscriptions.setdefault(addr, {})[ws] = amount
+        self.ws_addresses[ws].add(addr)
+        h = addr.to_scripthash_hex()
+        if h not in self.sh2addr:
+            self.sh2addr[h] = addr
+            self.network.subscribe_to_scripthashes([h], self.response_callback)
+        elif h in self.balances:
+            self.notify(addr, self.balances[h])
+
+    def close(self, ws):
+        for addr in self.ws_addresses.pop(ws, ()):
+            self.unsubscribe(addr, ws)
+
+    def unsubscribe(self, addr, ws):
+        subs = self.subscriptions.get(addr)
+        if subs is None:
+            return
+        subs.pop(ws, None)
+        if not subs:
+            # Nobody waits on this address anymore
+            del self.subscriptions[addr]
             h = addr.to_scripthash_hex()
-            self.sh2addr[h] = addr  # remember this scripthash_hex -> addr mapping since run() below needs it.
-            self.network.send([('blockchain.scripthash.subscribe', [h])], self.response_queue.put)
+            self.network.unsubscribe_from_scripthashes([h], self.response_callback)
+            self.sh2addr.pop(h, None)
+            self.statuses.pop(h, None)
+            self.balances.pop(h, None)
 
+    def find_wallet(self, addr):
+        for wallet in list(self.wallets.values()):
+            if wallet.is_mine(addr):
+                return wallet
 
-    def run(self):
-        threading.Thread(target=self.reading_thread).start()
-        while self.is_running():
-            try:
-                r = self.response_queue.get(timeout=0.1)
-            except queue.Empty:
-                continue
-            self.print_error('response', r)
-            method = r.get('method')
-            params = r.get('params')
-            result = r.get('result')
+    def on_response(self, r):
+        method = r.get('method')
+        params = r.get('params')
+        if r.get('error') or not params:
+            return
+        h = params[0]
+        addr = self.sh2addr.get(h)
+        if addr is None:
+            return
+        result = r.get('result')
+        if method == 'blockchain.scripthash.subscribe':
+            if h in self.statuses and self.statuses[h] == result:
+                return
+            self.statuses[h] = result
             if result is None:
-                continue
-            if method == 'blockchain.scripthash.subscribe':
-                self.network.send([('blockchain.scripthash.get_balance', params)], self.response_queue.put)
-            elif method == 'blockchain.scripthash.get_balance':
-                h = params[0]
-                addr = self.sh2addr.get(h)
-                if addr is None:
-                    self.print_error("can't find address for scripthash:", h)
-                    continue
-                l = self.subscriptions.get(addr, [])
-                for ws, amount in l:
-                    if not ws.closed:
-                        if sum(result.values()) >= amount:
-                            ws.sendMessage('paid')
+                # no history
+                self.set_balance(addr, 0)
+                return
+            wallet = self.find_wallet(addr)
+            if wallet is not None:
+                self.set_balance(addr, sum(wallet.get_addr_balance(addr)))
+            else:
+                self.network.send([('blockchain.scripthash.get_balance', params)],
+                                  self.response_callback)
+        elif method == 'blockchain.scripthash.get_balance' and result is not None:
+            self.set_balance(addr, sum(result.values()))
+
+    def on_payment(self, wallet, addr):
+        if addr in self.subscriptions:
+            self.set_balance(addr, sum(wallet.get_addr_balance(addr)))
+
+    def set_balance(self, addr, balance):
+        self.balances[addr.to_scripthash_hex()] = balance
+        self.notify(addr, balance)
 
+    def notify(self, addr, balance):
+        for ws, amount in list(self.subscriptions.get(addr, {}).items()):
+            if ws.closed:
+                self.close(ws)
+            elif balance >= amount:
+                ws.sendMessage('paid')
+                self.n_paid += 1
+                # The request is paid, this client is done with it
+                self.ws_addresses[ws].discard(addr)
+                if not self.ws_addresses[ws]:
+                    del self.ws_addresses[ws]
+                self.unsubscribe(addr, ws)
+
+    def process(self, event):
+        kind = event[0]
+        if kind == 'subscribe':
+            self.subscribe(*event[1:])
+        elif kind == 'close':
+            self.close(*event[1:])
+        elif kind == 'response':
+            self.on_response(*event[1:])
+        elif kind == 'payment':
+            self.on_payment(*event[1:])
+
+    def run(self):
+        self.network.register_callback(self.on_payment_received, ['payment_received'])
+        try:
+            while self.is_running():
+                if time.time() - self.registry.last_refresh > REGISTRY_REFRESH_INTERVAL:
+                    self.registry.refresh()
+                try:
+                    event = self.events.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                try:
+                    self.process(event)
+                except Exception as e:
+                    self.print_error("error processing", event[0], repr(e))
+        finally:
+            self.network.unregister_callback(self.on_payment_received)
+            self.on_stop()
 
 
 class WebSocketServer(threading.Thread):
 
-    def __init__(self, config, ns):
+    def __init__(self, config, ns, wallets=None):
         threading.Thread.__init__(self)
         self.config = config
         self.net_server = ns
+        self.wallets = wallets
         self.daemon = True
 
     def run(self):
-        t = WsClientThread(self.config, self.net_server)
+        if SimpleSSLWebSocketServer is None:
+            util.print_error("[WebSocketServer] install SimpleWebSocketServer")
+            return
+        t = WsClientThread(self.config, self.net_server, self.wallets)
         t.start()
 
         host = self.config.get('websocket_server')
@@ -991,6 +991,7 @@ class ElectrumGui(QtCore.QObject, PrintError):
             event = QtCore.QEvent(QtCore.QEvent.Clipboard)
             self.app.sendEvent(self.app.clipboard(), event)
             self.tray.hide()
+            self.config.flush()
         self.app.aboutToQuit.connect(clean_up)
 
         ExceptionHook(self.config) # This wouldn't work anyway unless the app event loop is active, so we must install it once here and no earlier.
@@ -601,7 +601,7 @@ class ElectrumWindow(QtWidgets.QMainWindow, MessageBoxMixin, PrintError):
 
 
     def backup_wallet(self):
-        self.wallet.storage.write()  # make sure file is committed to disk
+        self.wallet.save_scheduler.flush()  # make sure file is committed to disk
         path = self.wallet.storage.path
         wallet_folder = os.path.dirname(path)
         filename, __ = QtWidgets.QFileDialog.getSaveFileName(self, _('Enter a filename for the copy of your wallet'), wallet_folder)
@@ -2342,6 +2342,14 @@ class ElectrumWindow(QtWidgets.QMainWindow, MessageBoxMixin, PrintError):
                 # Not a PR, just broadcast.
                 status, msg = self.network.broadcast_transaction(tx)
 
+            if status:
+                # Commit what the wallet knows about the payment, e.g. the
+                # paid invoice, to disk before telling the user it was sent
+                try:
+                    self.wallet.save_scheduler.flush()
+                except OSError as e:
+                    self.print_error("Warning: cannot save wallet:", repr(e))
+
             return status, msg
 
         # Check fee and warn if it's below 1.0 sats/B (and not warned already)
@@ -38,3 +38,6 @@ description_delimiter = ''
 available_for = ['qt', 'cmdline']
 # If default_on is set to True, this plugin is loaded by default on new installs
 default_on = True
+# The command line daemon loads this plugin on the first use of one of these
+# commands (see Plugins.defer_plugin)
+daemon_commands = ['fusion_server_start', 'fusion_server_stop', 'fusion_server_status', 'fusion_server_fuse']